@@ -0,0 +1,347 @@
+""" Crispery benchmarks.
+
+Generates reproducible synthetic sequencing data (the same seed always gives
+the same library and reads), and times the main steps of the pipeline
+separately: startup (import, library loading, first counted reads and worker
+spawning), decompression, parsing, read counting with mismatch resolution
+and compiling. Every run is done in a fresh process, so the peak memory use
+(RSS) of each run can be measured as well.
+The results are printed, and saved as JSON, one record per run and step.
+
+type `python benchmark.py -h` for the options """
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+import psutil
+
+import crispery
+
+def synthetic_library(size, lenght=20, seed=0):
+
+    """ a library of "size" unique random sgRNAs """
+
+    rng = np.random.default_rng(seed)
+    sequences = set()
+    while len(sequences) < size:
+        bases = rng.integers(0, 4, size=(size, lenght))
+        sequences.update("".join("ACGT"[b] for b in row) for row in bases.tolist())
+    sequences = sorted(sequences)[:size]
+    rng.shuffle(sequences)
+    return [f"sgRNA{i:07d}" for i in range(size)], sequences
+
+def library_writer(path, names, sequences):
+
+    """ writes the library as a sgRNA .csv file (see D39V_guides.csv) """
+
+    with open(path, "w") as output:
+        for name, sequence in zip(names, sequences):
+            output.write(f"{name},{sequence}\n")
+
+def synthetic_reads(path, sequences, reads, error_rate=0.002, n_rate=0.0005, phred=None, offset=0, read_lenght=75, seed=0, compress=False):
+
+    """ writes "reads" random fastq records, each one with a sgRNA from
+    "sequences" at position "offset", and random flanking sequence.
+    Every base of the sgRNA is substituted with probability "error_rate", and
+    replaced by N with probability "n_rate". Quality scores are drawn from
+    "phred", a {score:weight} dictionary (Phred+33 encoding) """
+
+    rng = np.random.default_rng(seed)
+    phred = phred or {37:0.985, 25:0.01, 11:0.005}
+    scores = np.array(list(phred), dtype=np.uint8) + 33
+    weights = np.array(list(phred.values()), dtype=float)
+    lenght = len(sequences[0])
+    acgt = np.frombuffer(b"ACGT", dtype=np.uint8)
+    guides = np.frombuffer("".join(sequences).encode(), dtype=np.uint8).reshape(len(sequences), lenght)
+
+    opener = gzip.open if compress else open
+    with opener(path, "wb") as output:
+        for first in range(0, reads, 100000):
+            batch = min(100000, reads - first)
+            bases = acgt[rng.integers(0, 4, size=(batch, read_lenght))]
+            window = guides[rng.integers(0, len(sequences), size=batch)].copy()
+
+            errors = rng.random(window.shape) < error_rate
+            window[errors] = acgt[(np.searchsorted(acgt, window[errors]) + rng.integers(1, 4, size=errors.sum())) % 4]
+            window[rng.random(window.shape) < n_rate] = ord("N")
+            bases[:, offset:offset+lenght] = window[:, :read_lenght-offset]
+
+            qualities = scores[rng.choice(len(scores), size=(batch, read_lenght), p=weights / weights.sum())]
+            records = [b"@read%d\n%s\n+\n%s\n" % (first + i, sequence, quality) for i, (sequence, quality)
+                       in enumerate(zip(map(bytes, bases), map(bytes, qualities)))]
+            output.write(b"".join(records))
+
+def peak_rss():
+
+    """ peak memory use (RSS) of the current process, in MB. On linux, 
+    "ru_maxrss" is inherited from the parent process, so VmHWM is used instead """
+
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 / 1024 # macOS, in bytes
+    except ImportError: # windows
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024
+
+def decompress_run(case):
+
+    """ drains the .gz file through the "DecompressReader" """
+
+    tempo = time()
+    size = 0
+    for block in crispery.DecompressReader(case["gz"]).blocks():
+        size += len(block)
+    return {"seconds":time() - tempo, "bytes":size}
+
+def counting_run(case):
+
+    """ counts the uncompressed file, timing the parsing (quality control and 
+    perfect matches) and the mismatch search of the "ReadResolver" separately,
+    as well as the whole count. The mismatch index is built first, and timed 
+    on its own """
+
+    library = crispery.guides_loader(case["guides"])
+    qualities = crispery.phred_filter(case["phred"])
+    lenght, mismatch = case["lenght"], case["mismatch"]
+
+    if case["engine"] == "python":
+        crispery.reads_counter(case["warmup"], qualities, case["offset"], lenght, library, mismatch, case["cache"])
+        metrics = crispery.Metrics()
+        tempo = time()
+        reads, perfect_counter, imperfect_counter, counts = crispery.reads_counter(case["plain"], qualities, case["offset"], lenght, library, mismatch, case["cache"], metrics)
+        return {"count":time() - tempo, "reads":reads, "perfect":perfect_counter, "imperfect":imperfect_counter,
+                "cache_hit_rate":metrics.summary()["cache_hit_rate"]}
+
+    keys = crispery.packed_guides(library, lenght)
+    tempo = time()
+    index = crispery.search_index(keys, lenght, mismatch, case["search"])
+    index_time = time() - tempo
+
+    crispery.fast_reads_counter(case["warmup"], qualities, case["offset"], lenght, library, mismatch, case["cache"], keys, index) # compiles the kernels
+    if index is not None:
+        crispery.index_lookup(keys[:2], index, mismatch) # and the mismatch search ones, the warmup reads might not need them
+
+    resolver = crispery.ReadResolver(qualities, case["offset"], lenght, library, mismatch, case["cache"], keys, index)
+    parse, search, reads, perfect_counter, imperfect_counter = 0, 0, 0, 0, 0
+    counts = library.new_counts()
+    reader = crispery.RecordReader(case["plain"])
+    started = time()
+    for buffer in reader:
+        tempo = time()
+        found, used, ids = resolver.parse(buffer)
+        parse += time() - tempo
+        tempo = time()
+        rescued = resolver.rescue(buffer, ids)
+        search += time() - tempo
+        reader.consumed(used)
+        reads += found
+        counts += np.bincount(ids[ids >= 0], minlength=len(library)).astype(np.uint64)
+        imperfect_counter += int(rescued.sum())
+        perfect_counter += int((ids >= 0).sum()) - int(rescued.sum())
+
+    return {"index":index_time, "parse":parse, "mismatch":search, "count":time() - started, "reads":reads, "perfect":perfect_counter,
+            "imperfect":imperfect_counter, "cache_hit_rate":resolver.metrics.summary()["cache_hit_rate"]}
+
+def compiling_run(case):
+
+    """ compiles "samples" random count vectors, as "multi" would return them """
+
+    library = crispery.guides_loader(case["guides"])
+    rng = np.random.default_rng(case["seed"])
+    folder = tempfile.mkdtemp(dir=case["folder"])
+    results = []
+    for sample in range(case["samples"]):
+        counts = rng.integers(0, 1000, size=len(library)).astype(np.uint64)
+        stats = [f"sample{sample}", "1", "seconds", int(counts.sum()), int(counts.sum()), int(counts.sum()), 0]
+        results.append((os.path.join(folder, f"sample{sample}.fastq"), stats, counts))
+
+    tempo = time()
+    crispery.compiling(results, library, folder, 30, 1, "benchmark", os.sep, None)
+    seconds = time() - tempo
+    shutil.rmtree(folder, ignore_errors=True)
+    return {"seconds":seconds}
+
+def import_run(repeats=3):
+
+    """ imports crispery in a fresh interpreter, best of "repeats". Also tells
+    whether the plotting or GUI modules were loaded with it """
+
+    code = "from time import time; tempo = time(); import crispery, sys; print(time() - tempo, 'matplotlib' in sys.modules or 'tkinter' in sys.modules)"
+    best, heavy = None, None
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(crispery.__file__)),
+                                capture_output=True, text=True, check=True).stdout.split()
+        best, heavy = min(float(output[0]), best or float(output[0])), output[1] == "True"
+    return {"seconds":best, "heavy_modules":heavy}
+
+def startup_run(case):
+
+    """ time to the first counted reads in a fresh process: loading the library
+    (from the .csv file, or the index file made by build-index), and counting 
+    a tiny file, which includes loading (or compiling) the numba kernels """
+
+    qualities = crispery.phred_filter(case["phred"])
+    tempo = time()
+    library, keys, index = crispery.library_loader(case[case["source"]], case["lenght"], 1, "fast", "index")
+    loaded = time()
+    crispery.fast_reads_counter(case["warmup"], qualities, case["offset"], case["lenght"], library, 1, 64, keys, index)
+    return {"library":loaded - tempo, "first_count":time() - loaded}
+
+def worker_ready(shared, folder, ready):
+    crispery.worker_setup(shared, folder)
+    ready.put(time())
+
+def spawn_run(case):
+
+    """ starts a pool of spawned workers (as on macOS and windows) with the 
+    library of the index file, and times it until the last worker is ready """
+
+    library, keys, index = crispery.library_loader(case["index_file"], case["lenght"], 1, "fast", "index")
+    folder = tempfile.mkdtemp(dir=case["folder"])
+    crispery.save_arrays(folder, crispery.library_arrays(library, keys, index, None))
+    shared = {"quality_set":crispery.phred_filter(case["phred"]), "mismatch":1, "cache_size":64, "start":case["offset"], "lenght":case["lenght"], "span":0,
+              "index_kind":index[0] if index is not None else None, "store":None}
+
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    tempo = time()
+    pool = context.Pool(case["workers"], initializer=worker_ready, initargs=(shared, folder, ready))
+    seconds = max(ready.get() for _ in range(case["workers"])) - tempo
+    pool.close()
+    pool.join()
+    shutil.rmtree(folder, ignore_errors=True)
+    return {"seconds":seconds}
+
+def isolated(job):
+
+    """ runs one benchmark in the (fresh) worker process """
+
+    function, case = job
+    result = function(case)
+    result["peak_rss_mb"] = round(peak_rss(), 1)
+    return result
+
+def run(function, case):
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(isolated, ((function, case),))
+
+def benchmark(args):
+
+    """ runs the whole grid of benchmarks, and returns one record per run and step """
+
+    os.makedirs(args.o, exist_ok=True)
+    folder = tempfile.mkdtemp(prefix="benchmark_", dir=args.o)
+    phred = {int(score):float(weight) for score, weight in (pair.split(":") for pair in args.q.split(","))}
+    records = []
+
+    def record(**fields):
+        fields["reads_per_s"] = round(fields["reads"] / fields["seconds"]) if fields["reads"] and fields["seconds"] else None
+        fields["seconds"] = round(fields["seconds"], 4)
+        records.append(fields)
+        print(json.dumps(fields))
+
+    try:
+        result = import_run()
+        record(step="import", reads=0, seconds=result["seconds"], heavy_modules=result["heavy_modules"])
+
+        for size in args.sizes:
+            names, sequences = synthetic_library(size, args.l, args.seed)
+            guides = os.path.join(folder, f"library_{size}.csv")
+            library_writer(guides, names, sequences)
+            files = {}
+            for name, reads, compress in [("plain", args.n, False), ("gz", args.n, True), ("warmup", 1000, False)]:
+                files[name] = os.path.join(folder, f"reads_{size}_{name}.fastq" + (".gz" if compress else ""))
+                synthetic_reads(files[name], sequences, reads, args.er, args.nr, phred, args.st, args.rl, args.seed, compress)
+
+            case = dict(files, guides=guides, lenght=args.l, offset=args.st, phred=args.ph, seed=args.seed, folder=folder, samples=args.samples)
+            common = {"library":size, "error_rate":args.er, "n_rate":args.nr}
+
+            case["index_file"] = crispery.index_builder(guides, os.path.join(folder, f"library_{size}"), args.l, 1, "index")
+            for source in ["guides", "index_file"]:
+                result = run(startup_run, dict(case, source=source))
+                record(step="library", reads=0, seconds=result["library"], source=source, peak_rss_mb=result["peak_rss_mb"], **common)
+                record(step="first_count", reads=1000, seconds=result["first_count"], source=source, **common)
+            result = spawn_run(dict(case, workers=args.workers))
+            record(step="spawn", reads=0, seconds=result["seconds"], workers=args.workers, **common)
+
+            result = run(decompress_run, case)
+            record(step="decompress", reads=args.n, seconds=result["seconds"], mb=round(result["bytes"] / 1024 / 1024, 1), peak_rss_mb=result["peak_rss_mb"], **common)
+
+            for engine in args.engines:
+                for mismatch in args.mismatches:
+                    for cache in args.caches:
+                        for search in args.searches if engine == "fast" else ["scan"]:
+                            if mismatch == 0 and (cache != args.caches[0] or search != args.searches[0]): # no mismatch search, no cache
+                                continue
+                            result = run(counting_run, dict(case, engine=engine, mismatch=mismatch, cache=cache, search=search))
+                            run_fields = dict(common, engine=engine, search=search, mismatch=mismatch, cache_mb=cache, peak_rss_mb=result["peak_rss_mb"],
+                                              valid=result["perfect"] + result["imperfect"], imperfect=result["imperfect"])
+                            for step in ["index", "parse", "mismatch"]:
+                                if step in result and (mismatch != 0 or step == "parse"):
+                                    record(step=step, reads=result["reads"] if step != "index" else 0, seconds=result[step], **run_fields)
+                            record(step="count", reads=result["reads"], seconds=result["count"], cache_hit_rate=result.get("cache_hit_rate"), **run_fields)
+
+            result = run(compiling_run, case)
+            record(step="compiling", reads=0, seconds=result["seconds"], samples=args.samples, peak_rss_mb=result["peak_rss_mb"], **common)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return records
+
+def input_parser():
+
+    parser = argparse.ArgumentParser(description="Crispery benchmarks, on reproducible synthetic data")
+    parser.add_argument("--o",default=".",help="output directory, for the JSON results and the (temporary) synthetic files (default=current directory)")
+    parser.add_argument("--sizes",default="1500,20000,200000",help="comma separated library sizes (default=1500,20000,200000)")
+    parser.add_argument("--n",type=int,default=1000000,help="number of reads per file (default=1000000)")
+    parser.add_argument("--m",default="0,1,2,3",help="comma separated numbers of allowed mismatches (default=0,1,2,3)")
+    parser.add_argument("--r",default="0,64",help="comma separated mismatch cache sizes in MB, 0 is the RAM saving mode (default=0,64)")
+    parser.add_argument("--e",default="fast",help="comma separated counting engines, fast and/or python (default=fast)")
+    parser.add_argument("--mm",default="index",help="comma separated mismatch searches of the fast engine, index, scan and/or popcount (default=index)")
+    parser.add_argument("--l",type=int,default=20,help="guideRNA length (default=20)")
+    parser.add_argument("--rl",type=int,default=75,help="read length (default=75)")
+    parser.add_argument("--st",type=int,default=0,help="guideRNA start position in the reads (default=0)")
+    parser.add_argument("--er",type=float,default=0.002,help="substitution rate per guideRNA base (default=0.002)")
+    parser.add_argument("--nr",type=float,default=0.0005,help="N rate per guideRNA base (default=0.0005)")
+    parser.add_argument("--q",default="37:0.985,25:0.01,11:0.005",help="Phred score distribution, as score:weight pairs (default=37:0.985,25:0.01,11:0.005)")
+    parser.add_argument("--ph",type=int,default=30,help="Minimal Phred-score (default=30)")
+    parser.add_argument("--samples",type=int,default=96,help="number of samples in the compiling benchmark (default=96)")
+    parser.add_argument("--seed",type=int,default=0,help="random seed (default=0)")
+    parser.add_argument("--workers",type=int,default=max(1, multiprocessing.cpu_count() - 1),help="number of workers in the spawn benchmark (default=cpu cores minus one)")
+    parser.add_argument("--json",default="benchmark.json",help="name of the JSON results file, in the output directory (default=benchmark.json)")
+    args = parser.parse_args()
+
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+    args.mismatches = [int(mismatch) for mismatch in args.m.split(",")]
+    args.caches = [float(cache) for cache in args.r.split(",")]
+    args.engines = args.e.split(",")
+    args.searches = args.mm.split(",")
+    return args
+
+def main():
+    args = input_parser()
+    tempo = time()
+    records = benchmark(args)
+    report = {"crispery":crispery.__file__, "cpus":multiprocessing.cpu_count(), "ran_in_seconds":round(time() - tempo, 1),
+              "parameters":{name:value for name, value in vars(args).items() if name not in ["o", "json"]}, "results":records}
+    with open(os.path.join(args.o, args.json), "w") as output:
+        json.dump(report, output, indent=1)
+    print(f"\nResults saved into {os.path.join(args.o, args.json)}")
+
+if __name__ == "__main__":
+    main()
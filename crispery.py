@@ -2,32 +2,163 @@ import csv
 import glob
 import os
 import gzip
+import io
+import queue
 import shutil
+import sys
+import threading
+import zlib
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import multiprocessing 
 from platform import system
-from time import time
-import matplotlib.pyplot as plt
+from time import time, sleep
 import numpy as np
-from numba import njit
+from numba import njit, prange, set_num_threads
 import psutil
 import argparse
-#also needs tkinter (imported inside inputs_initializer())
+#also needs tkinter and matplotlib (imported inside inputs_initializer() and run_stats(), so that the workers never load them)
 
 #####################
 
-class SgRNA:
+class Library:
+    
+    """ The sgRNA library, kept as arrays instead of one object per sgRNA.
+    The sgRNAs are sorted by sequence, and each one is identified by its 
+    position (its ID) in the "names" and "sequences" arrays. The read counts
+    of a sample are a NumPy vector indexed by sgRNA ID (see "new_counts").
+    See the "guides loader" function """
+    
+    def __init__(self, names, sequences):
+        order = np.argsort(sequences, kind="stable")
+        self.names = np.array(names, dtype=str)[order]
+        self.sequences = np.array(sequences, dtype=str)[order]
+        self.hash = None
+        
+    def __len__(self):
+        return len(self.sequences)
+    
+    def ids(self):
+        
+        """ sequence to sgRNA ID hash, built on first use """
+        
+        if self.hash is None:
+            self.hash = {sequence:i for i, sequence in enumerate(self.sequences.tolist())}
+        return self.hash
+    
+    def new_counts(self):
+        return np.zeros(len(self), dtype=np.uint64)
+    
+    def arrays(self):
+        return {"names":self.names, "sequences":self.sequences}
+    
+    def fingerprint(self):
+        
+        """ hash of the sgRNA sequences (in ID order), identifying the library """
+        
+        import hashlib
+        return hashlib.sha1("\n".join(self.sequences.tolist()).encode()).hexdigest()
+    
+    @classmethod
+    def from_arrays(cls, arrays, prefix=""):
+        
+        """ rebuilds the library around (possibly memory-mapped) arrays, 
+        without sorting them again """
+        
+        library = cls.__new__(cls)
+        library.names, library.sequences, library.hash = arrays[prefix + "names"], arrays[prefix + "sequences"], None
+        return library
+
+def save_arrays(folder, arrays):
+    
+    """ saves each array into its own .npy file, so they can be memory-mapped 
+    back by "load_arrays". Arrays that are already memory-mapped from an index
+    file (see "index_reader") are not copied, only where they are is saved """
+    
+    import json
+    import mmap
+    
+    mapped = {}
+    for name, array in arrays.items():
+        if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap):
+            mapped[name] = {"path":array.filename, "dtype":array.dtype.str, "shape":list(array.shape), "offset":array.offset}
+        else:
+            np.save(os.path.join(folder, name + ".npy"), array)
+    with open(os.path.join(folder, "mapped.json"), "w") as output:
+        json.dump(mapped, output)
+
+def load_arrays(folder):
+    
+    """ memory-maps all the .npy arrays saved into the folder by "save_arrays".
+    The pages are shared by all the processes mapping the same file """
+    
+    import json
+    
+    arrays = {}
+    for path in glob.glob(os.path.join(folder, "*.npy")):
+        arrays[os.path.basename(path)[:-len(".npy")]] = np.load(path, mmap_mode="r")
+    if os.path.isfile(os.path.join(folder, "mapped.json")):
+        with open(os.path.join(folder, "mapped.json")) as f:
+            for name, array in json.load(f).items():
+                arrays[name] = np.memmap(array["path"], dtype=array["dtype"], mode="r", offset=array["offset"], shape=tuple(array["shape"]))
+    return arrays
+
+INDEX_EXTENSION = ".crispery"
+INDEX_MAGIC = b"CRISPERY"
+INDEX_FORMAT = 1
+PARTIAL_FILE = "partial" + INDEX_EXTENSION # the partial count file of a run, see "partial_writer"
+PARTIAL_FORMAT = 1
+
+def index_writer(path, arrays, meta):
+    
+    """ saves the library arrays into one binary index file: a magic string, 
+    the format version, the length of a JSON header with the "meta" data and 
+    the position of each array, and then the arrays themselves, each one 
+    aligned to 64 bytes so that "index_reader" can memory-map it in place """
     
-    """ Each sgRNA will have its own class instance, where the read counts will be kept.
-    Each sgRNA class is stored in a dictionary with the sequence as its key. 
-    See the "guides loader" function """    
+    import json
     
-    def __init__(self, name, sequence, counts):
-        self.name = name
-        self.sequence = sequence
-        self.counts = counts
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        layout[name] = {"dtype":array.dtype.str, "shape":list(array.shape), "offset":offset}
+        offset += (array.nbytes + 63) // 64 * 64
         
+    header = json.dumps({"meta":meta, "arrays":layout}).encode()
+    start = (len(INDEX_MAGIC) + 16 + len(header) + 63) // 64 * 64
+    with open(path + ".tmp", "wb") as output:
+        output.write(INDEX_MAGIC + np.array([INDEX_FORMAT, len(header)], dtype="<u8").tobytes() + header)
+        for name, array in arrays.items():
+            output.seek(start + layout[name]["offset"])
+            output.write(np.ascontiguousarray(array).tobytes())
+        output.truncate(start + offset)
+    os.replace(path + ".tmp", path)
+
+def index_reader(path):
+    
+    """ memory-maps the arrays of an index file written by "index_writer".
+    Returns them, and the "meta" data of the index """
+    
+    import json
+    
+    with open(path, "rb") as f:
+        magic = f.read(len(INDEX_MAGIC))
+        version, size = np.frombuffer(f.read(16), dtype="<u8").tolist() if magic == INDEX_MAGIC else (None, 0)
+        if version != INDEX_FORMAT:
+            input(f"\n{path} is not a sgRNA index file made by this version of Crispery, build it again with build-index.\nPress any key to exit")
+            raise Exception
+        header = json.loads(f.read(size))
         
+    start = (len(INDEX_MAGIC) + 16 + size + 63) // 64 * 64
+    arrays = {}
+    for name, array in header["arrays"].items():
+        shape = tuple(array["shape"])
+        if 0 in shape: # empty arrays can't be mapped
+            arrays[name] = np.zeros(shape, dtype=array["dtype"])
+        else:
+            arrays[name] = np.memmap(path, dtype=array["dtype"], mode="r", offset=start + array["offset"], shape=shape)
+    return arrays, header["meta"]
+
 def path_finder_seq(folder_path, extension, separator): 
     
     """ Finds the correct file paths from the indicated directories,
@@ -59,13 +190,243 @@ def unzip(file,write_path):
     """ loaded from "unpack" function.
     unzips the .gz files into the directory"""
     
-    f = gzip.open(file, 'rb')
-    
     if not os.path.isfile(write_path): 
         
-        with open(write_path, 'wb') as f_out:
-            shutil.copyfileobj(f, f_out)
+        with open(write_path + ".part", 'wb') as f_out:
+            for block in gzip_blocks(file):
+                f_out.write(block)
+        os.replace(write_path + ".part", write_path) # so that a file cut short is unzipped again
                 
+DECOMPRESS_THREADS = min(4, os.cpu_count() or 1) # per .gz file, only used on BGZF and multi-member files
+GZIP_MAGIC = b"\x1f\x8b\x08"
+
+def bgzf_offsets(mm):
+    
+    """ member offsets of a BGZF file (bgzip, samtools, ...), read from the 
+    block size that every member stores in its header. None if it is not BGZF """
+    
+    offsets, pos, size = [], 0, len(mm)
+    while pos < size:
+        if pos + 12 > size or mm[pos:pos+3] != GZIP_MAGIC or not mm[pos+3] & 4:
+            return None
+        xlen = int.from_bytes(mm[pos+10:pos+12], "little")
+        extra, bsize = pos + 12, None
+        while extra + 4 <= pos + 12 + xlen:
+            slen = int.from_bytes(mm[extra+2:extra+4], "little")
+            if mm[extra:extra+2] == b"BC" and slen == 2:
+                bsize = int.from_bytes(mm[extra+4:extra+6], "little")
+            extra += 4 + slen
+        if bsize is None:
+            return None
+        offsets.append(pos)
+        pos += bsize + 1
+    return offsets if pos == size else None
+
+def member_offsets(mm):
+    
+    """ candidate member offsets of a multi-member .gz file (concatenated .gz 
+    files, pigz --independent, ...). These are only guesses, the same bytes 
+    might show up inside the compressed data, so "inflate_members" checks them """
+    
+    offsets, pos = [], mm.find(GZIP_MAGIC)
+    while pos != -1:
+        if pos + 10 <= len(mm) and not mm[pos+3] & 0xE0: # reserved flag bits are always 0
+            offsets.append(pos)
+        pos = mm.find(GZIP_MAGIC, pos + 1)
+    return offsets
+
+def inflate_members(mm, start, end, limit):
+    
+    """ decompresses the gzip members found from "start" on, until one ends at
+    or past "end", and returns the data and the offset where the last one ended.
+    Returns None if "start" is not the beginning of a member (a wrong guess from
+    "member_offsets" fails the header or the CRC check), or if its first member
+    alone decompresses to more than "limit" bytes """
+    
+    out, total, pos, size = [], 0, start, len(mm)
+    done, boundary = 0, start
+    while pos < end:
+        inflater = zlib.decompressobj(31)
+        try:
+            while not inflater.eof:
+                if pos >= size:
+                    raise zlib.error("truncated member")
+                piece = mm[pos:pos+1024*1024]
+                data = inflater.decompress(piece)
+                pos += len(piece) - len(inflater.unused_data)
+                out.append(data)
+                total += len(data)
+                if total > limit:
+                    raise zlib.error("member too large")
+        except zlib.error:
+            if not done:
+                return None
+            break # the rest is for the serial reader to sort out
+        done, boundary = len(out), pos
+    return b"".join(out[:done]), boundary
+
+def serial_inflate(f, offset, block_size):
+    
+    """ plain gzip decompression, from "offset" until the end of the file """
+    
+    f.seek(offset)
+    with gzip.GzipFile(fileobj=f) as g:
+        while True:
+            block = g.read(block_size)
+            if not block:
+                break
+            yield block
+
+def gzip_blocks(path, block_size=4*1024*1024, threads=None):
+    
+    """ yields the decompressed content of a .gz file, in order. One gzip stream
+    can only be decoded serially, but BGZF and multi-member files are a series of 
+    independent members, so these are decompressed a few at a time on a thread 
+    pool (zlib releases the GIL). Single member files, and whatever the pool can 
+    not make sense of, go through the regular serial reader """
+    
+    import bisect
+    import mmap
+    
+    threads = threads or DECOMPRESS_THREADS
+    with open(path, 'rb') as f:
+        if threads < 2 or os.path.getsize(path) == 0:
+            yield from serial_inflate(f, 0, block_size)
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offsets = bgzf_offsets(mm)
+            if offsets is None:
+                offsets = member_offsets(mm)
+            if len(offsets) < 2 or offsets[0] != 0:
+                yield from serial_inflate(f, 0, block_size)
+                return
+            
+            starts = [0] # members are grouped into tasks of about a quarter "block_size" compressed
+            for offset in offsets:
+                if offset - starts[-1] >= block_size // 4:
+                    starts.append(offset)
+            ends = starts[1:] + [len(mm)]
+            limit = 8 * block_size
+            
+            pool = ThreadPoolExecutor(max_workers=threads)
+            pending, queued, pos = {}, 0, 0
+            try:
+                while pos < len(mm):
+                    while len(pending) < 2 * threads and queued < len(starts):
+                        if starts[queued] >= pos:
+                            pending[starts[queued]] = pool.submit(inflate_members, mm, starts[queued], ends[queued], limit)
+                        queued += 1
+                    if pos not in pending: # the previous task ran past a wrong guess
+                        end = ends[bisect.bisect_right(starts, pos) - 1]
+                        pending[pos] = pool.submit(inflate_members, mm, pos, end, limit)
+                    result = pending.pop(pos).result()
+                    if result is None:
+                        break
+                    block, pos = result
+                    for start in [start for start in pending if start < pos]:
+                        pending.pop(start).cancel()
+                    yield block
+            finally:
+                for task in pending.values():
+                    task.cancel()
+                pool.shutdown(wait=True)
+            if pos < len(mm) and (len(mm) - pos > block_size or mm[pos:].strip(b"\0")): # gzip allows zero padding at the end
+                yield from serial_inflate(f, pos, block_size)
+
+class DecompressReader(threading.Thread):
+    
+    """ Decompresses a .gz file on its own thread. The decompressed blocks are
+    handed over to the counter through a bounded queue, so that decompression 
+    and counting overlap, and nothing is ever written to disk """
+    
+    def __init__(self, path, block_size=4*1024*1024, buffered_blocks=8, threads=None):
+        super().__init__(daemon=True)
+        self.path = path
+        self.block_size = block_size
+        self.threads = threads
+        self.buffer = queue.Queue(maxsize=buffered_blocks)
+        self.stopped = threading.Event()
+        self.error = None
+        self.seconds = 0 # time spent decompressing, see "Metrics"
+        
+    def run(self):
+        try:
+            blocks = gzip_blocks(self.path, self.block_size, self.threads)
+            try:
+                while not self.stopped.is_set():
+                    tempo = time()
+                    block = next(blocks, None)
+                    self.seconds += time() - tempo
+                    if block is None:
+                        break
+                    self.put(block)
+            finally:
+                blocks.close()
+        except Exception as error:
+            self.error = error
+        finally:
+            self.put(None)
+            
+    def put(self, block):
+        while not self.stopped.is_set(): # the queue is bounded, so this waits for the counter to catch up
+            try:
+                self.buffer.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+            
+    def blocks(self):
+        
+        """ yields the decompressed blocks, in order, as they become available """
+        
+        self.start()
+        try:
+            while True:
+                block = self.buffer.get()
+                if block is None:
+                    break
+                yield block
+        finally:
+            self.stopped.set()
+            self.join()
+        if self.error is not None:
+            raise self.error
+
+class BlockStream(io.RawIOBase):
+    
+    """ file-like wrapper around an iterator of byte blocks, so that the 
+    decompressed stream can be read line by line like a regular file """
+    
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.leftover = memoryview(b"")
+        
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        while not self.leftover:
+            self.leftover = memoryview(next(self.blocks, b""))
+            if not self.leftover:
+                return 0
+        size = min(len(buffer), len(self.leftover))
+        buffer[:size] = self.leftover[:size]
+        self.leftover = self.leftover[size:]
+        return size
+    
+    def close(self):
+        self.blocks.close()
+        super().close()
+
+def open_reads(raw):
+    
+    """ opens a sequencing file for reading. .gz files are streamed through 
+    a "DecompressReader" thread instead of being unpacked to disk first """
+    
+    if raw.endswith(".gz"):
+        return io.TextIOWrapper(io.BufferedReader(BlockStream(DecompressReader(raw).blocks()), buffer_size=1024*1024))
+    return open(raw)
+
 def unpack(ordered,directory):
     
     """ gets the names from the fastq.gz files, and parses their new respective
@@ -84,10 +445,9 @@ def unpack(ordered,directory):
 
 def guides_loader(guides):
     
-    """ parses the sgRNA names and sequences from the indicated sgRNA .csv file.
-    Creates a dictionary using the sgRNA sequence as key, with an instace of the 
-    SgRNA class as respective value. If duplicated sgRNA sequences exist, 
-    this will be caught in here"""
+    """ parses the sgRNA names and sequences from the indicated sgRNA .csv file
+    into a "Library". If duplicated sgRNA sequences exist, this will be caught 
+    in here"""
     
     print("\nAligning sgRNAs")
     
@@ -104,14 +464,81 @@ def guides_loader(guides):
             sequence = sequence.replace(" ", "")
             
             if sequence not in sgrna:
-                sgrna[sequence] = SgRNA(line[0],sequence, 0)
+                sgrna[sequence] = line[0]
                 
             else:
-                print("\nWarning!!\n{} and {} share the same sequence. Only {} will be considered valid.\n".format(sgrna[sequence].name, line[0],sgrna[sequence].name))
+                print("\nWarning!!\n{} and {} share the same sequence. Only {} will be considered valid.\n".format(sgrna[sequence], line[0],sgrna[sequence]))
+
+    return Library(list(sgrna.values()), list(sgrna))
+
+def barcodes_loader(sheet, mismatch):
+    
+    """ parses the sample barcode sheet (a .csv file with the sample names and
+    their barcodes, like the sgRNA file), for demultiplexing. Dual barcodes 
+    can be written with a "+" in between. Returns the barcodes as a "Library"
+    (sorted by barcode, so the sample IDs are positions in its "names"), with
+    their packed keys and mismatch search index """
+    
+    if not os.path.isfile(sheet):
+        input("\nCheck the path to the barcode sheet.\nNo file found in the following path: {}\nPress any key to exit".format(sheet))
+        raise Exception
+    
+    samples = {}
+    with open(sheet) as current:
+        for line in current:
+            line = line.strip().split(",")
+            if len(line) < 2:
+                continue
+            barcode = line[1].upper().replace(" ", "").replace("+", "")
+            if barcode in samples:
+                input("\n{} and {} share the same barcode.\nPress any key to exit".format(samples[barcode], line[0]))
+                raise Exception
+            samples[barcode] = line[0]
+            
+    barcodes = Library(list(samples.values()), list(samples))
+    lenght = len(barcodes.sequences[0]) if len(barcodes) else 0
+    keys = packed_guides(barcodes, lenght)
+    if keys is None or lenght == 0:
+        input("\nThe barcodes must all have the same length, of at most 31bp, and be made of A, C, G and T only.\nPress any key to exit")
+        raise Exception
+    
+    print(f"\nDemultiplexing {len(barcodes)} samples, with {lenght}bp barcodes")
+    return {"names":barcodes.names.tolist(), "keys":keys, "lenght":lenght, "mismatch":mismatch, 
+            "index":mismatch_index(keys, lenght, mismatch) if mismatch != 0 else None}
+
+def barcode_samples(barcodes, demux):
+    
+    """ the sample ID of each packed barcode: an exact match, or the only 
+    barcode within the allowed mismatches. Otherwise AMBIGUOUS or NO_MATCH, 
+    like the sgRNAs """
+    
+    keys = demux["keys"]
+    found = np.minimum(np.searchsorted(keys, barcodes), len(keys) - 1)
+    exact = (keys[found] == barcodes) & (barcodes >= 0)
+    samples = np.where(exact, found, NO_MATCH)
+    if demux["index"] is not None:
+        close = np.flatnonzero(~exact & (barcodes >= 0))
+        samples[close] = index_lookup(barcodes[close], demux["index"], demux["mismatch"])
+    return samples
 
-    return sgrna
+def binary_converter(library):
+    from numba import types
+    from numba.typed import Dict
+    
+    """ Parses the input sgRNAs into binary dictionaries. Converts all DNA
+    sequences to their respective binary array forms. This gives some computing
+    speed advantages with mismatches."""
+    
+    container = Dict.empty(key_type=types.unicode_type,
+                           value_type=types.int8[:])
 
-def reads_counter(raw, quality_set, start, lenght, sgrna, mismatch, ram):
+    for sequence in library.sequences.tolist():
+        byte_list = bytearray(sequence,'utf8')
+        if sequence not in container:
+            container[sequence] = np.array((byte_list), dtype=np.int8)
+    return container
+
+def reads_counter(raw, quality_set, start, lenght, library, mismatch, cache_size, metrics=None, progress=None, store=None):
     
     """ Reads the fastq file on the fly to avoid RAM issues. 
     Each read is assumed to be composed of 4 lines, with the sequense being 
@@ -120,39 +547,31 @@ def reads_counter(raw, quality_set, start, lenght, sgrna, mismatch, ram):
     The quality of the obtained trimmed read is crossed against the indicated
     Phred score for quality control.
     If the read has a perfect match with a sgRNA, the respective sgRNA gets a 
-    read increase of 1 (done by calling .counts from the respective sgRNA class 
-    from the sgRNA class dictionary).
+    read increase of 1 (its ID is found in the library sequence hash, and 
+    used to index the counts vector).
     If the read doesnt have a perfect match, it is sent for mismatch comparison
     via the "imperfect_alignment" function.
+    The read counters, the time spent in the mismatch search, and the 
+    "Profile" of the reads go into "metrics" (see "Metrics")
     """
     
-    def binary_converter(sgrna):
-        from numba import types
-        from numba.typed import Dict
-        
-        """ Parses the input sgRNAs into binary dictionaries. Converts all DNA
-        sequences to their respective binary array forms. This gives some computing
-        speed advantages with mismatches."""
-        
-        container = Dict.empty(key_type=types.unicode_type,
-                               value_type=types.int8[:])
-
-        for sequence in sgrna:
-            byte_list = bytearray(sequence,'utf8')
-            if sequence not in container:
-                container[sequence] = np.array((byte_list), dtype=np.int8)
-        return container
-
     if mismatch != 0:
-        binary_sgrna = binary_converter(sgrna)
-    
+        binary_sgrna = binary_converter(library)
+        cache = ResolutionCache(cache_size, lenght, library, store)
+    
+    metrics = metrics if metrics is not None else Metrics()
+    metrics.profile = metrics.profile or Profile(start, lenght)
+    profiled, span = ([], []), metrics.profile.span
+    counters = metrics.counts
+    started, searching = time(), metrics.seconds["mismatch"]
+    ids = library.ids()
+    counts = library.new_counts()
     n = set("N")
     reading = []
     perfect_counter, imperfect_counter, reads = 0,0,0
     guide_len = start + lenght
-    failed_reads = set()
     
-    with open(raw) as current:
+    with open_reads(raw) as current:
         for line in current:
             reading.append(line[:-1])
             
@@ -160,33 +579,57 @@ def reads_counter(raw, quality_set, start, lenght, sgrna, mismatch, ram):
                 
                 seq = reading[1][start:guide_len].upper()
                 quality = reading[3][start:guide_len]
+                profiled[0].append(reading[1][span])
+                profiled[1].append(reading[3][span])
                 
                 reading = []
                 reads += 1
+                if reads % 100000 == 0:
+                    progress_update(progress, 100000)
+                    metrics.profile.add(*profiled)
+                    profiled = ([], [])
+                    if mismatch != 0:
+                        cache.relieve()
                 
                 if (len(quality_set.intersection(quality)) == 0) & \
                     (len(n.intersection(seq)) == 0):
                         
-                    if seq in sgrna:
-                        sgrna[seq].counts += 1
+                    if seq in ids:
+                        counts[ids[seq]] += 1
                         perfect_counter += 1
                     
                     elif mismatch != 0:
-                        byte_list = bytearray(seq,'utf8')
-                        read=np.array((byte_list), dtype=np.int8)
+                        tempo = time()
+                        finder = imperfect_alignment(seq,binary_sgrna,mismatch,cache)
+                        if finder >= 0:
+                            counts[finder] += 1
+                            imperfect_counter += 1
+                        counters["ambiguous"] += int(finder == AMBIGUOUS)
+                        counters["no_match"] += int(finder == NO_MATCH)
+                        metrics.add("mismatch", tempo)
                         
-                        if not ram: #keeps track of reads that are already known to not align with confidence
-                            if seq not in failed_reads:
-                                sgrna,imperfect_counter,failed_reads = imperfect_alignment(read,seq,binary_sgrna,mismatch,imperfect_counter,sgrna,failed_reads,ram)
-                        else:
-                            sgrna,imperfect_counter,failed_reads = imperfect_alignment(read,seq,binary_sgrna,mismatch,imperfect_counter,sgrna,failed_reads,ram)
-                            
-    # clears the cache RAM from each individual file/process
-    failed_reads = set()
-    
-    return reads, perfect_counter, imperfect_counter, sgrna
+                    else:
+                        counters["no_match"] += 1
+                        
+                elif len(quality_set.intersection(quality)) != 0:
+                    counters["phred_fail"] += 1
+                else:
+                    counters["n_fail"] += 1
+    
+    progress_update(progress, reads % 100000)
+    metrics.profile.add(*profiled)
+    counters["reads"] += reads
+    counters["exact"] += perfect_counter
+    counters["mismatch"] += imperfect_counter
+    if mismatch != 0:
+        counters["cache_hits"] += cache.hits
+        counters["store_hits"] += cache.disk_hits
+        counters["cache_lookups"] += cache.lookups
+    metrics.seconds["parse"] += time() - started - (metrics.seconds["mismatch"] - searching)
+    
+    return reads, perfect_counter, imperfect_counter, counts
   
-@njit
+@njit(cache=True)
 def binary_subtract(array1,array2,mismatch):
     miss=0
     for arr1,arr2 in zip(array1,array2):
@@ -196,7 +639,7 @@ def binary_subtract(array1,array2,mismatch):
             return 0
     return 1
 
-@njit
+@njit(cache=True)
 def sgrna_all_vs_all(binary_sgrna,read,mismatch):
     
     """ Runs the loop of the read vs all sgRNA comparison.
@@ -209,266 +652,1877 @@ def sgrna_all_vs_all(binary_sgrna,read,mismatch):
             found+=1
             found_guide = guide
             if found>=2:
-                return
+                return "" # more than one sgRNA, see "scan_outcome"
     if found==1:
         return found_guide
     return
 
-def imperfect_alignment(read,seq,binary_sgrna, mismatch, counter, sgrna,failed_reads,ram):
+def scan_outcome(finder, ids):
+    
+    """ sgRNA ID, AMBIGUOUS or NO_MATCH, from what "sgrna_all_vs_all" returned """
+    
+    if finder is None:
+        return NO_MATCH
+    return AMBIGUOUS if finder == "" else ids[finder]
+
+def imperfect_alignment(seq,binary_sgrna, mismatch, cache):
     
     """ for the inputed read sequence, this compares if there is a sgRNA 
     with a sequence that is similar to it, to the indicated mismatch degree
-    if the read can be atributed to more than 1 sgRNA, the read is discarded.
-    If all conditions are meet, the read goes into the respective sgRNA count 
-    score"""
-    
-    finder = sgrna_all_vs_all(binary_sgrna, read, mismatch)
+    if the read can be atributed to more than 1 sgRNA, the read is discarded
+    (AMBIGUOUS is returned, NO_MATCH when no sgRNA is that similar to it). 
+    If all conditions are meet, the sgRNA ID is 
+    returned. The outcome is kept in the "ResolutionCache", so repeated reads 
+    are only compared once"""
+    
+    finder = cache.get(seq)
+    
+    if finder == CACHE_MISS:
+        read = np.array(bytearray(seq,'utf8'), dtype=np.int8)
+        finder = sgrna_all_vs_all(binary_sgrna, read, mismatch)
+        finder = scan_outcome(finder, cache.ids)
+        cache.put(seq, finder)
+        
+    return finder
 
-    if finder is not None:
-        sgrna[finder].counts += 1
-        counter += 1
-    elif not ram:
-        failed_reads.add(seq)
+CACHE_WAYS = 8 # entries per set of the "ResolutionCache"
+MEMORY_PRESSURE = 95 # system memory use (%) above which the caches shrink
+CACHE_MISS = -9
+
+class ResolutionCache:
+    
+    """ Bounded cache of the mismatch search outcome of the reads without a 
+    perfect match, both when they were assigned to a sgRNA and when they were
+    discarded (AMBIGUOUS, NO_MATCH). The reads are kept as 2 bit packed integers (see 
+    "pack_sequence") in a set associative table, with CLOCK eviction within 
+    each set, so the cache never takes more than "size" MB. 
+    A size of 0 turns the cache off (RAM saving mode). Under memory pressure
+    the cache shrinks (see "relieve"). 
+    When there is a "ResolutionStore" ("disk"), the reads missing from the 
+    cache are looked up in it, and every new outcome is added to it """
+    
+    def __init__(self, size, lenght, library, disk=None):
+        self.lenght = lenght
+        self.ids = library.ids()
+        self.hits, self.lookups, self.disk_hits = 0, 0, 0
+        self.disk = disk if lenght <= 31 else None
+        self.allocate(size if lenght <= 31 else 0)
+        
+    def allocate(self, size):
+        sets = int(float(size) * 1024 * 1024) // (13 * CACHE_WAYS) # 8 bytes key + 4 bytes value + 1 reference bit
+        self.size = size if sets else 0
+        self.keys = np.zeros(sets * CACHE_WAYS, dtype=np.int64)
+        self.values = np.zeros(sets * CACHE_WAYS, dtype=np.int32) # sgRNA index + 3, 0 for empty entries
+        self.refs = np.zeros(sets * CACHE_WAYS, dtype=np.uint8)
+        self.hands = np.zeros(sets, dtype=np.uint8)
+        
+    def relieve(self, limit=MEMORY_PRESSURE):
+        
+        """ halves the cache when the system memory use is above "limit" 
+        percent. The entries that still fit are kept """
+        
+        if (not self.size) or (psutil.virtual_memory().percent < limit):
+            return
+        used = self.values != 0
+        keys, found = self.keys[used], self.values[used].astype(np.int64) - 3
+        self.allocate(self.size / 2 if self.size > 1 else 0)
+        self.store(keys, found)
+        print(f"\nHigh RAM use detected, the mismatch cache was reduced to {round(self.size, 1)}MB\n")
+        
+    def lookup(self, queries):
+        
+        """ sgRNA index (or AMBIGUOUS, NO_MATCH) for each of the packed "queries", 
+        CACHE_MISS for those not in the cache """
+        
+        found = np.full(len(queries), CACHE_MISS, dtype=np.int64)
+        if len(self.keys):
+            self.hits += cache_lookup(queries, self.keys, self.values, self.refs, found)
+        self.lookups += len(queries)
+        
+        if self.disk is not None:
+            missing = np.flatnonzero(found == CACHE_MISS)
+            found[missing] = self.disk.lookup(queries[missing])
+            stored = missing[found[missing] != CACHE_MISS]
+            self.disk_hits += len(stored)
+            if len(self.keys) and len(stored): # brought into memory
+                cache_store(queries[stored], found[stored], self.keys, self.values, self.refs, self.hands)
+        return found
+    
+    def store(self, queries, found):
+        if len(self.keys):
+            cache_store(queries, found, self.keys, self.values, self.refs, self.hands)
+        if self.disk is not None:
+            self.disk.store(queries, found)
+    
+    def key(self, seq):
+        if (len(seq) != self.lenght) or ((not len(self.keys)) and (self.disk is None)) or (set(seq) - set("ACGT")):
+            return None
+        return np.array([pack_sequence(seq)], dtype=np.int64)
+            
+    def get(self, seq):
         
-    return sgrna, counter, failed_reads
+        """ same as "lookup", for a single read sequence """
+        
+        key = self.key(seq)
+        if key is None:
+            return CACHE_MISS
+        return self.lookup(key)[0]
+    
+    def put(self, seq, finder):
+        key = self.key(seq)
+        if key is not None:
+            self.store(key, np.array([finder], dtype=np.int64))
 
-def aligner(raw, guides, out, quality_set,mismatch,i,o,sgrna,version,separator, start, lenght, ram):
+@njit(cache=True)
+def cache_set(key, sets):
+    return np.int64((np.uint64(key) * np.uint64(0x9E3779B97F4A7C15) >> np.uint64(32)) % np.uint64(sets))
 
-    """ Runs the main read to sgRNA associating function "reads_counter".
-    Creates some visual prompts to alert the user that the samples are being
-    processed. Some on the fly quality control is possible (such as making sure 
-    the total number of samples is correct, getting an estimate of the total
-    number of reads per sample, and checking total running time"""
-    
-    ram_lock()
-    tempo = time()
-       
-    print(f"Processing file {i+1} out of {o}")
+@njit(cache=True)
+def cache_lookup(queries, keys, values, refs, found):
+    sets = keys.shape[0] // CACHE_WAYS
+    hits = 0
+    for i in range(queries.shape[0]):
+        first = cache_set(queries[i], sets) * CACHE_WAYS
+        for entry in range(first, first + CACHE_WAYS):
+            if (values[entry] != 0) and (keys[entry] == queries[i]):
+                found[i] = values[entry] - 3
+                refs[entry] = 1
+                hits += 1
+                break
+    return hits
 
-    reads, perfect_counter, imperfect_counter, sgrna = reads_counter(raw, quality_set, start, lenght, sgrna, mismatch, ram)
+@njit(cache=True)
+def cache_store(queries, found, keys, values, refs, hands):
+    sets = keys.shape[0] // CACHE_WAYS
+    for i in range(queries.shape[0]):
+        cache = cache_set(queries[i], sets)
+        while True: # the CLOCK hand skips (and clears) recently used entries
+            entry = cache * CACHE_WAYS + hands[cache]
+            hands[cache] = (hands[cache] + 1) % CACHE_WAYS
+            if (values[entry] == 0) or (refs[entry] == 0):
+                break
+            refs[entry] = 0
+        keys[entry] = queries[i]
+        values[entry] = found[i] + 3
+        refs[entry] = 0
 
-    master_list = [["#sgRNA"] + ["Reads"]]
-    for guide in sgrna:
-        master_list.append([sgrna[guide].name] + [sgrna[guide].counts])
+STORE_SIZE = 256 # MB, of each "ResolutionStore" file
 
-    tempo = time() - tempo
-    if tempo > 60:
-        timing = str(round(tempo / 60, 2)) + " minutes"   
-    else:
-        timing = str(round(tempo, 2)) + " seconds"
+class ResolutionStore:
+    
+    """ On-disk version of the "ResolutionCache", kept between runs. All the 
+    samples of a screen share the same sgRNA library, so the same erroneous 
+    reads show up in every file: their mismatch search outcome is kept in a 
+    memory-mapped file, read and added to by all the workers at once, and
+    later runs with the same library start from it. There is one file per 
+    library, sgRNA length and mismatch setting (see "store_path").
+    Each entry is a pair of int64: the packed read, and its outcome (+3) 
+    with a hash of the read in the top 32 bits. Entries are written without
+    locks, so a half written entry fails the hash check, and is just a miss """
+    
+    def __init__(self, path, size=STORE_SIZE):
+        self.path = path
+        sets = int(size * 1024 * 1024) // (16 * CACHE_WAYS)
+        if (not os.path.isfile(path)) or (os.path.getsize(path) != sets * CACHE_WAYS * 16):
+            with open(path, "wb") as f: # sparse file of empty entries
+                f.truncate(sets * CACHE_WAYS * 16)
+        self.table = np.memmap(path, dtype=np.int64, mode="r+", shape=(sets * CACHE_WAYS, 2))
+        
+    def lookup(self, queries):
+        found = np.full(len(queries), CACHE_MISS, dtype=np.int64)
+        store_lookup(queries, self.table, found)
+        return found
+    
+    def store(self, queries, found):
+        store_insert(queries, found, self.table)
 
-    name = raw[-raw[::-1].find(separator):-len(".fastq")]
-    stats_condition = f"#script ran in {timing} for file {name}. {perfect_counter+imperfect_counter} reads out of {reads} were considered valid. {perfect_counter} were perfectly aligned. {imperfect_counter} were aligned with mismatch"
+def store_path(folder, library, lenght, mismatch):
     
-    master_list.sort(key = lambda master_list: master_list[0]) #alphabetical sorting
-    master_list.insert(0,[stats_condition])
-    csvfile = out[:-out[::-1].find(".")-1] + "_reads.csv"
-    csv_writer(csvfile, master_list)
+    """ the "ResolutionStore" file of a library, in "folder" """
     
-    print(stats_condition[1:]) # quality control
+    import hashlib
+    
+    fingerprint = hashlib.sha1(f"{library.fingerprint()},{lenght},{mismatch}".encode()).hexdigest()[:20]
+    return os.path.join(folder, f"resolutions_{fingerprint}.bin")
 
-def csv_writer(path, outfile):
+def open_store(folder, library, lenght, mismatch):
     
-    """ writes the indicated outfile into an .csv file in the directory"""
-        
-    with open(path, "w", newline='') as output: #writes the output
-        writer = csv.writer(output)
-        writer.writerows(outfile)
+    """ creates (if needed) the "ResolutionStore" file of the library in 
+    "folder", before the workers open it. Returns its path, or None when 
+    there is no store folder, or no mismatch search """
+    
+    if (folder is None) or (mismatch == 0):
+        return None
+    os.makedirs(folder, exist_ok=True)
+    path = store_path(folder, library, lenght, mismatch)
+    print(f"\n{'Reusing' if os.path.isfile(path) else 'Creating'} the mismatch search store {path}")
+    ResolutionStore(path)
+    return path
 
-def inputs_handler(separator):
+@njit(cache=True)
+def store_check(key):
+    return np.int64((np.uint64(key) * np.uint64(0xC2B2AE3D27D4EB4F)) >> np.uint64(33))
+
+@njit(cache=True)
+def store_lookup(queries, table, found):
+    sets = table.shape[0] // CACHE_WAYS
+    for i in range(queries.shape[0]):
+        first = cache_set(queries[i], sets) * CACHE_WAYS
+        check = store_check(queries[i])
+        for entry in range(first, first + CACHE_WAYS):
+            value = table[entry, 1]
+            if (table[entry, 0] == queries[i]) and (value != 0) and ((value >> 32) == check):
+                found[i] = (value & 0xFFFFFFFF) - 3
+                break
+
+@njit(cache=True)
+def store_insert(queries, found, table):
+    sets = table.shape[0] // CACHE_WAYS
+    for i in range(queries.shape[0]):
+        first = cache_set(queries[i], sets) * CACHE_WAYS
+        check = store_check(queries[i])
+        entry = first + check % CACHE_WAYS # replaced when the set is full
+        for way in range(first, first + CACHE_WAYS):
+            if (table[way, 1] == 0) or (table[way, 0] == queries[i]):
+                entry = way
+                break
+        table[entry, 1] = 0
+        table[entry, 0] = queries[i]
+        table[entry, 1] = (check << 32) | (found[i] + 3)
+
+# status codes written by "fastq_kernel" for the reads without a perfect match
+PHRED_FAIL, N_FAIL, UNMATCHED, OTHER_BASES, SHORT_READ, NO_LOCATION = -1, -2, -3, -4, -5, -6
+
+def base_codes():
     
-    """ assertains the correct parsing of the input parameters"""
+    """ lookup table from the raw sequence bytes to their 2 bit codes 
+    (A=0, C=1, G=2, T=3). N is flagged with 4, and any other character with 5 """
     
-    parameters=inputs_initializer(separator)
+    codes = np.full(256, 5, dtype=np.int8)
+    for code, bases in enumerate(["Aa", "Cc", "Gg", "Tt", "Nn"]):
+        for base in bases:
+            codes[ord(base)] = code
+    return codes
+
+def quality_table(quality_set):
     
-    if len(parameters) != 9:
-        input("Please confirm that all the input boxes are filled. Some parameters are missing.\nPress any key to exit")
-        raise Exception
-        
-    try:
-        int(parameters["start"])
-        int(parameters["length"])
-        int(parameters["miss"])
-        int(parameters["phred"])
-    except Exception:
-        input("\nOnly numeric values are accepted in the folowing fields:\nsgRNA read starting place;\nsgRNA length;\nmismatch;\nPhred score.\n\nPlease try again. Press any key to exit")
-        raise Exception    
+    """ lookup table from the raw quality bytes to whether they fail the 
+    Phred-score cutoff. Built from the same "quality_set" used by "reads_counter" """
     
-    # parsing the RAM saving choice as a bolean
-    if parameters['ram'] == "n":
-        parameters['ram'] = False
-    else:
-        parameters['ram'] = True
+    table = np.zeros(256, dtype=np.bool_)
+    for score in quality_set:
+        table[ord(score)] = True
+    return table
 
-    return parameters['seq_files'],parameters['sgrna'],parameters['out'],parameters['start'],\
-    parameters['length'],parameters['miss'],parameters['phred'],parameters['ram'],\
-    parameters['fastq_extent']
+def phred_filter(phred):
+    
+    """ the quality characters below the minimal Phred score """
+    
+    quality_list = '!"#$%&' + "'()*+,-/0123456789:;<=>?@ABCDEFGHI" #Phred score
+    return set(quality_list[:int(phred)-1])
 
-def inputs_initializer(separator):
+def pack_sequence(sequence):
     
-    """ Handles the graphical interface, and all the parameter inputs"""
+    """ packs an ACGT sequence into an integer, 2 bits per base """
     
-    from tkinter import Entry,LabelFrame,Button,Label,Tk,filedialog,StringVar,OptionMenu
+    key = 0
+    for base in sequence:
+        key = (key << 2) | "ACGT".index(base)
+    return key
+
+def packed_guides(library, lenght):
     
-    def restart():
-        root.destroy()
-        inputs_initializer()
-        
-    def submit():
-        for arg in temporary:
-            parameters[arg] = temporary[arg].get()
-        root.destroy()
+    """ packs the sgRNA sequences into an array of integers for the 
+    "fastq_kernel" hash lookup. The library is sorted by sequence, so the 
+    packed keys come out sorted as well, each one at its sgRNA ID. 
+    Returns None when the library can't be packed (sequences other than ACGT,
+    sequences with a different length than the indicated one, or guides 
+    longer than 31bp), in which case the python "reads_counter" is used instead """
     
-    def directory(column,row,parameter,frame):
-        filename = filedialog.askdirectory(initialdir =  separator, title = "Select a folder")
-        filing_parser(column,row,filename,parameter,frame)
-        
-    def file(column,row,parameter,frame):
-        filename = filedialog.askopenfilename(initialdir = separator, title = "Select a file", filetypes = \
-            (("CSV files","*.csv"),("all files","*.*")) )
-        filing_parser(column,row,filename,parameter,frame)
+    if lenght > 31:
+        return None
     
-    def filing_parser(column,row,filename,parameter,frame):
-        place = Entry(frame,borderwidth=5,width=50)
-        place.grid(row=row,column=column+1)
-        place.insert(0, filename)
-        parameters[parameter] = filename
+    keys = []
+    for sequence in library.sequences.tolist():
+        if (len(sequence) != lenght) or (set(sequence) - set("ACGT")):
+            return None
+        keys.append(pack_sequence(sequence))
+    
+    return np.array(keys, dtype=np.int64)
 
-    def browsing(keyword,inputs):
-        title1,title2,row,column,function=inputs
-        frame=LabelFrame(root,text=title1,padx=5,pady=5)
-        frame.grid(row=row,column=column, columnspan=2)
-        button = Button(frame, text = title2,command = lambda: function(column,row,keyword,frame))
-        button.grid(column = column, row = row)
-        button_place = Entry(frame,borderwidth=5,width=50)
-        button_place.grid(row=row,column=column+1)
-        button_place.insert(0, "Use the Browse button to navigate")
-        
-    def write_menu(keyword,inputs):
-        title,row,column,default=inputs
-        start = Entry(root,width=25,borderwidth=5)
-        start.grid(row=row,column=column+1,padx=20,pady=5)
-        start.insert(0, default)
-        placeholder(row,column,title,10,1)
-        temporary[keyword]=start
-        
-    def dropdown():
-        file_ext = StringVar()
-        file_ext.set(".fastq.gz")
-        placeholder(4,0,"Sequencing file extension",20,1)
-        drop = OptionMenu(root, file_ext, ".fastq.gz", ".fastq")
-        drop.grid(column = 1,row = 4)
-        temporary["fastq_extent"]=file_ext
-        
-    def button_click(row, column, title, function):
-        button_ok = Button(root,text=title,padx=12,pady=5, width=15,command=function)
-        button_ok.grid(row=row, column=column,columnspan=1)
+AMBIGUOUS = -1 # mismatch search outcome for reads that are close to more than one sgRNA
+NO_MATCH = -2 # mismatch search outcome for reads that aren't close to any sgRNA
+NEIGHBORHOOD_LIMIT = 10_000_000 # max number of entries in the precomputed mismatch neighborhood
+
+def mismatch_masks(lenght, mismatch):
+    
+    """ XOR masks turning a packed sequence into all its variants with 1 up to
+    "mismatch" substitutions """
+    
+    from itertools import combinations, product
+    
+    masks = []
+    for miss in range(1, mismatch + 1):
+        for positions in combinations(range(lenght), miss):
+            for changes in product((1, 2, 3), repeat=miss):
+                mask = 0
+                for position, change in zip(positions, changes):
+                    mask |= change << (2 * (lenght - 1 - position))
+                masks.append(mask)
+    return np.array(masks, dtype=np.int64)
+
+def neighborhood_size(lenght, mismatch):
+    from math import comb
+    return sum(comb(lenght, miss) * 3**miss for miss in range(1, mismatch + 1))
+
+def mismatch_index(keys, lenght, mismatch):
+    
+    """ Builds the mismatch search index once, for all the samples.
+    When small enough, every variant of every sgRNA with up to "mismatch" 
+    substitutions is precomputed into a sorted array, mapping straight to its
+    sgRNA, or to AMBIGUOUS when more than one sgRNA is that close to it.
+    Otherwise (large libraries or many mismatches) a pigeonhole seed index is
+    built: the sgRNA is split into mismatch+1 segments, and at least one of 
+    them must match exactly for a read to be within "mismatch" of a sgRNA.
+    Either way, the same "unique match or discard" rule of "sgrna_all_vs_all"
+    is applied """
+    
+    if len(keys) * neighborhood_size(lenght, mismatch) <= NEIGHBORHOOD_LIMIT:
+        masks = mismatch_masks(lenght, mismatch)
+        variants = (keys[:, None] ^ masks[None, :]).ravel()
+        owners = np.repeat(np.arange(len(keys), dtype=np.int64), len(masks))
+        order = np.argsort(variants, kind="stable")
+        variants, owners = variants[order], owners[order]
         
-    def placeholder(row, column,title,padx,pady):
-        placeholder = Label(root, text=title)
-        placeholder.grid(row=row,column=column,padx=padx,pady=pady)
-        return placeholder
+        # each sgRNA has each of its variants only once, so repeated variants belong to several sgRNAs
+        variants, first, repeats = np.unique(variants, return_index=True, return_counts=True)
+        values = np.where(repeats == 1, owners[first], AMBIGUOUS)
+        return "neighborhood", variants, values
+    
+    bounds = np.linspace(0, lenght, mismatch + 2).astype(np.int64)
+    shifts = 2 * (lenght - bounds[1:])
+    widths = 2 * (bounds[1:] - bounds[:-1])
+    seed_keys, seed_guides, offsets = [], [], [0]
+    for shift, width in zip(shifts, widths):
+        seeds = (keys >> shift) & ((1 << int(width)) - 1)
+        order = np.argsort(seeds, kind="stable")
+        seed_keys.append(seeds[order])
+        seed_guides.append(order.astype(np.int64))
+        offsets.append(offsets[-1] + len(keys))
         
-    root = Tk()
-    root.title("Crispery Input Parameters Window")
-    root.minsize(400, 475)
-    parameters,temporary = {},{}  
-
-    browsing_inputs = {"seq_files":["Path to the .fastq(.gz) files folder","Browse",1,0,directory],
-                       "sgrna":["Path to the sgRNA .csv file","Browse",2,0,file],
-                       "out":["Path to the output folder","Browse",3,0,directory]}
+    return "seeds", keys, shifts, widths, np.concatenate(seed_keys), \
+        np.concatenate(seed_guides), np.array(offsets, dtype=np.int64)
 
-    default_inputs = {"start":["sgRNA start position in the read",5,0,0],
-                      "length":["sgRNA length",6,0,20],
-                      "miss":["Allowed mismatches",7,0,1],
-                      "phred":["Minimal sgRNA Phred-score",8,0,30],
-                      "ram":["RAM saving mode [y/n]",9,0,"n"]}
-    
-    # Generating the file/folder browsing buttons
-    for arg in browsing_inputs:
-        browsing(arg,browsing_inputs[arg])
-    
-    # Generating the input parameter buttons
-    for arg in default_inputs:
-        write_menu(arg,default_inputs[arg])
-    
-    dropdown()
-    placeholder(0,1,"",0,0)
-    placeholder(10,0,"",0,0)
-    button_click(11, 0, "OK", submit)
-    button_click(11, 1, "Reset", restart)
+@njit(cache=True)
+def packed_mismatches(key1, key2, mismatch):
+    
+    """ number of different bases between two packed sequences, 
+    counting stops past "mismatch" """
+    
+    diff = key1 ^ key2
+    diff = (diff | (diff >> 1)) & 0x5555555555555555
+    miss = 0
+    while diff != 0:
+        diff &= diff - 1
+        miss += 1
+        if miss > mismatch:
+            break
+    return miss
 
-    root.mainloop()
+@njit(cache=True)
+def neighborhood_lookup(queries, variants, values):
+    found = np.full(queries.shape[0], NO_MATCH, dtype=np.int64)
+    for i in range(queries.shape[0]):
+        index = np.searchsorted(variants, queries[i])
+        if (index < variants.shape[0]) and (variants[index] == queries[i]):
+            found[i] = values[index]
+    return found
 
-    return parameters
+@njit(cache=True)
+def seeds_lookup(queries, keys, shifts, widths, seed_keys, seed_guides, offsets, mismatch):
+    found = np.full(queries.shape[0], NO_MATCH, dtype=np.int64)
+    for i in range(queries.shape[0]):
+        query, guide = queries[i], NO_MATCH
+        for segment in range(shifts.shape[0]):
+            seed = (query >> shifts[segment]) & ((np.int64(1) << widths[segment]) - 1)
+            low, high = offsets[segment], offsets[segment + 1]
+            first = low + np.searchsorted(seed_keys[low:high], seed, side="left")
+            last = low + np.searchsorted(seed_keys[low:high], seed, side="right")
+            for candidate in seed_guides[first:last]:
+                if (candidate != guide) and (packed_mismatches(keys[candidate], query, mismatch) <= mismatch):
+                    if guide != NO_MATCH: # a second sgRNA is as close, the read is discarded
+                        guide = AMBIGUOUS
+                        break
+                    guide = candidate
+            if guide == AMBIGUOUS:
+                break
+        found[i] = guide
+    return found
 
-def initializer(cmd):
-    
-    """ Handles the program initialization process.
-    Makes sure the path separators, and the input parser function is correct
-    for the used OS.
-    Creates the output diretory and handles some parameter parsing"""
- 
-    version = "1.5"
+def index_lookup(queries, index, mismatch):
     
-    print("\nVersion: {}".format(version))
+    """ resolves an array of packed reads without perfect matches against the 
+    "mismatch_index". Returns the sgRNA index for each, AMBIGUOUS or NO_MATCH """
     
-    if system() == 'Windows':
-        separator = "\\"
-    else:
-        separator = "/"
+    if index[0] == "neighborhood":
+        return neighborhood_lookup(queries, index[1], index[2])
+    if index[0] == "popcount":
+        return popcount_lookup(queries, index[1].view(np.uint64), mismatch)
+    return seeds_lookup(queries, *index[1:], mismatch)
 
-    if cmd is None:
-        folder_path, guides, out, start, lenght, mismatch, phred, ram, extension = inputs_handler(separator)
-    else:
-        folder_path, guides, out, extension, mismatch, phred, start, lenght, ram = cmd
+@njit(cache=True)
+def base_differences(diff):
     
-    extension = f'*{extension}'
+    """ number of different bases in the XOR of two packed sequences, with a 
+    branchless popcount of its 2 bit pairs """
     
-    quality_list = '!"#$%&' + "'()*+,-/0123456789:;<=>?@ABCDEFGHI" #Phred score
+    diff = (diff | (diff >> np.uint64(1))) & np.uint64(0x5555555555555555)
+    diff = (diff & np.uint64(0x3333333333333333)) + ((diff >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    diff = (diff + (diff >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return np.int64((diff * np.uint64(0x0101010101010101)) >> np.uint64(56))
 
-    quality_set = set(quality_list[:int(phred)-1])
-    
-    directory = os.path.join(out, "unpacked")
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+@njit(cache=True, parallel=True)
+def popcount_lookup(queries, keys, mismatch):
+    
+    """ the "popcount" mismatch search: each read of the batch is compared 
+    against the whole packed library, one XOR and popcount per sgRNA, with the
+    reads spread over the cpu cores. Nothing is precomputed, so unlike the 
+    "mismatch_index" its cost doesn't grow with the number of mismatches """
+    
+    found = np.full(queries.shape[0], NO_MATCH, dtype=np.int64)
+    for i in prange(queries.shape[0]):
+        query, guide = np.uint64(queries[i]), NO_MATCH
+        for k in range(keys.shape[0]):
+            if base_differences(query ^ keys[k]) <= mismatch:
+                if guide != NO_MATCH: # a second sgRNA is as close, the read is discarded
+                    guide = AMBIGUOUS
+                    break
+                guide = k
+        found[i] = guide
+    return found
+
+def search_index(keys, lenght, mismatch, search):
     
-    if psutil.virtual_memory().percent>=60:
-        print("\nLow RAM availability detected, file processing may be slow\n")
+    """ the mismatch search of the fast engine chosen with --mm: the 
+    "mismatch_index" ("index"), the packed sgRNAs themselves for 
+    "popcount_lookup" ("popcount"), or None for the all-vs-all scan """
     
-    print(f"\nRunning with parameters:\n{mismatch} mismatch allowed\nMinimal Phred Score per bp >= {phred}\n")
-    print(f"All data will be saved into {directory}")
+    if (keys is None) or (mismatch == 0) or (search == "scan"):
+        return None
+    if search == "popcount":
+        return "popcount", keys
+    return mismatch_index(keys, lenght, mismatch)
+
+EDIT_ARRAYS = ["edit_variants", "edit_owners", "edit_bounds", "edit_guides"] # the "edit_index", as saved for the workers
+
+def delete_bases(keys, lenght, position):
+
+    """ removes the base at "position" from packed sequences of "lenght" bases """
+
+    tail = 2 * (lenght - position - 1)
+    return ((keys >> (tail + 2)) << tail) | (keys & ((1 << tail) - 1))
+
+def edit_index(keys, lenght, indels):
+
+    """ Builds the indel search index once, for all the samples. It's the
+    deletion neighborhood of the sgRNAs (SymSpell style): every sequence left
+    after removing 1 up to "indels" bases from each sgRNA, sorted, per number
+    of deletions. Two sequences within "indels" edits of each other always
+    share one of these, so a handful of lookups finds every candidate sgRNA,
+    which is then checked with a real edit distance. The base codes of the
+    sgRNAs are kept for that check """
+
+    variants, owners = [keys], [np.arange(len(keys), dtype=np.int64)]
+    for deletions in range(1, indels + 1):
+        size = lenght - deletions + 1
+        level = np.concatenate([delete_bases(variants[-1], size, position) for position in range(size)])
+        guides = np.tile(owners[-1], size)
+        order = np.lexsort((guides, level))
+        level, guides = level[order], guides[order]
+
+        # the same deletion variant comes up from several positions of the same sgRNA (repeated bases)
+        unique = np.ones(len(level), dtype=np.bool_)
+        unique[1:] = (level[1:] != level[:-1]) | (guides[1:] != guides[:-1])
+        variants.append(level[unique])
+        owners.append(guides[unique])
+
+    order = np.argsort(keys, kind="stable")
+    variants[0], owners[0] = keys[order], owners[0][order]
+    bounds = np.cumsum([0] + [len(level) for level in variants]).astype(np.int64)
+    shifts = 2 * np.arange(lenght - 1, -1, -1, dtype=np.int64)
+    guides = ((keys[:, None] >> shifts[None, :]) & 3).astype(np.int8)
+    return np.concatenate(variants), np.concatenate(owners), bounds, guides
+
+@njit(cache=True)
+def edit_distance(guide, window, size, limit):
+
+    """ smallest edit distance between a sgRNA and the start of the read
+    window, over all the read lenghts within "limit" of the sgRNA """
+
+    lenght = guide.shape[0]
+    previous = np.arange(size + 1)
+    current = np.empty(size + 1, dtype=previous.dtype)
+    for i in range(1, lenght + 1):
+        current[0] = i
+        for j in range(1, size + 1):
+            cost = previous[j - 1] + (guide[i - 1] != window[j - 1])
+            cost = min(cost, previous[j] + 1)
+            current[j] = min(cost, current[j - 1] + 1)
+        previous, current = current, previous
+
+    best = limit + 1
+    for j in range(max(0, lenght - limit), min(size, lenght + limit) + 1):
+        best = min(best, previous[j])
+    return best
+
+@njit(cache=True)
+def edit_candidates(query, level, variants, owners, bounds, guides, window, size, found, count):
+
+    """ looks up one deletion variant of the read, and adds the sgRNAs that
+    really are within the edit distance to "found". Returns their number """
+
+    limit = bounds.shape[0] - 2
+    low, high = bounds[level], bounds[level + 1]
+    i = low + np.searchsorted(variants[low:high], query)
+    while (i < high) and (variants[i] == query) and (count < 2):
+        guide, seen = owners[i], False
+        for k in range(count):
+            seen = seen or (found[k] == guide)
+        if (not seen) and (edit_distance(guides[guide], window, size, limit) <= limit):
+            found[count] = guide
+            count += 1
+        i += 1
+    return count
+
+@njit(cache=True)
+def edit_lookup(buffer, windows, reads, lenght, codes, variants, owners, bounds, guides):
+
+    """ Resolves the reads left after the mismatch search against the
+    "edit_index", allowing insertions and deletions. The read window is taken
+    "limit" bases longer than the sgRNAs, and each of its prefixes within
+    "limit" of the sgRNA lenght is looked up with its own deletion variants.
+    Returns the sgRNA index for each, AMBIGUOUS or NO_MATCH """
+
+    limit = bounds.shape[0] - 2
+    resolved = np.full(reads.shape[0], NO_MATCH, dtype=np.int64)
+    window = np.empty(lenght + limit, dtype=np.int8)
+    found = np.empty(2, dtype=np.int64)
+    for r in range(reads.shape[0]):
+        begin, size = windows[reads[r]], 0
+        while (size < lenght + limit) and (begin + size < buffer.shape[0]):
+            code = codes[buffer[begin + size]]
+            if code > 3: # end of the line, or a base that can't be packed
+                break
+            window[size] = code
+            size += 1
+
+        count = 0
+        for prefix in range(max(1, lenght - limit), size + 1):
+            query = np.int64(0)
+            for k in range(prefix):
+                query = (query << 2) | window[k]
+
+            for removed in range(limit + 1):
+                level = removed + lenght - prefix
+                if (level < 0) or (level > limit) or (count > 1):
+                    continue
+                if removed == 0:
+                    count = edit_candidates(query, level, variants, owners, bounds, guides, window, size, found, count)
+                    continue
+                for first in range(prefix):
+                    once = ((query >> (2 * (prefix - first))) << (2 * (prefix - first - 1))) | \
+                        (query & ((np.int64(1) << (2 * (prefix - first - 1))) - 1))
+                    if removed == 1:
+                        count = edit_candidates(once, level, variants, owners, bounds, guides, window, size, found, count)
+                        continue
+                    for second in range(first, prefix - 1):
+                        twice = ((once >> (2 * (prefix - 1 - second))) << (2 * (prefix - second - 2))) | \
+                            (once & ((np.int64(1) << (2 * (prefix - second - 2))) - 1))
+                        count = edit_candidates(twice, level, variants, owners, bounds, guides, window, size, found, count)
+
+        if count == 1:
+            resolved[r] = found[0]
+        elif count > 1: # a second sgRNA is as close, the read is discarded
+            resolved[r] = AMBIGUOUS
+    return resolved
+
+@njit(cache=True)
+def substituted(packed, keys, reads, resolved, limit):
+    
+    """ which of the "reads" resolved by "edit_lookup" are within "limit"
+    substitutions of their sgRNA, so that no insertion or deletion is needed """
+    
+    found = np.zeros(reads.shape[0], dtype=np.bool_)
+    for r in range(reads.shape[0]):
+        if resolved[r] >= 0:
+            found[r] = base_differences(np.uint64(packed[reads[r]] ^ keys[resolved[r]])) <= limit
+    return found
+
+@njit(cache=True)
+def build_automaton(keys, lenght):
+    
+    """ Builds the Aho-Corasick automaton of the packed sgRNAs, as a complete 
+    transition table over the 4 bases (failure links already followed), so 
+    the search takes a single table lookup per base. "outputs" holds the 
+    sgRNA ID of the states where a whole sgRNA was read, -1 elsewhere """
+    
+    goto = np.full((keys.shape[0] * lenght + 1, 4), -1, dtype=np.int32)
+    outputs = np.full(goto.shape[0], -1, dtype=np.int64)
+    used = 1
+    for guide in range(keys.shape[0]):
+        state = 0
+        for position in range(lenght):
+            code = (keys[guide] >> (2 * (lenght - 1 - position))) & 3
+            if goto[state, code] == -1:
+                goto[state, code] = used
+                used += 1
+            state = goto[state, code]
+        outputs[state] = guide
+    
+    goto, outputs = goto[:used].copy(), outputs[:used].copy()
+    fail = np.zeros(used, dtype=np.int32)
+    queue = np.empty(used, dtype=np.int32)
+    head, tail = 0, 0
+    for code in range(4):
+        if goto[0, code] == -1:
+            goto[0, code] = 0
+        else:
+            queue[tail] = goto[0, code]
+            tail += 1
+            
+    while head < tail: # breadth first, so the failure states are always complete
+        state = queue[head]
+        head += 1
+        for code in range(4):
+            child = goto[state, code]
+            if child == -1:
+                goto[state, code] = goto[fail[state], code]
+            else:
+                fail[child] = goto[fail[state], code]
+                queue[tail] = child
+                tail += 1
+                
+    return goto, outputs
+
+def guide_locator(anchor, span, keys, lenght):
+    
+    """ arrays used by "locate_guide" to find the sgRNA within the reads. 
+    With an anchor, the sgRNA starts right after it. Without one, but with a
+    search span, the reads are searched for the whole library at once with an
+    Aho-Corasick automaton. Returns the arrays, and the search span """
+    
+    codes = base_codes()
+    locator = {"anchor":np.array([codes[ord(base)] for base in anchor], dtype=np.int8),
+               "automaton":np.zeros((0, 4), dtype=np.int32), "outputs":np.zeros(0, dtype=np.int64)}
+    
+    if anchor:
+        span = max(span, 1)
+    elif span > 0:
+        locator["automaton"], locator["outputs"] = build_automaton(keys, lenght)
+    
+    return locator, span
+
+@njit(cache=True)
+def locate_guide(buffer, seq_start, seq_end, start, lenght, codes, anchor, span, automaton, outputs):
+    
+    """ position of the sgRNA within the read. Fixed at "start", unless an 
+    anchor is given (searched for from "start" on, over "span" positions), or
+    the library automaton is given (the first sgRNA starting within "span" 
+    positions from "start"). Returns -1 when it can't be found """
+    
+    if anchor.shape[0] > 0:
+        for offset in range(start, start + span):
+            first = seq_start + offset
+            if first + anchor.shape[0] > seq_end:
+                break
+            for j in range(anchor.shape[0]):
+                if codes[buffer[first + j]] != anchor[j]:
+                    break
+            else:
+                return offset + anchor.shape[0]
+        return -1
+    
+    if automaton.shape[0] > 0:
+        state = 0
+        for i in range(seq_start + start, min(seq_start + start + span - 1 + lenght, seq_end)):
+            code = codes[buffer[i]]
+            if code > 3:
+                state = 0
+                continue
+            state = automaton[state, code]
+            if outputs[state] >= 0:
+                return i + 1 - lenght - seq_start
+        return -1
+    
+    return start
+
+@njit(cache=True)
+def next_line(buffer, pos, size):
+    while pos < size:
+        if buffer[pos] == 10: # "\n"
+            return pos
+        pos += 1
+    return -1
+
+@njit(cache=True)
+def profile_record(buffer, seq_start, seq_end, qual_start, first, codes, qualities, bases):
+    
+    """ adds the Phred score and the base at each profiled position (from
+    read position "first" on) of one read, to the "Profile" count arrays """
+    
+    low, high = max(0, -first), min(qualities.shape[0], seq_end - seq_start - first)
+    seq, qual = seq_start + first, qual_start + first
+    for i in range(low, high):
+        bases[i, np.int64(codes[buffer[seq + i]])] += 1
+        qualities[i, min(max(np.int64(buffer[qual + i]) - 33, 0), PROFILE_SCORES - 1)] += 1
+
+@njit(cache=True)
+def profile_lines(sequences, qualities, shift, codes, profile_qualities, bases):
+    
+    """ "profile_record" for the python engine, over the profiled part of a 
+    batch of reads, padded with zeros past the end of the shorter ones """
+    
+    for r in range(sequences.shape[0]):
+        for i in range(sequences.shape[1]):
+            if sequences[r, i] == 0:
+                break
+            bases[shift + i, np.int64(codes[sequences[r, i]])] += 1
+            profile_qualities[shift + i, min(max(np.int64(qualities[r, i]) - 33, 0), PROFILE_SCORES - 1)] += 1
+
+@njit(cache=True)
+def fastq_kernel(buffer, start, lenght, quality_fail, codes, keys, anchor, span, automaton, outputs, hits, packed, windows, first, qualities, bases):
+    
+    """ Parses the raw fastq bytes without creating any python objects per read. 
+    Finds the 4 line record boundaries, locates and trims the sgRNA window 
+    (see "locate_guide"), applies the
+    Phred-score lookup table and the N check, and packs the window to find
+    its sgRNA index in the sorted "keys" array. Writes one entry per read into
+    "hits" (sgRNA index, or one of the status codes), "packed" (the packed 
+    window), and "windows" (the position of the window in the buffer). 
+    The "Profile" arrays ("qualities" and "bases", empty when not profiling) 
+    are filled along the way (see "profile_record").
+    Only complete records are parsed. Returns the number of reads, and the 
+    number of bytes consumed """
+    
+    size = buffer.shape[0]
+    capacity = hits.shape[0]
+    pos, record = 0, 0
+    
+    while record < capacity:
+        header_end = next_line(buffer, pos, size)
+        if header_end == -1:
+            break
+        seq_end = next_line(buffer, header_end + 1, size)
+        if seq_end == -1:
+            break
+        plus_end = next_line(buffer, seq_end + 1, size)
+        if plus_end == -1:
+            break
+        qual_end = next_line(buffer, plus_end + 1, size)
+        if qual_end == -1:
+            break
+        
+        seq_start, qual_start = header_end + 1, plus_end + 1
+        if qualities.shape[0]:
+            profile_record(buffer, seq_start, seq_end, qual_start, first, codes, qualities, bases)
+        offset = locate_guide(buffer, seq_start, seq_end, start, lenght, codes, anchor, span, automaton, outputs)
+        
+        status, key, other = 0, 0, False
+        if offset == -1:
+            status, offset = NO_LOCATION, 0
+            
+        s0, s1 = min(seq_start + offset, seq_end), min(seq_start + offset + lenght, seq_end)
+        q0, q1 = min(qual_start + offset, qual_end), min(qual_start + offset + lenght, qual_end)
+        
+        if status == 0:
+            for i in range(q0, q1):
+                if quality_fail[buffer[i]]:
+                    status = PHRED_FAIL
+                    break
+            
+        if status == 0:
+            for i in range(s0, s1):
+                code = codes[buffer[i]]
+                if code == 4:
+                    status = N_FAIL
+                    break
+                if code == 5:
+                    other = True
+                key = (key << 2) | (code & 3)
+                
+        if status == 0:
+            if other:
+                status = OTHER_BASES
+            elif s1 - s0 < lenght:
+                status = SHORT_READ
+            else:
+                index = np.searchsorted(keys, key)
+                if (index < keys.shape[0]) and (keys[index] == key):
+                    status = index
+                else:
+                    status = UNMATCHED
+        
+        hits[record] = status
+        packed[record] = key
+        windows[record] = s0
+        record += 1
+        pos = qual_end + 1
+        
+    return record, pos
+
+@njit(cache=True)
+def barcode_kernel(buffer, found, position, lenght, codes, barcodes):
+    
+    """ packs the sample barcode of each of the first "found" records of the 
+    buffer (the ones "fastq_kernel" parsed). The barcode is read inline, from
+    "position" on in the read sequence, or with a negative "position", from 
+    the index in the read header (the last ":" field, with the "+" between 
+    dual indexes skipped). Writes -1 for barcodes with N, other characters, 
+    or that are too short """
+    
+    size = buffer.shape[0]
+    pos = 0
+    for record in range(found):
+        header_end = next_line(buffer, pos, size)
+        seq_end = next_line(buffer, header_end + 1, size)
+        plus_end = next_line(buffer, seq_end + 1, size)
+        qual_end = next_line(buffer, plus_end + 1, size)
+        
+        if position >= 0:
+            b0, b1 = min(header_end + 1 + position, seq_end), seq_end
+        else:
+            b0, b1 = header_end, header_end
+            while b0 > pos and buffer[b0 - 1] != 58: # ":"
+                b0 -= 1
+        
+        key, bases = 0, 0
+        for i in range(b0, b1):
+            if bases == lenght:
+                break
+            if buffer[i] == 43 or buffer[i] == 13: # "+" between dual indexes, windows line ends
+                continue
+            code = codes[buffer[i]]
+            if code > 3:
+                bases = -1
+                break
+            key = (key << 2) | code
+            bases += 1
+        
+        barcodes[record] = key if bases == lenght else -1
+        pos = qual_end + 1
+
+class RecordReader:
+    
+    """ Serves large byte buffers from a sequencing file to "fastq_kernel".
+    Uncompressed files are memory-mapped, and .gz files are streamed through a 
+    "DecompressReader". The kernel only parses complete records, so whatever 
+    it didn't consume (reported back through "consumed") is carried over into
+    the next buffer """
+    
+    def __init__(self, raw, window=16*1024*1024, byte_range=None, resume=0):
+        self.raw = raw
+        self.window = window
+        self.byte_range = byte_range
+        self.resume = resume # bytes already counted, see "checkpoint_writer"
+        self.used = 0
+        self.offset = self.position = resume # where the current buffer starts, and how far the kernel got
+        self.decompress = 0 # time spent decompressing (.gz files)
+        
+    def consumed(self, used):
+        self.used = used
+        self.position = self.offset + used
+    
+    def __iter__(self):
+        if self.raw.endswith(".gz"):
+            yield from self.stream()
+        else:
+            yield from self.mapped()
+            
+    def mapped(self):
+        import mmap
+        
+        if os.path.getsize(self.raw) == 0:
+            return
+        with open(self.raw, "rb") as f: # the map is closed once the last buffer view is released
+            data = np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+        if self.byte_range is not None: # record aligned chunk, see "record_boundary"
+            data = data[self.byte_range[0]:self.byte_range[1]]
+        
+        pos, size = self.resume, data.shape[0]
+        while pos < size:
+            self.used, self.offset = 0, pos
+            yield data[pos:pos+self.window]
+            if self.used == 0: # last record is missing its final newline
+                if pos + self.window < size:
+                    raise ValueError(f"No complete fastq record found at byte {pos} of {self.raw}")
+                yield np.frombuffer(bytes(data[pos:]) + b"\n", dtype=np.uint8)
+                break
+            pos += self.used
+            
+    def stream(self):
+        leftover, skip, base = b"", self.resume, self.resume
+        reader = DecompressReader(self.raw, block_size=self.window)
+        for block in reader.blocks():
+            if skip: # decompressed again, but not counted again
+                block, skip = block[skip:], max(0, skip - len(block))
+                if not block:
+                    continue
+            self.used, self.offset = 0, base
+            buffer = leftover + block
+            yield np.frombuffer(buffer, dtype=np.uint8)
+            leftover, base = buffer[self.used:], base + self.used
+            while len(leftover) > self.window: # the kernel ran out of record slots
+                self.used, self.offset = 0, base
+                yield np.frombuffer(leftover, dtype=np.uint8)
+                leftover, base = leftover[self.used:], base + self.used
+        self.decompress = reader.seconds
+        if leftover:
+            self.offset = base
+            yield np.frombuffer(leftover + b"\n", dtype=np.uint8)
+
+PROFILE_FLANK = 10 # bases profiled on each side of the sgRNA window
+PROFILE_SCORES = 94 # Phred scores 0 to 93 (Phred+33 encoding)
+PROFILE_BASES = ["A", "C", "G", "T", "N", "other"] # same order as "base_codes"
+
+class Profile:
+    
+    """ Per-position Phred score histograms and base composition of the reads,
+    over the sgRNA window (at --st) and PROFILE_FLANK bases on each side. 
+    Filled while the reads are parsed (see "profile_record"), at a fixed size
+    whatever the number of reads, and carried and added up along with the
+    "Metrics". Written out by "profile_writer" """
+    
+    def __init__(self, start, lenght, flank=PROFILE_FLANK):
+        self.first, self.flank = start - flank, flank
+        self.qualities = np.zeros((lenght + 2 * flank, PROFILE_SCORES), dtype=np.int64)
+        self.bases = np.zeros((lenght + 2 * flank, len(PROFILE_BASES)), dtype=np.int64)
+        self.span = slice(max(0, self.first), self.first + len(self.bases)) # the profiled part of a read line
+        
+    def add(self, sequences, qualities):
+        
+        """ the python engine version of "profile_record", for a batch of reads
+        (their sequence and quality lines, cut to "span") """
+        
+        width = len(self.bases)
+        shift = self.span.start - self.first
+        window = lambda lines: np.frombuffer("".join(line.ljust(width - shift, "\0") for line in lines).encode(), 
+                                             dtype=np.uint8).reshape(len(lines), width - shift)
+        profile_lines(window(sequences), window(qualities), shift, base_codes(), self.qualities, self.bases)
+        
+    def merge(self, other):
+        self.qualities += other.qualities
+        self.bases += other.bases
+        return self
+
+    def arrays(self):
+    
+        """ the profile as arrays, to be saved with the counts (see "Manifest") """
+    
+        return {"first":self.first, "flank":self.flank, "qualities":self.qualities, "bases":self.bases}
+    
+    @classmethod
+    def from_arrays(cls, arrays):
+    
+        """ rebuilds the profile from its "arrays" """
+    
+        flank = int(arrays["flank"])
+        profile = cls(int(arrays["first"]) + flank, len(arrays["bases"]) - 2 * flank, flank)
+        profile.qualities += arrays["qualities"]
+        profile.bases += arrays["bases"]
+        return profile
+    
+class Metrics:
+    
+    """ Timings per processing stage, and read counters, of one file (or chunk).
+    The metrics of the chunks and files add up into the run metrics (see 
+    "merge"), written into the "metrics.json" file. 
+    Stages: "decompress" (.gz files, on its own thread, so it overlaps with the
+    other stages), "parse" (quality control and perfect matches, which are done
+    together in one "fastq_kernel" pass), "mismatch" (mismatch search), "count"
+    (adding up the reads per sgRNA) and "output" (writing the result files).
+    Reads rescued by the indel search are counted as "indel" when they need an
+    insertion or deletion, and as "mismatch" when substitutions alone will do """
+    
+    stages = ["decompress", "parse", "mismatch", "count", "output"]
+    counters = ["reads", "phred_fail", "n_fail", "no_location", "exact", "mismatch", "indel", "ambiguous", "no_match", "cache_hits", "store_hits", "cache_lookups"]
+    
+    def __init__(self):
+        self.seconds = dict.fromkeys(self.stages, 0.0)
+        self.counts = dict.fromkeys(self.counters, 0)
+        self.wall = None # running time
+        self.profile = None # see "Profile"
+    
+    def add(self, stage, started):
+        
+        """ adds the time since "started" to the stage """
+        
+        self.seconds[stage] += time() - started
+    
+    def merge(self, other):
+        for stage in self.stages:
+            self.seconds[stage] += other.seconds[stage]
+        for counter in self.counters:
+            self.counts[counter] += other.counts[counter]
+        if other.profile is not None:
+            from copy import deepcopy
+            self.profile = deepcopy(other.profile) if self.profile is None else self.profile.merge(other.profile)
+        return self
+    
+    @classmethod
+    def from_summary(cls, summary):
+        
+        """ rebuilds the metrics from their "summary" """
+        
+        metrics = cls()
+        for stage in cls.stages:
+            metrics.seconds[stage] = summary["seconds"].get(stage, 0.0)
+        for counter in cls.counters:
+            metrics.counts[counter] = summary["counters"].get(counter, 0)
+        metrics.wall = summary.get("wall_seconds")
+        return metrics
+            
+    def summary(self):
+        
+        """ the metrics as a dictionary, for the JSON file """
+        
+        wall = self.wall
+        summary = {"seconds":{stage:round(value, 4) for stage, value in self.seconds.items()}, "counters":dict(self.counts)}
+        lookups = self.counts["cache_lookups"]
+        summary["cache_hit_rate"] = round(self.counts["cache_hits"] / lookups, 4) if lookups else None
+        if wall:
+            summary["wall_seconds"] = round(wall, 4)
+            summary["reads_per_s"] = round(self.counts["reads"] / wall)
+        return summary
 
-    return folder_path, guides, int(mismatch), quality_set, directory, \
-        version, int(phred), separator, int(start), int(lenght), ram, extension 
+class ReadResolver:
+    
+    """ Resolves the reads in the byte buffers served by a "RecordReader" into
+    sgRNA IDs. The compiled "fastq_kernel" finds the perfect matches, and the
+    reads without one are resolved in bulk against the "mismatch_index" when 
+    there is one. Otherwise they are turned into python strings for the 
+    "sgrna_all_vs_all" mismatch search. Unless the whole mismatch neighborhood
+    is precomputed, the outcomes are kept in a "ResolutionCache", so repeated
+    reads are only searched once. With an "edit_index" the reads still left 
+    get an indel search too. The stage timings, read counters and (with 
+    "profile") the "Profile" of the reads go into "metrics". With a 
+    "ResolutionStore", the outcomes are kept on disk too """
+    
+    def __init__(self, quality_set, start, lenght, library, mismatch, cache_size, keys, index, locator=None, span=0, capacity=1<<20, metrics=None, store=None, edits=None, profile=True):
+        self.start, self.lenght, self.library, self.mismatch = start, lenght, library, mismatch
+        self.keys, self.index, self.edits = keys, index, edits
+        self.codes, self.quality_fail = base_codes(), quality_table(quality_set)
+        if locator is None:
+            locator, span = guide_locator("", 0, keys, lenght)
+        self.locator, self.span = locator, span
+        self.hits = np.empty(capacity, dtype=np.int64)
+        self.packed = np.empty(capacity, dtype=np.int64)
+        self.windows = np.empty(capacity, dtype=np.int64)
+        self.cache = ResolutionCache(cache_size if mismatch != 0 else 0, lenght, library, store if mismatch != 0 else None)
+        self.binary_sgrna = None
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.profile = None
+        self.profiled = (0, np.zeros((0, PROFILE_SCORES), dtype=np.int64), np.zeros((0, len(PROFILE_BASES)), dtype=np.int64)) # nothing to fill
+        if profile:
+            self.metrics.profile = self.profile = Profile(start, lenght) if self.metrics.profile is None else self.metrics.profile
+            self.profiled = (self.profile.first, self.profile.qualities, self.profile.bases)
+        
+    def resolve(self, buffer):
+        
+        """ Returns the number of reads and of bytes consumed from the buffer,
+        the sgRNA ID (or status code) of each read, and which of those were
+        only resolved with mismatches """
+        
+        found, used, ids = self.parse(buffer)
+        self.cache.relieve()
+        return found, used, ids, self.rescue(buffer, ids)
+    
+    def parse(self, buffer):
+        
+        """ the "fastq_kernel" step: quality control and perfect matches """
+        
+        tempo = time()
+        found, used = fastq_kernel(buffer, self.start, self.lenght, self.quality_fail, self.codes, self.keys, 
+                                   self.locator["anchor"], self.span, self.locator["automaton"], self.locator["outputs"], 
+                                   self.hits, self.packed, self.windows, *self.profiled)
+        ids = self.hits[:found].copy()
+        
+        statuses = np.bincount(-ids[ids < 0], minlength=-NO_LOCATION + 1)
+        counts = self.metrics.counts
+        counts["reads"] += found
+        counts["phred_fail"] += int(statuses[-PHRED_FAIL])
+        counts["n_fail"] += int(statuses[-N_FAIL])
+        counts["no_location"] += int(statuses[-NO_LOCATION])
+        counts["exact"] += found - int(statuses.sum())
+        self.metrics.add("parse", tempo)
+        return found, used, ids
+    
+    def rescue(self, buffer, ids):
+        
+        """ the mismatch search step, for the reads of the last "parse". 
+        Updates "ids" in place, and returns which reads were rescued """
+        
+        tempo = time()
+        hits, lookups, stored = self.cache.hits, self.cache.lookups, self.cache.disk_hits
+        rescued = np.zeros(len(ids), dtype=np.bool_)
+        searched = (ids == UNMATCHED) | (ids == OTHER_BASES) | (ids == SHORT_READ)
+        doubtful = np.zeros(len(ids), dtype=np.bool_)
+        indel = 0
+        
+        if self.mismatch != 0:
+            unmatched = np.flatnonzero(ids == UNMATCHED)
+            resolved = self.packed_search(buffer, unmatched)
+            ids[unmatched[resolved >= 0]] = resolved[resolved >= 0]
+            rescued[unmatched[resolved >= 0]] = True
+            doubtful[unmatched[resolved == AMBIGUOUS]] = True
+            
+            for j in np.flatnonzero((ids == OTHER_BASES) | (ids == SHORT_READ)): # reads that couldn't be packed
+                window = self.windows[j]
+                seq = bytes(buffer[window:window+self.lenght]).decode().split("\n")[0].upper()
+                finder = imperfect_alignment(seq,self.scan_library(),self.mismatch,self.cache)
+                if finder >= 0:
+                    ids[j], rescued[j] = finder, True
+                doubtful[j] = finder == AMBIGUOUS
+        
+        if self.edits is not None: # reads ambiguous with substitutions alone stay discarded
+            left = np.flatnonzero(((ids == UNMATCHED) | (ids == SHORT_READ)) & ~doubtful)
+            resolved = edit_lookup(buffer, self.windows, left, self.lenght, self.codes, *self.edits)
+            full = ids[left] == UNMATCHED # reads with a packed window, that substitutions alone might explain
+            ids[left[resolved >= 0]] = resolved[resolved >= 0]
+            rescued[left[resolved >= 0]] = True
+            doubtful[left[resolved == AMBIGUOUS]] = True
+            indel = int((resolved >= 0).sum()) - int(substituted(self.packed, self.keys, left[full], resolved[full], len(self.edits[2]) - 2).sum())
+        
+        ambiguous = int(doubtful.sum())
+        counts = self.metrics.counts
+        counts["mismatch"] += int(rescued.sum()) - indel
+        counts["indel"] += indel
+        counts["ambiguous"] += ambiguous
+        counts["no_match"] += int(searched.sum()) - int(rescued.sum()) - ambiguous
+        counts["cache_hits"] += self.cache.hits - hits
+        counts["store_hits"] += self.cache.disk_hits - stored
+        counts["cache_lookups"] += self.cache.lookups - lookups
+        self.metrics.add("mismatch", tempo)
+        return rescued
+    
+    def scan_library(self):
+        if self.binary_sgrna is None:
+            self.binary_sgrna = binary_converter(self.library)
+        return self.binary_sgrna
+    
+    def packed_search(self, buffer, unmatched):
+        
+        """ mismatch search of the packed reads without a perfect match """
+        
+        queries = self.packed[unmatched]
+        if (self.index is not None) and (self.index[0] == "neighborhood"):
+            return index_lookup(queries, self.index, self.mismatch)
+        
+        resolved = self.cache.lookup(queries)
+        missing = np.flatnonzero(resolved == CACHE_MISS)
+        misses, first, inverse = np.unique(queries[missing], return_index=True, return_inverse=True)
+        
+        if self.index is not None:
+            outcome = index_lookup(misses, self.index, self.mismatch)
+        else:
+            outcome = np.empty(len(misses), dtype=np.int64)
+            for j, window in enumerate(self.windows[unmatched[missing[first]]]):
+                read = (buffer[window:window+self.lenght] & 0xDF).astype(np.int8) # upper case
+                finder = sgrna_all_vs_all(self.scan_library(), read, self.mismatch)
+                outcome[j] = scan_outcome(finder, self.cache.ids)
+                
+        self.cache.store(misses, outcome)
+        resolved[missing] = outcome[inverse.ravel()]
+        return resolved
+
+def fast_reads_counter(raw, quality_set, start, lenght, library, mismatch, cache_size, keys, index, byte_range=None, locator=None, span=0, metrics=None, progress=None, store=None, checkpoint=None, edits=None):
+    
+    """ Same as "reads_counter", but the reads are parsed in large byte buffers 
+    by the compiled "fastq_kernel", and resolved in bulk by a "ReadResolver".
+    With a "checkpoint" path, the progress is saved there every minute, 
+    and picked up from there if a previous run was cut short """
+    
+    resolver = ReadResolver(quality_set, start, lenght, library, mismatch, cache_size, keys, index, locator, span, metrics=metrics, store=store, edits=edits)
+    counts = library.new_counts()
+    perfect_counter, imperfect_counter, reads = 0,0,0
+    
+    resume = 0
+    if (checkpoint is not None) and os.path.isfile(checkpoint):
+        import json
+    
+        with np.load(checkpoint) as saved:
+            resume, counts = int(saved["position"]), saved["counts"]
+            reads, perfect_counter, imperfect_counter = (int(counter) for counter in saved["counters"])
+            resolver.metrics.merge(Metrics.from_summary(json.loads(str(saved["metrics"]))))
+            if (resolver.profile is not None) and ("qualities" in saved.files):
+                resolver.profile.merge(Profile.from_arrays(saved))
+        print(f"Resuming {os.path.basename(raw)} from its checkpoint, {reads} reads in")
+    saved = time()
+    
+    reader = RecordReader(raw, byte_range=byte_range, resume=resume)
+    for buffer in reader:
+        found, used, ids, rescued = resolver.resolve(buffer)
+        reader.consumed(used)
+        reads += found
+        
+        tempo = time()
+        valid = ids >= 0
+        counts += np.bincount(ids[valid], minlength=len(library)).astype(np.uint64)
+        imperfect = int(rescued.sum())
+        imperfect_counter += imperfect
+        perfect_counter += int(valid.sum()) - imperfect
+        resolver.metrics.add("count", tempo)
+        progress_update(progress, found)
+        
+        if (checkpoint is not None) and (time() - saved > CHECKPOINT_INTERVAL):
+            checkpoint_writer(checkpoint, reader.position, counts, reads, perfect_counter, imperfect_counter, resolver.metrics)
+            saved = time()
+    
+    resolver.metrics.seconds["decompress"] += reader.decompress
+    return reads, perfect_counter, imperfect_counter, counts
+
+def demux_reads_counter(raw, resolver, demux, position, byte_range=None, progress=None):
+    
+    """ Same as "fast_reads_counter", for a pooled file: each read is also 
+    assigned to a sample by its barcode (see "barcode_kernel"), in the same 
+    pass. Returns the reads, perfect and imperfect matches of each sample, as 
+    arrays with one entry per sample, plus a last one for the reads whose 
+    barcode didn't match any sample, and the read counts of the samples as
+    sparse "PairCounts" (sample, sgRNA ID) """
+    
+    samples = len(demux["names"])
+    reads = np.zeros(samples + 1, dtype=np.int64)
+    perfect_counter, imperfect_counter = np.zeros_like(reads), np.zeros_like(reads)
+    counts = PairCounts(len(resolver.library))
+    codes = base_codes()
+    barcodes = np.empty(resolver.hits.shape[0], dtype=np.int64)
+    
+    reader = RecordReader(raw, byte_range=byte_range)
+    for buffer in reader:
+        found, used, ids, rescued = resolver.resolve(buffer)
+        reader.consumed(used)
+        
+        tempo = time()
+        barcode_kernel(buffer, found, position, demux["lenght"], codes, barcodes)
+        sample = barcode_samples(barcodes[:found], demux)
+        sample[sample < 0] = samples
+        valid = ids >= 0
+        reads += np.bincount(sample, minlength=samples + 1)
+        imperfect_counter += np.bincount(sample[rescued], minlength=samples + 1)
+        perfect_counter += np.bincount(sample[valid & ~rescued], minlength=samples + 1)
+        assigned = valid & (sample < samples)
+        counts.add(sample[assigned], ids[assigned])
+        resolver.metrics.add("count", tempo)
+        progress_update(progress, found)
+    
+    resolver.metrics.seconds["decompress"] += reader.decompress
+    return reads, perfect_counter, imperfect_counter, counts
+
+class Counter:
+    
+    """ Importable, incremental read counting, for embedding Crispery in other
+    pipelines. Takes a loaded "Library" (or the path to a sgRNA .csv or index 
+    file), and consumes raw FASTQ bytes, or records, as they come:
+        
+        counter = Counter("sgrna.csv", lenght=20, start=0, mismatch=1)
+        for block in blocks:
+            counter.update(block)
+        reads, perfect_counter, imperfect_counter, counts = counter.result()
+    
+    The byte blocks can be cut anywhere, records split between blocks are put
+    back together. Records are (sequence, quality) or (name, sequence, "+", 
+    quality) tuples, of strings or bytes, or objects with "sequence" and 
+    "qualities" attributes. Counters fed from different parts of the same 
+    data (on other threads or processes) are added up with "merge". The counts
+    vector is indexed by sgRNA ID, see "Library". Uses the fast engine, so the
+    sgRNAs must be packable (see "packed_guides"). With "indels", reads up to
+    that many insertions or deletions away from a sgRNA are counted too """
+    
+    def __init__(self, library, lenght=20, start=0, mismatch=1, phred=30, cache_size=64, keys=None, index=None, locator=None, span=0, store=None, indels=0):
+        if isinstance(library, str):
+            library, keys, index = library_loader(library, lenght, mismatch, "fast", "index")
+        if keys is None:
+            keys = packed_guides(library, lenght)
+        if keys is None:
+            raise ValueError("The sgRNAs must be made of A, C, G and T only, all of the indicated length, and at most 31bp long")
+        if (index is None) and (mismatch != 0):
+            index = mismatch_index(keys, lenght, mismatch)
+        
+        self.library = library
+        edits = edit_index(keys, lenght, indels) if indels else None
+        self.resolver = ReadResolver(phred_filter(phred), start, lenght, library, mismatch, cache_size, keys, index, locator, span, store=store, edits=edits)
+        self.metrics = self.resolver.metrics
+        self.counts = library.new_counts()
+        self.reads, self.perfect_counter, self.imperfect_counter = 0, 0, 0
+        self.leftover = b""
+        
+    def update(self, data):
+        
+        """ counts a block of raw FASTQ bytes, or an iterable of records """
+        
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self.feed(bytes(data))
+            return self
+        
+        batch = []
+        for record in data:
+            if hasattr(record, "sequence"):
+                sequence, quality = record.sequence, record.qualities
+            else:
+                sequence, quality = record[1 if len(record) == 4 else 0], record[-1]
+            batch.append(b"@\n%s\n+\n%s\n" % (sequence.encode() if isinstance(sequence, str) else sequence, 
+                                               quality.encode() if isinstance(quality, str) else quality))
+            if len(batch) == 1 << 16:
+                self.feed(b"".join(batch))
+                batch = []
+        self.feed(b"".join(batch))
+        return self
+    
+    def feed(self, block):
+        buffer = self.leftover + block
+        while buffer:
+            found, used, ids, rescued = self.resolver.resolve(np.frombuffer(buffer, dtype=np.uint8))
+            if found:
+                tempo = time()
+                valid = ids >= 0
+                self.counts += np.bincount(ids[valid], minlength=len(self.library)).astype(np.uint64)
+                imperfect = int(rescued.sum())
+                self.reads += found
+                self.imperfect_counter += imperfect
+                self.perfect_counter += int(valid.sum()) - imperfect
+                self.metrics.add("count", tempo)
+            buffer = buffer[used:]
+            if used == 0: # only part of a record left, for the next block
+                break
+        self.leftover = buffer
+        
+    def flush(self):
+        
+        """ counts what is left, if the data didn't end with a newline """
+        
+        if self.leftover:
+            self.feed(b"\n")
+            self.leftover = b""
+        return self
+        
+    def merge(self, other):
+        
+        """ adds up the counts of another "Counter" of the same library """
+        
+        other.flush()
+        self.counts += other.counts
+        self.reads += other.reads
+        self.perfect_counter += other.perfect_counter
+        self.imperfect_counter += other.imperfect_counter
+        self.metrics.merge(other.metrics)
+        return self
+    
+    def result(self):
+        
+        """ the number of reads, of perfect and of imperfect (with mismatches)
+        matches, and the read counts vector, like "fast_reads_counter" """
+        
+        self.flush()
+        return self.reads, self.perfect_counter, self.imperfect_counter, self.counts
+
+PAIRS_MEMORY = 96 # MB, of a "PairCounts" with its buffered keys, for the "MemoryScheduler"
+
+class PairCounts:
+    
+    """ Sparse guide pair counts, for the paired mode (and the sample, sgRNA
+    pairs when demultiplexing). Each pair is packed into one integer key 
+    (sgRNA1 ID * size of library 2 + sgRNA2 ID), and only the pairs that were
+    seen are kept, as sorted keys with their counts (so libraries of 10^5 x 
+    10^5 sgRNAs are fine). New pairs are buffered, and merged in bulk """
+    
+    def __init__(self, size2):
+        self.size2 = size2
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.uint64)
+        self.pending, self.pending_size = [], 0
+        
+    def add(self, ids1, ids2):
+        self.pending.append(ids1 * self.size2 + ids2)
+        self.pending_size += len(ids1)
+        if self.pending_size > 1 << 22:
+            self.compact()
+            
+    def compact(self):
+        if self.pending:
+            added = np.concatenate(self.pending)
+            self.pending, self.pending_size = [], 0
+            self.reduce(added, np.ones(len(added), dtype=np.uint64))
+        return self
+        
+    def merge(self, keys, counts):
+        self.compact().reduce(keys, counts)
+    
+    def reduce(self, keys, counts):
+        keys = np.concatenate([self.keys, keys])
+        counts = np.concatenate([self.counts, counts])
+        if len(keys) == 0:
+            return
+        order = np.argsort(keys, kind="stable")
+        keys, counts = keys[order], counts[order]
+        first = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+        self.keys, self.counts = keys[first], np.add.reduceat(counts, first)
+        
+    def coo(self):
+        
+        """ the counts as COO arrays: sgRNA1 IDs, sgRNA2 IDs and counts """
+        
+        self.compact()
+        return self.keys // self.size2, self.keys % self.size2, self.counts
+
+def paired_reads_counter(raw1, raw2, resolver1, resolver2, size2, progress=None):
+    
+    """ Walks the R1 and R2 files in lockstep. Each file is parsed in large 
+    byte buffers by its own "ReadResolver" (the files don't have the same 
+    buffer layout), and the resolved sgRNA IDs are paired off in read order
+    as soon as both sides have them. Only the read pairs where both reads 
+    are resolved into a sgRNA are counted, as a guide pair in "PairCounts" """
+    
+    readers = [RecordReader(raw1), RecordReader(raw2)]
+    buffers = [iter(reader) for reader in readers]
+    resolvers = [resolver1, resolver2]
+    pending = [[np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.bool_)] for reader in readers]
+    ended = [False, False]
+    pairs = PairCounts(size2)
+    perfect_counter, imperfect_counter, reads = 0,0,0
+    
+    while not (ended[0] or ended[1]) or (not ended[0] and len(pending[0][0]) < len(pending[1][0])) \
+                                    or (not ended[1] and len(pending[1][0]) < len(pending[0][0])):
+        side = 0 if (not ended[0]) and (ended[1] or len(pending[0][0]) <= len(pending[1][0])) else 1
+        buffer = next(buffers[side], None)
+        if buffer is None:
+            ended[side] = True
+            continue
+        found, used, ids, rescued = resolvers[side].resolve(buffer)
+        readers[side].consumed(used)
+        pending[side] = [np.concatenate([pending[side][0], ids]), np.concatenate([pending[side][1], rescued])]
+        
+        paired = min(len(pending[0][0]), len(pending[1][0]))
+        (ids1, rescued1), (ids2, rescued2) = [[array[:paired] for array in side_ids] for side_ids in pending]
+        pending = [[array[paired:] for array in side_ids] for side_ids in pending]
+        
+        tempo = time()
+        valid = (ids1 >= 0) & (ids2 >= 0)
+        pairs.add(ids1[valid], ids2[valid])
+        imperfect = int((valid & (rescued1 | rescued2)).sum())
+        reads += paired
+        imperfect_counter += imperfect
+        perfect_counter += int(valid.sum()) - imperfect
+        resolver1.metrics.add("count", tempo)
+        progress_update(progress, paired)
+    
+    for reader, resolver in zip(readers, resolvers):
+        resolver.metrics.seconds["decompress"] += reader.decompress
+        
+    if len(pending[0][0]) or len(pending[1][0]):
+        print(f"\nWarning!!\n{raw1} and {raw2} don't have the same number of reads. The unpaired reads were not counted.\n")
+    
+    return reads, perfect_counter, imperfect_counter, pairs
+
+def aligner(task):
+
+    """ Runs the main read to sgRNA associating function "reads_counter" over
+    one chunk of a sequencing file (see "chunk_tasks"), inside a worker process.
+    Returns the chunk read counts vector (indexed by sgRNA ID), so they can 
+    be added up with the other chunks of the file, and the chunk "Metrics".
+    With the "Manifest" key of the file, the chunk is checkpointed """
+    
+    i, o, raw, byte_range, chunk, chunks, key = task
+    library, keys, index = WORKER["library"], WORKER["keys"], WORKER["index"]
+    quality_set, mismatch, cache_size = WORKER["quality_set"], WORKER["mismatch"], WORKER["cache_size"]
+    start, lenght, locator, span = WORKER["start"], WORKER["lenght"], WORKER["locator"], WORKER["span"]
+    
+    need = task_memory(raw, len(library), mismatch, keys is not None)
+    with WORKER["scheduler"].admitted(need, cache_size if mismatch != 0 else 0) as cache_size:
+        tempo = time()
+        if chunk == 0:
+            print(f"Processing file {i+1} out of {o}" + (f" (split into {chunks} chunks)" if chunks > 1 else ""))
+        
+        metrics, progress = Metrics(), WORKER["progress"]
+        if keys is not None:
+            checkpoint = None
+            if key is not None:
+                checkpoint = checkpoint_path(WORKER["checkpoints"], key, byte_range)
+            reads, perfect_counter, imperfect_counter, counts = fast_reads_counter(raw, quality_set, start, lenght, library, mismatch, cache_size, keys, index, byte_range, locator, span, metrics, progress, WORKER["store"], checkpoint, WORKER["edits"])
+        else:
+            reads, perfect_counter, imperfect_counter, counts = reads_counter(raw, quality_set, start, lenght, library, mismatch, cache_size, metrics, progress, WORKER["store"])
+
+    return i, tempo, time(), reads, perfect_counter, imperfect_counter, counts, metrics
+
+def paired_aligner(task):
+    
+    """ Same as "aligner", for a pair of R1/R2 files in paired mode (see 
+    "pair_files"). Returns the guide pair counts as COO arrays. The "Metrics"
+    add up the R1 and R2 reads """
+    
+    i, o, raw1, raw2 = task
+    r1, r2 = WORKER, WORKER["r2"]
+    quality_set, mismatch, cache_size = WORKER["quality_set"], WORKER["mismatch"], WORKER["cache_size"]
+    lenght = WORKER["lenght"]
+    
+    need = task_memory(raw1, len(r1["library"]), mismatch, True) + task_memory(raw2, len(r2["library"]), mismatch, True) + PAIRS_MEMORY
+    with WORKER["scheduler"].admitted(need, 2 * cache_size if mismatch != 0 else 0) as granted:
+        tempo = time()
+        print(f"Processing file pair {i+1} out of {o}")
+        
+        metrics = Metrics()
+        resolver1 = ReadResolver(quality_set, WORKER["start"], lenght, r1["library"], mismatch, granted / 2, r1["keys"], r1["index"], r1["locator"], WORKER["span"], metrics=metrics, store=r1["store"])
+        resolver2 = ReadResolver(quality_set, WORKER["start2"], lenght, r2["library"], mismatch, granted / 2, r2["keys"], r2["index"], metrics=metrics, store=r2["store"], profile=False)
+        reads, perfect_counter, imperfect_counter, pairs = paired_reads_counter(raw1, raw2, resolver1, resolver2, len(r2["library"]), WORKER["progress"])
+    
+    return (i, tempo, time(), reads, perfect_counter, imperfect_counter) + pairs.coo() + (metrics,)
+
+def demux_aligner(task):
+    
+    """ Same as "aligner", for one chunk of a pooled file, see "demux_multi" """
+    
+    i, o, raw, byte_range, chunk, chunks = task
+    library, keys, index = WORKER["library"], WORKER["keys"], WORKER["index"]
+    quality_set, mismatch, cache_size = WORKER["quality_set"], WORKER["mismatch"], WORKER["cache_size"]
+    demux = WORKER["demux"]
+    
+    need = task_memory(raw, len(library), mismatch, True) + PAIRS_MEMORY
+    with WORKER["scheduler"].admitted(need, cache_size if mismatch != 0 else 0) as cache_size:
+        tempo = time()
+        if chunk == 0:
+            print(f"Processing pooled file {i+1} out of {o}" + (f" (split into {chunks} chunks)" if chunks > 1 else ""))
+        
+        metrics = Metrics()
+        resolver = ReadResolver(quality_set, WORKER["start"], WORKER["lenght"], library, mismatch, cache_size, keys, index, WORKER["locator"], WORKER["span"], metrics=metrics, store=WORKER["store"], edits=WORKER["edits"])
+        reads, perfect_counter, imperfect_counter, counts = demux_reads_counter(raw, resolver, demux, WORKER["barcode_position"], byte_range, WORKER["progress"])
+    
+    return (i, tempo, time(), reads, perfect_counter, imperfect_counter) + counts.coo() + (metrics,)
+
+def sample_stats(out, separator, reads, perfect_counter, imperfect_counter, tempo):
+    
+    """ the statistics of one sample, as a row of the "compiled_stats.csv" file """
+
+    if tempo > 60:
+        timing = [str(round(tempo / 60, 2)), "minutes"]
+    else:
+        timing = [str(round(tempo, 2)), "seconds"]
+
+    name = out[-out[::-1].find(separator):-len(".fastq")]
+    return [name] + timing + [reads, perfect_counter+imperfect_counter, perfect_counter, imperfect_counter]
+
+def stats_line(stats):
+    
+    """ the sample statistics line, at the top of each sample output file """
+    
+    name, time, unit, reads, valid, perfect_counter, imperfect_counter = stats
+    return f"#script ran in {time} {unit} for file {name}. {valid} reads out of {reads} were considered valid. {perfect_counter} were perfectly aligned. {imperfect_counter} were aligned with mismatch"
+
+def reads_file(out):
+    
+    """ the "_reads.csv" file of a sample """
+    
+    return out[:-out[::-1].find(".")-1] + "_reads.csv"
+
+def sample_writer(out, separator, library, counts, reads, perfect_counter, imperfect_counter, tempo):
+    
+    """ Writes the read counts per sgRNA of one sample into its "_reads.csv" file. 
+    Some on the fly quality control is possible (such as making sure 
+    the total number of samples is correct, getting an estimate of the total
+    number of reads per sample, and checking total running time.
+    Returns the sample statistics"""
+    
+    master_list = [["#sgRNA"] + ["Reads"]]
+    for name, count in zip(library.names.tolist(), counts.tolist()):
+        master_list.append([name] + [count])
+
+    stats = sample_stats(out, separator, reads, perfect_counter, imperfect_counter, tempo)
+    stats_condition = stats_line(stats)
+    
+    master_list.sort(key = lambda master_list: master_list[0]) #alphabetical sorting
+    master_list.insert(0,[stats_condition])
+    csv_writer(reads_file(out), master_list)
+    
+    print(stats_condition[1:]) # quality control
+    return stats
+
+def pairs_writer(out, separator, library1, library2, coo, reads, perfect_counter, imperfect_counter, tempo):
+    
+    """ Same as "sample_writer", for the guide pair counts of one sample in
+    paired mode. Only the pairs that were seen are written, into its 
+    "_pairs.csv" file. Returns the sample statistics """
+    
+    ids1, ids2, counts = coo
+    master_list = [["#sgRNA1", "sgRNA2", "Reads"]]
+    for name1, name2, count in zip(library1.names[ids1].tolist(), library2.names[ids2].tolist(), counts.tolist()):
+        master_list.append([name1, name2, count])
+    
+    stats = sample_stats(out, separator, reads, perfect_counter, imperfect_counter, tempo)
+    stats_condition = stats_line(stats)
+    
+    master_list[1:] = sorted(master_list[1:]) #alphabetical sorting
+    master_list.insert(0,[stats_condition])
+    csvfile = out[:-out[::-1].find(".")-1] + "_pairs.csv"
+    csv_writer(csvfile, master_list)
+    
+    print(stats_condition[1:]) # quality control
+    return stats
+
+def csv_writer(path, outfile):
+    
+    """ writes the indicated outfile into an .csv file in the directory"""
+        
+    with open(path, "w", newline='') as output: #writes the output
+        writer = csv.writer(output)
+        writer.writerows(outfile)
+
+def inputs_handler(separator):
+    
+    """ assertains the correct parsing of the input parameters"""
+    
+    parameters=inputs_initializer(separator)
+    
+    if len(parameters) != 9:
+        input("Please confirm that all the input boxes are filled. Some parameters are missing.\nPress any key to exit")
+        raise Exception
+        
+    try:
+        int(parameters["start"])
+        int(parameters["length"])
+        int(parameters["miss"])
+        int(parameters["phred"])
+        float(parameters["cache"])
+    except Exception:
+        input("\nOnly numeric values are accepted in the folowing fields:\nsgRNA read starting place;\nsgRNA length;\nmismatch;\nPhred score;\nmismatch cache size.\n\nPlease try again. Press any key to exit")
+        raise Exception    
+
+    return parameters['seq_files'],parameters['sgrna'],parameters['out'],parameters['start'],\
+    parameters['length'],parameters['miss'],parameters['phred'],parameters['cache'],\
+    parameters['fastq_extent']
+
+def inputs_initializer(separator):
+    
+    """ Handles the graphical interface, and all the parameter inputs"""
+    
+    from tkinter import Entry,LabelFrame,Button,Label,Tk,filedialog,StringVar,OptionMenu
+    
+    def restart():
+        root.destroy()
+        inputs_initializer()
+        
+    def submit():
+        for arg in temporary:
+            parameters[arg] = temporary[arg].get()
+        root.destroy()
+    
+    def directory(column,row,parameter,frame):
+        filename = filedialog.askdirectory(initialdir =  separator, title = "Select a folder")
+        filing_parser(column,row,filename,parameter,frame)
+        
+    def file(column,row,parameter,frame):
+        filename = filedialog.askopenfilename(initialdir = separator, title = "Select a file", filetypes = \
+            (("CSV files","*.csv"),("all files","*.*")) )
+        filing_parser(column,row,filename,parameter,frame)
+    
+    def filing_parser(column,row,filename,parameter,frame):
+        place = Entry(frame,borderwidth=5,width=50)
+        place.grid(row=row,column=column+1)
+        place.insert(0, filename)
+        parameters[parameter] = filename
+
+    def browsing(keyword,inputs):
+        title1,title2,row,column,function=inputs
+        frame=LabelFrame(root,text=title1,padx=5,pady=5)
+        frame.grid(row=row,column=column, columnspan=2)
+        button = Button(frame, text = title2,command = lambda: function(column,row,keyword,frame))
+        button.grid(column = column, row = row)
+        button_place = Entry(frame,borderwidth=5,width=50)
+        button_place.grid(row=row,column=column+1)
+        button_place.insert(0, "Use the Browse button to navigate")
+        
+    def write_menu(keyword,inputs):
+        title,row,column,default=inputs
+        start = Entry(root,width=25,borderwidth=5)
+        start.grid(row=row,column=column+1,padx=20,pady=5)
+        start.insert(0, default)
+        placeholder(row,column,title,10,1)
+        temporary[keyword]=start
+        
+    def dropdown():
+        file_ext = StringVar()
+        file_ext.set(".fastq.gz")
+        placeholder(4,0,"Sequencing file extension",20,1)
+        drop = OptionMenu(root, file_ext, ".fastq.gz", ".fastq")
+        drop.grid(column = 1,row = 4)
+        temporary["fastq_extent"]=file_ext
+        
+    def button_click(row, column, title, function):
+        button_ok = Button(root,text=title,padx=12,pady=5, width=15,command=function)
+        button_ok.grid(row=row, column=column,columnspan=1)
+        
+    def placeholder(row, column,title,padx,pady):
+        placeholder = Label(root, text=title)
+        placeholder.grid(row=row,column=column,padx=padx,pady=pady)
+        return placeholder
+        
+    root = Tk()
+    root.title("Crispery Input Parameters Window")
+    root.minsize(400, 475)
+    parameters,temporary = {},{}  
+
+    browsing_inputs = {"seq_files":["Path to the .fastq(.gz) files folder","Browse",1,0,directory],
+                       "sgrna":["Path to the sgRNA .csv file","Browse",2,0,file],
+                       "out":["Path to the output folder","Browse",3,0,directory]}
+
+    default_inputs = {"start":["sgRNA start position in the read",5,0,0],
+                      "length":["sgRNA length",6,0,20],
+                      "miss":["Allowed mismatches",7,0,1],
+                      "phred":["Minimal sgRNA Phred-score",8,0,30],
+                      "cache":["Mismatch cache size in MB (0 = RAM saving mode)",9,0,64]}
+    
+    # Generating the file/folder browsing buttons
+    for arg in browsing_inputs:
+        browsing(arg,browsing_inputs[arg])
+    
+    # Generating the input parameter buttons
+    for arg in default_inputs:
+        write_menu(arg,default_inputs[arg])
+    
+    dropdown()
+    placeholder(0,1,"",0,0)
+    placeholder(10,0,"",0,0)
+    button_click(11, 0, "OK", submit)
+    button_click(11, 1, "Reset", restart)
+
+    root.mainloop()
+
+    return parameters
+
+def initializer(cmd):
+    
+    """ Handles the program initialization process.
+    Makes sure the path separators, and the input parser function is correct
+    for the used OS.
+    Creates the output diretory and handles some parameter parsing.
+    Returns the run options, as a dict named after the input_parser variables"""
+ 
+    version = "1.5"
+    
+    print("\nVersion: {}".format(version))
+    
+    if system() == 'Windows':
+        separator = "\\"
+    else:
+        separator = "/"
+
+    if cmd is None:
+        folder_path, guides, out, start, lenght, mismatch, phred, cache_size, extension = inputs_handler(separator)
+        options = {"folder_path":folder_path, "guides":guides, "out":out, "extension":extension, "mismatch":mismatch, "phred":phred, "start":start, "lenght":lenght, 
+                   "cache_size":cache_size, "unpacking":False, "engine":"fast", "search":"index", "chunk_size":128, "anchor":"", "span":0, 
+                   "paired":False, "guides2":None, "start2":start, "columnar":None, "memory":None, "stores":None, "fresh":False, "sample_name":"stdin", 
+                   "barcodes":None, "barcode_position":"header", "barcode_mismatch":1, "indels":0, "watching":False, "stable":60}
+    else:
+        options = dict(cmd)
+    
+    options.update(extension=f'*{options["extension"]}', mismatch=int(options["mismatch"]), phred=int(options["phred"]), start=int(options["start"]), 
+                   lenght=int(options["lenght"]), cache_size=float(options["cache_size"]), chunk_size=int(options["chunk_size"])*1024*1024, 
+                   anchor=options["anchor"].upper(), span=int(options["span"]), start2=int(options["start2"]), barcode_mismatch=int(options["barcode_mismatch"]),
+                   barcode_position=-1 if options["barcode_position"] == "header" else int(options["barcode_position"]), indels=int(options["indels"]), 
+                   stable=float(options["stable"]))
+    
+    options["quality_set"] = phred_filter(options["phred"])
+    
+    directory = os.path.join(options["out"], "unpacked")
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    if psutil.virtual_memory().percent>=60:
+        print("\nLow RAM availability detected, file processing may be slow\n")
+    
+    print(f"\nRunning with parameters:\n{options['mismatch']} mismatch allowed\n" + (f"{options['indels']} indels allowed\n" if options["indels"] else "") + f"Minimal Phred Score per bp >= {options['phred']}\n")
+    print(f"All data will be saved into {directory}")
+    
+    options.update(directory=directory, version=version, separator=separator)
+    return options
 
 def input_parser():
     
     parser = argparse.ArgumentParser()
     parser.add_argument("-c",nargs='?',const=True,help="cmd line mode")
-    parser.add_argument("--s",help="The full path to the directory with the sequencing files")
-    parser.add_argument("--g",help="The full path to the .csv file with the sgRNAs.")
+    parser.add_argument("--s",help="The full path to the directory with the sequencing files, or - to read one sample (fastq or fastq.gz) from stdin")
+    parser.add_argument("--g",help=f"The full path to the .csv file with the sgRNAs, or to the index file made by build-index ({INDEX_EXTENSION})")
     parser.add_argument("--o",help="The full path to the output directory")
     parser.add_argument("--se",help="Sequencing file extenction (ie:'.fastq.gz')")
     parser.add_argument("--m",help="number of allowed mismatches (default=1)")
     parser.add_argument("--ph",help="Minimal Phred-score (default=30)")
     parser.add_argument("--st",help="guideRNA start position in the read (default is 0==1st bp)")
     parser.add_argument("--l",help="guideRNA length (default=20bp)")
-    parser.add_argument("--r",help="ram saving mode (only appropriate for mismatch searching)")
+    parser.add_argument("--id",choices=["0","1","2"],help="number of allowed insertions/deletions, for the reads left without a match after the mismatch search (default=0, fast engine only)")
+    parser.add_argument("--r",help="size in MB of the mismatch search cache, per worker (default=64, 0 is the RAM saving mode)")
+    parser.add_argument("--u",nargs='?',const=True,help="unpack .gz files to disk before counting (default is to stream them)")
+    parser.add_argument("--e",choices=["fast","python"],help="counting engine (default=fast, falls back to python when the sgRNAs can't be packed)")
+    parser.add_argument("--mm",choices=["index","scan","popcount"],help="mismatch search, precomputed index, all-vs-all scan, or batched XOR/popcount against the whole library (default=index, fast engine only)")
+    parser.add_argument("--ch",help="size in MB of the chunks uncompressed files are split into, for processing them in parallel (default=128, fast engine only)")
+    parser.add_argument("--a",help="constant anchor sequence right before the guideRNA, searched for from --st on (fast engine only)")
+    parser.add_argument("--w",help="number of positions from --st where the anchor, or without an anchor the guideRNAs themselves, are searched for (default=0, guideRNA fixed at --st)")
+    parser.add_argument("--p",nargs='?',const=True,help="paired mode, counts the guideRNA pairs of R1/R2 files (named with _R1 and _R2, fast engine only)")
+    parser.add_argument("--g2",help="The full path to the .csv file with the sgRNAs of R2, in paired mode (default is the --g file)")
+    parser.add_argument("--st2",help="guideRNA start position in R2, in paired mode (default is --st)")
+    parser.add_argument("--co",choices=["npz","parquet"],help="also save the compiled read counts in a binary columnar file, next to compiled.csv (parquet requires pyarrow)")
+    parser.add_argument("--mem",help="memory ceiling in MB, files are only processed in parallel while they fit under it (default=90%% of the available memory)")
+    parser.add_argument("--rc",help="folder where the mismatch search outcomes are kept between runs, shared by all the samples and runs with the same sgRNAs (default=not kept)")
+    parser.add_argument("--bc",help="The full path to a sample barcode sheet (.csv file with the sample names and barcodes), to demultiplex pooled sequencing files while counting")
+    parser.add_argument("--bp",help="barcode position, in the read sequence (0==1st bp), or 'header' for the index at the end of the read header (default=header)")
+    parser.add_argument("--bm",help="number of allowed mismatches in the barcodes (default=1)")
+    parser.add_argument("--sn",help="name of the sample read from stdin (--s -, default=stdin)")
+    parser.add_argument("--wa",nargs='?',const=True,help="watch mode, keeps counting the sequencing files as they are completed in the --s folder, until stopped (Ctrl+C) or a CopyComplete.txt file shows up there")
+    parser.add_argument("--wt",help="in watch mode, seconds a file must stay unchanged to be taken as complete, unless there is a .done file next to it (default=60)")
+    parser.add_argument("--fr",nargs='?',const=True,help="fresh run, processes all the samples again instead of skipping the ones already completed in the output folder")
     args = parser.parse_args()
 
     if args.c is None:
         return None
     
+    if args.s == "-" and args.se is None: # stdin, no files to look for
+        args.se = ".fastq"
+        
     if (args.s is None) or (args.g is None) or (args.o is None) or (args.se is None):
         print(parser.print_usage())
         raise ValueError("\nPlease specify --s,--g,--o, and --se parameters. type -h into cmd for help")
     else:
         folder_path, guides, out, extension = args.s, args.g, args.o, args.se
 
-    ram=False
+    cache_size=64
     if args.r is not None:
-        ram=True
+        try:
+            cache_size=float(args.r)
+        except ValueError:
+            raise ValueError("\n--r is now the size in MB of the mismatch search cache, per worker (0 is the RAM saving mode)") from None
+        if cache_size < 0:
+            raise ValueError("\n--r is now the size in MB of the mismatch search cache, per worker (0 is the RAM saving mode)")
+        
+    unpacking=False
+    if args.u is not None:
+        unpacking=True
+        
+    engine="fast"
+    if args.e is not None:
+        engine=args.e
+        
+    search="index"
+    if args.mm is not None:
+        search=args.mm
+        
+    chunk_size=128
+    if args.ch is not None:
+        chunk_size=args.ch
+        
+    anchor=""
+    if args.a is not None:
+        anchor=args.a
+        if set(anchor.upper()) - set("ACGT"):
+            raise ValueError("\nThe anchor sequence (--a) can only have A, C, G and T")
+    
+    span=0
+    if args.w is not None:
+        span=args.w
         
     lenght=20
     if args.l is not None:
@@ -486,78 +2540,137 @@ def input_parser():
     if args.m is not None:
         mismatch=args.m
 
-    return folder_path, guides, out, extension,mismatch, phred, start, lenght, ram
+    paired=False
+    if args.p is not None:
+        paired=True
+        
+    guides2=args.g2
+        
+    start2=start
+    if args.st2 is not None:
+        start2=args.st2
+        
+    columnar=args.co
+    
+    memory=None
+    if args.mem is not None:
+        memory=float(args.mem)
+        
+    stores=args.rc
+    
+    fresh=False
+    if args.fr is not None:
+        fresh=True
+        
+    sample_name="stdin"
+    if args.sn is not None:
+        sample_name=args.sn
+        
+    barcodes=args.bc
+    
+    barcode_position="header"
+    if args.bp is not None:
+        barcode_position=args.bp
+        
+    barcode_mismatch=1
+    if args.bm is not None:
+        barcode_mismatch=args.bm
+        
+    indels=0
+    if args.id is not None:
+        indels=args.id
+        
+    watching=False
+    if args.wa is not None:
+        watching=True
+        
+    stable=60
+    if args.wt is not None:
+        stable=args.wt
+
+    return {"folder_path":folder_path, "guides":guides, "out":out, "extension":extension, "mismatch":mismatch, "phred":phred, "start":start, "lenght":lenght, 
+            "cache_size":cache_size, "unpacking":unpacking, "engine":engine, "search":search, "chunk_size":chunk_size, "anchor":anchor, "span":span, 
+            "paired":paired, "guides2":guides2, "start2":start2, "columnar":columnar, "memory":memory, "stores":stores, "fresh":fresh, "sample_name":sample_name, 
+            "barcodes":barcodes, "barcode_position":barcode_position, "barcode_mismatch":barcode_mismatch, "indels":indels, "watching":watching, "stable":stable}
 
 
-def compiling(directory,phred,mismatch,version,separator):
-    
-    """ Combines all the individual processed .csv files into one final file.
-    Gathers the individual sample statistic and parses it into "run_stats" """
+def compiling(results, library, directory, phred, mismatch, version, separator, columnar):
     
-    ordered_csv = path_finder_seq(directory, '*reads.csv',separator)
+    """ Combines the read counts of all the processed samples (see "multi") 
+    into one final file, by stacking their count vectors into one matrix 
+    (sgRNAs x samples). Passes the sample statistics on to "run_stats".
+    The matrix can also be saved in a columnar format ("npz" or "parquet"),
+    next to the compiled.csv file """
     
     headers = [f"#Crispery version: {version}"] + \
             [f"#Mismatch: {mismatch}"] + \
             [f"#Phred Score: {phred}"]
-            
-    compiled = {} #dictionary with all the reads per sgRNA
+    
     head = ["#sgRNA"] #name of the samples
-    for name, file in ordered_csv:
-        head.append(name[name.find(separator)+len(separator):name.find(".csv")])
-        with open(file) as current:
-            for line in current:
-                line = line[:-1].split(",")
-                if "#" not in line[0]:
-                    if line[0] in compiled:
-                        compiled[line[0]] = compiled[line[0]] + [int(line[1])]
-                    else:
-                        compiled[line[0]] = [int(line[1])]
-                        
-                elif "#sgRNA" not in line[0]:
-                    headers.append(line[0][1:]+"\n")
-  
-    path = ordered_csv[0][1]
-    out_file = path[:-path[::-1].find(separator)-1]
+    for out, stats, counts in results:
+        name = os.path.basename(reads_file(out))
+        head.append(name[:-len(".csv")])
     
-    run_stats(headers,out_file,separator)
-                        
-    final = []
-    for sgrna in compiled:
-        final.append([sgrna] + compiled[sgrna])
-        
-    final.insert(0, head)
+    matrix = np.column_stack([counts for out, stats, counts in results]) #all the reads per sgRNA
+    order = np.argsort(library.names, kind="stable") #alphabetical sorting
+    names, matrix = library.names[order], matrix[order]
+    
+    out_file = directory
+    
+    run_stats(headers, [stats for out, stats, counts in results], out_file, separator)
+    
+    final = [head]
+    for sgrna, row in zip(names.tolist(), matrix.tolist()):
+        final.append([sgrna] + row)
     
     csvfile = out_file + separator + "compiled.csv"
     csv_writer(csvfile, final)
+    
+    if columnar is not None:
+        columnar_writer(out_file + separator + "compiled", columnar, names, head[1:], matrix)
+
+def columnar_writer(path, columnar, names, samples, matrix):
+    
+    """ saves the compiled read counts in a binary columnar format, so they can
+    be loaded back without parsing the .csv file. "npz" keeps the counts matrix 
+    (sgRNAs x samples) with the sgRNA and sample names, "parquet" (requires 
+    pyarrow) has one "sgRNA" column and one column per sample """
+    
+    if columnar == "npz":
+        np.savez_compressed(path + ".npz", counts=matrix, sgrna=names, samples=np.array(samples))
         
-    input("\nAnalysis successfully completed\nAll the reads have been compiled into the compiled.csv file.\nPress any key to exit")
+    elif columnar == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print("\nWarning!!\nThe parquet output requires the pyarrow package. Only the compiled.csv file was written.\n")
+            return
+        table = pyarrow.table({"sgRNA":names.tolist(), **{sample:matrix[:, i] for i, sample in enumerate(samples)}})
+        pyarrow.parquet.write_table(table, path + ".parquet")
 
-def run_stats(headers, out_file,separator):
+def run_stats(headers, stats, out_file,separator):
     
     """ Manipulates the statistics from all the samples into one file that can
     be used for downstream user quality control aplications. Creates a simple
     bar graph with the number of reads per sample"""
     
-    ### parsing the stats from the read files
     global_stat = [["#Sample name", "Running Time", "Running Time unit", \
                     "Total number of reads in sample", \
                     "Total number of reads that passed quality control parameters", \
                     "Number of reads that were aligned without mismatches", \
                     "Number of reads that were aligned with mismatches"]]
         
+    global_stat += stats
     for run in headers:
-        if "script ran" in run:
-            parsed = run.split()
-            global_stat.append([parsed[7][:-1]] + [parsed[3]] + [parsed[4]] + \
-                               [parsed[12]] + [parsed[8]] + [parsed[16]] + \
-                               [parsed[20]])
-        else:
-            global_stat.insert(0,[run])
+        global_stat.insert(0,[run])
     
     csvfile = out_file + separator + "compiled_stats.csv"
     csv_writer(csvfile, global_stat)
     
     ### plotting
+    import matplotlib.pyplot as plt
+    
     header_ofset = 4
     fig, ax = plt.subplots()
     width = 0.4
@@ -579,54 +2692,943 @@ def run_stats(headers, out_file,separator):
     plt.gcf().subplots_adjust(bottom=0.4)
     
     plt.savefig(f"{out_file}{separator}reads_plot.png", dpi=300)
+    plt.close(fig)
+
+def metrics_writer(directory, separator, metrics, started):
+    
+    """ Writes the "Metrics" of each sample, and of the whole run (all the 
+    samples added up), into the "metrics.json" file """
+    
+    import json
+    
+    run = Metrics()
+    for sample in metrics.values():
+        run.merge(sample)
+    run.wall = time() - started
+    
+    with open(directory + separator + "metrics.json", "w") as output:
+        json.dump({"run":run.summary(), "samples":{name:sample.summary() for name, sample in metrics.items()}}, output, indent=1)
+
+def profile_writer(directory, separator, metrics, phred):
+    
+    """ Writes the "Profile" of the reads of each sample into the 
+    "compiled_profile.csv" file: per position (from the sgRNA start) the number
+    of bases sequenced, their mean and median Phred score, how many pass the
+    Phred-score cutoff, and the base composition. The full count arrays go 
+    into "compiled_profile.npz". Plots the mean Phred scores of each sample,
+    and the base composition of all of them, into "profile_plot.png" """
+    
+    profiles = {name:sample.profile for name, sample in metrics.items() if sample.profile is not None}
+    if not profiles:
+        return
+    
+    rows = [["#Sample name", "Position from the sgRNA start", "Bases sequenced", "Mean Phred score", "Median Phred score", 
+             f"% bases with Phred >= {phred}"] + [f"% {base}" for base in PROFILE_BASES]]
+    scores = np.arange(PROFILE_SCORES)
+    for name, profile in profiles.items():
+        for i, (qualities, bases) in enumerate(zip(profile.qualities.tolist(), profile.bases.tolist())):
+            total = sum(bases)
+            if total == 0: # past the end of the reads
+                continue
+            median = int(np.searchsorted(np.cumsum(qualities), (total + 1) / 2))
+            rows.append([name, i - profile.flank, total, round(float(np.dot(qualities, scores)) / total, 2), median, 
+                         round(100 * sum(qualities[phred:]) / total, 2)] + [round(100 * count / total, 2) for count in bases])
+    csv_writer(directory + separator + "compiled_profile.csv", rows)
+    
+    names = list(profiles)
+    flank = profiles[names[0]].flank
+    positions = np.arange(len(profiles[names[0]].bases)) - flank
+    np.savez_compressed(directory + separator + "compiled_profile.npz", qualities=np.stack([profiles[name].qualities for name in names]), 
+                        bases=np.stack([profiles[name].bases for name in names]), samples=np.array(names), positions=positions, base_names=np.array(PROFILE_BASES))
+    
+    ### plotting
+    import matplotlib.pyplot as plt
+    
+    fig, (top, bottom) = plt.subplots(2, 1, sharex=True, figsize=(8, 7))
+    for name in names:
+        profile = profiles[name]
+        covered = profile.bases.sum(axis=1)
+        top.plot(positions, np.where(covered > 0, profile.qualities @ scores / np.maximum(covered, 1), np.nan), label=name)
+    top.axhline(phred, color="grey", linestyle="--", linewidth=1)
+    top.set_ylabel('Mean Phred score')
+    
+    bases = sum(profiles[name].bases for name in names)
+    covered = np.maximum(bases.sum(axis=1), 1)
+    for j, base in enumerate(PROFILE_BASES[:5]):
+        bottom.plot(positions, 100 * bases[:, j] / covered, label=base)
+    bottom.set_ylabel('% of the bases (all samples)')
+    bottom.set_xlabel('Position from the sgRNA start')
+    
+    for ax in (top, bottom):
+        ax.axvspan(-0.5, len(positions) - 2 * flank - 0.5, color="lightgrey", alpha=0.4)
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+    if len(names) <= 12:
+        top.legend(loc='center left', bbox_to_anchor=(1, 0.5), prop={'size': 8})
+    bottom.legend(loc='center left', bbox_to_anchor=(1, 0.5), prop={'size': 8})
+    
+    plt.gcf().subplots_adjust(right=0.8)
+    plt.savefig(f"{directory}{separator}profile_plot.png", dpi=300)
+    plt.close(fig)
+
+def outputs_writer(results, metrics, library, directory, separator, version, params, columnar, started):
+    
+    """ writes everything that sums up the samples of a run: the partial count
+    file (to be added up with other runs by "merge", for example one run per
+    machine), compiled.csv and the run statistics (see "compiling"), the 
+    timings per processing stage and the read counters of each sample and of 
+    the whole run (see "metrics_writer"), and the per position Phred scores and
+    base composition of the reads of each sample (see "profile_writer") """
+    
+    metrics = dict(metrics)
+    partial_writer(directory + separator + PARTIAL_FILE, library, version, params, results, metrics)
+    
+    tempo = time()
+    compiling(results, library, directory, params["phred"], params["mismatch"], version, separator, columnar)
+    metrics["compiled"] = Metrics()
+    metrics["compiled"].add("output", tempo)
+    
+    metrics_writer(directory, separator, metrics, started)
+    profile_writer(directory, separator, metrics, params["phred"])
 
-def ram_lock():
+WATCH_INTERVAL = 10 # seconds between two looks at the input folder, in watch mode
+WATCH_DONE = ".done" # marker file next to a sequencing file ("sample.fastq.gz.done") telling it is complete
+WATCH_END = "CopyComplete.txt" # marker file in the input folder telling no more files will come
+
+def watch_files(folder_path, extension, separator, sizes, stable):
+    
+    """ the sequencing files of the input folder that are complete: with a 
+    WATCH_DONE marker next to them, or with the same size as on the previous 
+    look ("sizes") and not modified for "stable" seconds """
+    
+    complete = []
+    for filename in sorted(glob.glob(os.path.join(folder_path, extension))):
+        info = os.stat(filename)
+        unchanged = sizes.get(filename, info.st_size) == info.st_size
+        sizes[filename] = info.st_size
+        if os.path.isfile(filename + WATCH_DONE) or (unchanged and (time() - info.st_mtime >= stable)):
+            stop = filename[::-1].find(separator) + 1
+            complete.append([filename[-stop:], filename])
+    return complete
+
+def watch(options, library, keys, index, locator, manifest, edits, params, started):
+    
+    """ the watch mode, for counting while the sequencer (or the data 
+    transfer) is still writing the files. The workers are started once, with
+    the library and mismatch index, and the input folder is looked at every
+    WATCH_INTERVAL seconds. The chunks of the files that are complete (see 
+    "watch_files") are handed to the workers right away, and their results 
+    are added up as they come back (see "SampleTally"), so the files found 
+    while others are being counted don't wait for them. compiled.csv and the
+    run statistics are updated whenever a sample is done. Files already 
+    counted, in this run or (through the "Manifest") in a previous one, are 
+    never counted again. Runs until stopped with Ctrl+C, or until a WATCH_END
+    file shows up in the folder and every file is counted. Returns the same 
+    as "multi" """
+    
+    folder_path, extension, separator, directory = options["folder_path"], options["extension"], options["separator"], options["directory"]
+    mismatch, cache_size = options["mismatch"], options["cache_size"]
+    need = task_memory(extension[1:], len(library), mismatch, keys is not None) + (cache_size if mismatch != 0 else 0)
+    workers = start_workers(worker_shared(options, library, index, manifest), library_arrays(library, keys, index, locator, edits=edits), directory, options["memory"], need)
+    
+    print(f"\nWatching {folder_path} for {extension[1:]} files. Stop with Ctrl+C, or with a {WATCH_END} file in the folder")
+    tally, done, counted, sizes, pending = SampleTally(library, separator, manifest), queue.Queue(), set(), {}, 0
+    try:
+        while True:
+            ending = os.path.isfile(os.path.join(folder_path, WATCH_END))
+            new = [entry for entry in watch_files(folder_path, extension, separator, sizes, 0 if ending else options["stable"]) if entry[1] not in counted]
+            if new:
+                counted.update(raw for name, raw in new)
+                files, write_path_save = input_file_type(new, extension, directory, options["unpacking"])
+                for task in tally.register(files, write_path_save, chunk_tasks(files, options["chunk_size"], keys)):
+                    workers[0].apply_async(aligner, (task,), callback=done.put, error_callback=done.put)
+                    pending += 1
+            elif ending and not pending:
+                break
+            
+            deadline, updated = time() + WATCH_INTERVAL, False
+            while pending and (time() < deadline):
+                try:
+                    result = done.get(timeout=deadline - time())
+                except queue.Empty:
+                    break
+                pending -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                updated = tally.add(result) or updated
+                if updated and (done.empty() or (time() >= deadline)):
+                    outputs_writer(*tally.collect(), library, directory, separator, options["version"], params, options["columnar"], started)
+                    print(f"\n{len(tally.results)} samples counted so far, compiled.csv updated")
+                    updated = False
+            if not (pending or ending):
+                sleep(max(0, deadline - time()))
+    except KeyboardInterrupt:
+        print("\nStopped watching. The files being counted will be resumed by the next run")
+        workers[0].terminate()
+    finally:
+        stop_workers(*workers)
+    
+    return tally.collect()
 
-    """ stalls the program until more RAM is available from finishing the 
-    processing of other files """
+def stats_seconds(stats):
     
-    if psutil.virtual_memory().percent >= 98:
-        print("\nSub-optimal RAM allocation detected. Please consider running the program in 'RAM saving mode'\n")
+    """ the running time of a sample, in seconds, back from its statistics """
     
-    while psutil.virtual_memory().percent >= 98:
-        pass
-    return True
+    return float(stats[1]) * (60 if stats[2] == "minutes" else 1)
 
-def cpu_counter():
+def partial_writer(path, library, version, params, results, metrics):
+    
+    """ Saves the outcome of a run into a partial count file, so that runs over
+    different shards of the sequencing files (on other machines, or at other 
+    times) can be added up by "merge". It's an index file (see "index_writer")
+    with the read counts matrix (samples x sgRNAs, by sgRNA ID), and the 
+    library fingerprint, run parameters, sample statistics and "Metrics" in 
+    its header """
+    
+    samples = [{"name":stats[0], "reads":int(stats[3]), "perfect":int(stats[5]), "imperfect":int(stats[6]), "seconds":stats_seconds(stats)}
+               for out, stats, counts in results]
+    meta = {"kind":"partial", "format":PARTIAL_FORMAT, "version":version, "library":library.fingerprint(), "size":len(library),
+            "params":params, "samples":samples, "metrics":{name:sample.summary() for name, sample in metrics.items() if name != "compiled"}}
+    matrix = np.zeros((len(results), len(library)), dtype=np.uint64)
+    for row, (out, stats, counts) in zip(matrix, results):
+        row += counts.astype(np.uint64)
+    index_writer(path, {"counts":matrix}, meta)
+
+def partial_reader(path):
     
-    """ counts the available cpu cores, required for spliting the processing
-    of the files """
+    """ loads a partial count file written by "partial_writer". Returns the
+    read counts matrix and the header """
     
-    cpu = multiprocessing.cpu_count()
-    if cpu >= 2:
-        cpu -= 1
-    pool = multiprocessing.Pool(processes = cpu)
+    if not os.path.isfile(path):
+        input(f"\nCheck the path to the partial count file.\nNo file found in the following path: {path}\nPress any key to exit")
+        raise Exception
+    arrays, meta = index_reader(path)
+    if (meta.get("kind") != "partial") or (meta.get("format") != PARTIAL_FORMAT):
+        input(f"\n{path} is not a partial count file made by this version of Crispery.\nPress any key to exit")
+        raise Exception
+    return np.array(arrays["counts"]), meta
+
+def merge(partials, guides, out, columnar):
+    
+    """ the merge step: adds up any number of partial count files, in any
+    order, into the final compiled.csv and compiled_stats.csv files, as if all
+    the shards had been counted in one run. Samples with the same name in 
+    different partial files (for example the same sample, split into shards)
+    are added up. The files must have been counted with the same sgRNAs (--g,
+    checked through the library fingerprint) and parameters. The merged counts
+    are saved as a partial count file too, so merges can be merged again """
+    
+    started = time()
+    separator = "\\" if system() == 'Windows' else "/"
+    directory = os.path.join(out, "unpacked")
+    if not os.path.exists(directory):
+        os.makedirs(directory)
     
-    return pool
+    partials = [os.path.join(path, "unpacked", PARTIAL_FILE) if os.path.isdir(path) else path for path in partials]
+    library = library_loader(guides, 20, 0, "python", "scan")[0]
+    fingerprint = library.fingerprint()
+    
+    totals, samples, metrics, params, versions = {}, {}, {}, None, set()
+    for path in partials:
+        counts, meta = partial_reader(path)
+        if meta["library"] != fingerprint:
+            input(f"\n{path} was counted with other sgRNAs than {guides}.\nPress any key to exit")
+            raise Exception
+        if params is None:
+            params = meta["params"]
+        elif meta["params"] != params:
+            input(f"\n{path} was counted with other parameters ({meta['params']}) than {partials[0]} ({params}).\nPress any key to exit")
+            raise Exception
+        versions.add(meta["version"])
+        
+        for row, sample in zip(counts, meta["samples"]):
+            name = sample["name"]
+            if name not in totals:
+                totals[name], samples[name] = library.new_counts(), dict.fromkeys(["reads", "perfect", "imperfect", "seconds"], 0)
+            totals[name] += row
+            for field in samples[name]:
+                samples[name][field] += sample[field]
+        for name, summary in meta["metrics"].items():
+            metrics.setdefault(name, Metrics()).merge(Metrics.from_summary(summary))
+    
+    results = []
+    for name in sorted(totals):
+        sample = samples[name]
+        path = directory + separator + name + ".fastq"
+        results.append((path, sample_stats(path, separator, sample["reads"], sample["perfect"], sample["imperfect"], sample["seconds"]), totals[name]))
+    
+    version = "/".join(sorted(versions))
+    tempo = time()
+    compiling(results, library, directory, params["phred"], params["mismatch"], version, separator, columnar)
+    partial_writer(directory + separator + PARTIAL_FILE, library, version, params, results, metrics)
+    metrics["compiled"] = Metrics()
+    metrics["compiled"].add("output", tempo)
+    metrics_writer(directory, separator, metrics, started)
+    
+    print(f"\nMerged {len(partials)} partial count files, {len(results)} samples, into {directory}")
+
+CHECKPOINT_INTERVAL = 60 # seconds between the checkpoints of a file being counted
+
+def file_fingerprint(raw):
+    
+    """ size, modification time and a hash of the first MB of a file. Enough 
+    to tell whether it changed, without reading all of it """
+    
+    import hashlib
+    
+    info = os.stat(raw)
+    with open(raw, "rb") as f:
+        head = hashlib.sha1(f.read(1024*1024)).hexdigest()
+    return {"size":info.st_size, "mtime":info.st_mtime_ns, "head":head}
+
+def checkpoint_path(folder, key, byte_range):
+    
+    """ checkpoint file of one file (or chunk, see "chunk_tasks") of a sample """
+    
+    if byte_range is None:
+        return os.path.join(folder, f"{key}.npz")
+    return os.path.join(folder, f"{key}_{byte_range[0]}_{byte_range[1]}.npz")
+
+def checkpoint_writer(path, position, counts, reads, perfect_counter, imperfect_counter, metrics):
+    
+    """ saves how far a file was counted (byte offset, from the start of its
+    chunk, in the decompressed data for .gz files), its counts and its
+    "Metrics" so far. The previous checkpoint is only replaced once the new
+    one is complete """
+    
+    import json
+    
+    profile = metrics.profile.arrays() if metrics.profile is not None else {}
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, position=position, counts=counts, counters=np.array([reads, perfect_counter, imperfect_counter], dtype=np.int64),
+                 metrics=json.dumps(metrics.summary()), **profile)
+    os.replace(path + ".tmp", path)
+
+class Manifest:
+    
+    """ Keeps track of the samples of a run, in the "manifest.json" file of the
+    output folder: the fingerprint of each input file, the run parameters, and
+    whether the sample was completed. Each sample gets a key hashed from its 
+    input fingerprint, the parameters and the sgRNAs, and its counts vector is 
+    kept under that key in the "checkpoints" folder, along with the periodic 
+    checkpoints of the files still being counted. When the same output folder 
+    is used again, the samples with the same key are not processed again """
+    
+    def __init__(self, directory, library, params, fresh=False):
+        import hashlib
+        import json
+        
+        self.path = os.path.join(directory, "manifest.json")
+        self.folder = os.path.join(directory, "checkpoints")
+        os.makedirs(self.folder, exist_ok=True)
+        self.params = params
+        self.samples = {}
+        if os.path.isfile(self.path) and not fresh:
+            try:
+                with open(self.path) as f:
+                    self.samples = json.load(f).get("samples", {})
+            except ValueError: # cut short while being written, before the atomic writes
+                pass
+        names = hashlib.sha1("\n".join(library.names.tolist()).encode()).hexdigest()
+        self.digest = json.dumps(params, sort_keys=True) + library.fingerprint() + names
+        
+    def key(self, raw):
+        
+        """ key and fingerprint of an input file, for these parameters """
+        
+        import hashlib
+        import json
+        
+        fingerprint = file_fingerprint(raw)
+        key = hashlib.sha1((self.digest + json.dumps(fingerprint, sort_keys=True)).encode()).hexdigest()[:20]
+        return key, fingerprint
+    
+    def completed(self, name, key):
+        
+        """ the stats, counts vector and "Metrics" (with their "Profile") of a
+        sample already processed from the same input file, with the same
+        parameters. None otherwise """
+    
+        entry = self.samples.get(name)
+        path = os.path.join(self.folder, key + ".npy")
+        if (entry is None) or (entry.get("key") != key) or (entry.get("status") != "completed") or (entry.get("metrics") is None) or not os.path.isfile(path):
+            return None
+        metrics = Metrics.from_summary(entry["metrics"])
+        profile = os.path.join(self.folder, key + ".profile.npz")
+        if os.path.isfile(profile):
+            with np.load(profile) as arrays:
+                metrics.profile = Profile.from_arrays(arrays)
+        return entry["stats"], np.load(path), metrics
+    
+    def update(self, name, raw, key, fingerprint, status, stats=None, counts=None, metrics=None):
+        if counts is not None:
+            path = os.path.join(self.folder, key + ".npy")
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, counts)
+            os.replace(path + ".tmp", path)
+            for checkpoint in [checkpoint_path(self.folder, key, None)] + glob.glob(os.path.join(self.folder, key + "_*.npz")):
+                if os.path.isfile(checkpoint):
+                    os.remove(checkpoint)
+        if (metrics is not None) and (metrics.profile is not None):
+            path = os.path.join(self.folder, key + ".profile.npz")
+            with open(path + ".tmp", "wb") as f:
+                np.savez(f, **metrics.profile.arrays())
+            os.replace(path + ".tmp", path)
+        self.samples[name] = {"input":raw, "fingerprint":fingerprint, "key":key, "status":status, "stats":stats,
+                              "metrics":metrics.summary() if metrics is not None else None}
+        self.save()
+        
+    def save(self):
+        import json
+        
+        with open(self.path + ".tmp", "w") as output:
+            json.dump({"params":self.params, "samples":self.samples}, output, indent=1, default=int)
+        os.replace(self.path + ".tmp", self.path)
+
+WORKER_MEMORY = 200 # MB, python, numpy and numba in each worker process
+
+def task_memory(raw, library_size, mismatch, fast, window=16):
+    
+    """ estimated working set (MB) of counting one file (or chunk), without 
+    the mismatch cache, for the "MemoryScheduler" """
+    
+    if fast:
+        need = 3 * window + 48 # byte buffers, and the per read arrays of the "ReadResolver"
+        if raw.endswith(".gz"):
+            need += 8 * window # blocks queued by the "DecompressReader"
+            need += 2 * DECOMPRESS_THREADS * window if DECOMPRESS_THREADS > 1 else 0 # and the ones being decompressed in parallel
+    else:
+        need = 16 + (library_size * 160 / 1024 / 1024 if mismatch != 0 else 0) # the "binary_converter" sgRNAs
+    return need + library_size * 200 / 1024 / 1024 # counts vectors and sgRNA hash
+
+class MemoryScheduler:
+    
+    """ Admits the counting tasks into the workers only when their estimated 
+    working set (see "task_memory") fits under the memory ceiling (MB), and
+    in the available system memory. Workers waiting for memory are blocked 
+    on a shared condition until a running task is done. A task is always 
+    admitted when nothing else is running, so too small a ceiling can't 
+    stall the run. The mismatch cache gets whatever memory is left, up to the
+    requested size: it shrinks down to 0 (RAM saving mode) when memory is short """
+    
+    def __init__(self, ceiling):
+        self.ceiling = ceiling
+        self.free = multiprocessing.Value("d", ceiling)
+        self.condition = multiprocessing.Condition(self.free.get_lock())
+        
+    def admit(self, need, cache):
+        
+        """ blocks until "need" MB can be used, and returns the cache size (MB) 
+        granted. Both must be given back through "release" """
+        
+        warned = False
+        with self.condition:
+            while True:
+                available = psutil.virtual_memory().available / 1024 / 1024
+                if (self.free.value >= self.ceiling) or ((need <= self.free.value) and (need <= available)):
+                    break
+                if not warned:
+                    print("\nWaiting for memory to be freed by the other files. Please consider running the program with a smaller mismatch cache (--r), or a higher memory ceiling (--mem)\n")
+                    warned = True
+                self.condition.wait(timeout=1) # re-checks the system memory every second
+                
+            granted = max(0, min(cache, self.free.value - need, available - need))
+            if granted < 1:
+                granted = 0
+            if granted < cache:
+                print(f"\nLow RAM availability, running with a {round(granted, 1)}MB mismatch cache instead of {cache}MB\n")
+            self.free.value -= need + granted
+        return granted
+    
+    def release(self, amount):
+        with self.condition:
+            self.free.value += amount
+            self.condition.notify_all()
+    
+    @contextmanager
+    def admitted(self, need, cache):
+        
+        """ "admit" and "release" around one counting task, yields the cache
+        size granted """
+        
+        granted = self.admit(need, cache)
+        try:
+            yield granted
+        finally:
+            self.release(need + granted)
+            
+    def workers(self, need):
+        
+        """ number of workers whose tasks (of "need" MB each) fit under the 
+        ceiling, from 1 up to the available cpu cores minus one """
+        
+        cpu = multiprocessing.cpu_count()
+        if cpu >= 2:
+            cpu -= 1
+        return max(1, min(cpu, int(self.ceiling // (WORKER_MEMORY + need))))
+
+def memory_ceiling(memory, arrays):
+    
+    """ the memory ceiling (MB) for the counting tasks: the --mem parameter, 
+    by default 90% of the available memory, minus the sgRNA library and 
+    mismatch index arrays shared by all the workers """
+    
+    if memory is None:
+        memory = psutil.virtual_memory().available / 1024 / 1024 * 0.9
+    shared = sum(array.nbytes for array in arrays.values()) / 1024 / 1024
+    return max(float(memory) - shared, 0)
 
-def multi(files,guides, write_path_save, quality_set,mismatch,sgrna,version,separator, start, lenght, ram):
+def cpu_counter(shared, folder, progress, scheduler, need, tasks=None):
+    
+    """ starts the worker processes, required for spliting the processing
+    of the files. There are as many workers as available cpu cores (minus one), 
+    unless the memory ceiling of the "scheduler" only fits fewer tasks of 
+    "need" MB, or there are fewer "tasks" than that (every worker costs a
+    process start and the imports). The workers live for the whole run, and 
+    take the files and chunks one after another from the same work queue.
+    The run parameters are handed to each worker once, when it
+    starts, instead of with every chunk. The sgRNA library and the mismatch 
+    index are not pickled at all: the workers memory-map them from "folder".
+    The workers add the reads they process to the shared "progress" counter
+    (see "ProgressReporter") """
+    
+    cpu = scheduler.workers(need)
+    if cpu < multiprocessing.cpu_count() - 1:
+        print(f"\nRunning {cpu} files at a time, to stay under the memory ceiling of {round(scheduler.ceiling)}MB\n")
+    if tasks is not None:
+        cpu = max(1, min(cpu, tasks))
+    shared["threads"] = max(1, multiprocessing.cpu_count() // cpu)
+    pool = multiprocessing.Pool(processes = cpu, initializer = worker_setup, initargs = (shared, folder, progress, scheduler))
     
-    """ starts and handles the parallel processing of all the samples by calling 
-    multiple instances of the "aligner" function (one per sample) """
+    return pool
+
+class ProgressReporter(threading.Thread):
+    
+    """ Prints the number of reads processed so far by all the workers, and 
+    the current reads/s, every "interval" seconds while the files are being 
+    processed. The workers add to the shared "counter" (see "progress_update") """
+    
+    def __init__(self, interval=30):
+        super().__init__(daemon=True)
+        self.counter = multiprocessing.Value("q", 0)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.started = time()
+        
+    def run(self):
+        last, tempo = 0, time()
+        while not self.stopped.wait(self.interval):
+            reads, now = self.counter.value, time()
+            print(f"{reads} reads processed ({round((reads - last) / (now - tempo))} reads/s)")
+            last, tempo = reads, now
+            
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def progress_update(progress, reads):
+    if progress is not None:
+        with progress.get_lock():
+            progress.value += reads
+
+def worker_setup(shared, folder, progress=None, scheduler=None):
+    
+    """ runs once in each worker process, see "cpu_counter" """
+    
+    global WORKER
+    WORKER = dict(shared)
+    WORKER["progress"], WORKER["scheduler"] = progress, scheduler
+    arrays = load_arrays(folder)
+    WORKER.update(library_state(arrays, shared["index_kind"]))
+    WORKER["store"] = ResolutionStore(shared["store"]) if shared.get("store") else None
+    if shared["index_kind"] == "popcount": # the only multithreaded kernel, sharing the cores with the other workers
+        set_num_threads(shared["threads"])
+    if "r2_names" in arrays: # paired mode with a second library
+        WORKER["r2"] = library_state(arrays, shared["r2_index_kind"], "r2_")
+        WORKER["r2"]["store"] = ResolutionStore(shared["r2_store"]) if shared.get("r2_store") else None
+    else:
+        WORKER["r2"] = dict(WORKER, locator=None)
+
+def library_arrays(library, keys, index, locator, prefix="", edits=None):
+    
+    """ everything the workers need about one sgRNA library, as named arrays
+    for "save_arrays" """
+    
+    arrays = {prefix + name:array for name, array in library.arrays().items()}
+    if keys is not None:
+        arrays[prefix + "keys"] = keys
+        arrays.update({prefix + name:array for name, array in (locator or {}).items()})
+    for i, array in enumerate(index[1:] if index is not None else []):
+        arrays[f"{prefix}index_{i}"] = array
+    for name, array in zip(EDIT_ARRAYS, edits or []):
+        arrays[prefix + name] = array
+    return arrays
+
+def library_state(arrays, index_kind, prefix=""):
+    
+    """ rebuilds, in the workers, what "library_arrays" saved """
+    
+    state = {"library":Library.from_arrays(arrays, prefix), "keys":arrays.get(prefix + "keys"), "index":None,
+             "locator":{name:arrays[prefix + name] for name in ["anchor", "automaton", "outputs"] if prefix + name in arrays} or None}
+    if index_kind is not None:
+        size = 0
+        while f"{prefix}index_{size}" in arrays:
+            size += 1
+        state["index"] = (index_kind,) + tuple(arrays[f"{prefix}index_{i}"] for i in range(size))
+    state["edits"] = tuple(arrays[prefix + name] for name in EDIT_ARRAYS) if prefix + EDIT_ARRAYS[0] in arrays else None
+    return state
+
+def record_boundary(mm, pos):
+    
+    """ finds the start of the first fastq record at or after "pos". 
+    A record starts on a line begining with "@" that is followed, 2 lines 
+    later, by a line begining with "+" (a quality line might start with "@",
+    but it is never followed by a "+" line 2 lines later)"""
+    
+    size = len(mm)
+    if pos == 0:
+        return 0
+    line = mm.find(b"\n", pos - 1) + 1
+    while 0 < line < size:
+        seq = mm.find(b"\n", line) + 1
+        plus = mm.find(b"\n", seq) + 1 if seq else 0
+        if not plus:
+            break
+        if (mm[line:line+1] == b"@") and (mm[plus:plus+1] == b"+"):
+            return line
+        line = seq
+    return size
 
-    pool = cpu_counter()
-    for i, (name, out) in enumerate(zip(files, write_path_save)):
-        pool.apply_async(aligner, args=(name, guides, out, quality_set,mismatch,i,len(files),sgrna,version,separator, start, lenght, ram))
+def chunk_tasks(files, chunk_size, keys):
+    
+    """ splits the uncompressed sequencing files into record aligned byte 
+    ranges of about "chunk_size" bytes, so that a single big file can be 
+    processed by all the workers at once. Compressed files (and the python 
+    engine) get a single task per file. The tasks are sorted by size, so that 
+    the bigger ones are ran first """
+    
+    import mmap
+    
+    tasks = []
+    for i, raw in enumerate(files):
+        size = os.path.getsize(raw)
+        if raw.endswith(".gz") or (keys is None) or (size <= chunk_size):
+            tasks.append((size, [i, len(files), raw, None]))
+            continue
         
+        with open(raw, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            bounds = sorted(set(record_boundary(mm, pos) for pos in range(0, size, chunk_size)) | {size})
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            tasks.append((last - first, [i, len(files), raw, (first, last)]))
+    
+    chunks = {}
+    for size, task in tasks:
+        chunks[task[0]] = chunks.get(task[0], 0) + 1
+    
+    ordered, numbering = [], {}
+    for size, task in sorted(tasks, key=lambda e: e[0], reverse=True):
+        numbering[task[0]] = numbering.get(task[0], -1) + 1
+        ordered.append(tuple(task + [numbering[task[0]], chunks[task[0]]]))
+    
+    return ordered
+
+def worker_shared(options, library, index, manifest=None):
+    
+    """ the run parameters handed to each "aligner" worker when it starts """
+    
+    shared = {name:options[name] for name in ["quality_set", "mismatch", "cache_size", "start", "lenght", "span"]}
+    shared.update(index_kind=index[0] if index is not None else None, store=open_store(options["stores"], library, options["lenght"], options["mismatch"]),
+                  checkpoints=manifest.folder if manifest is not None else None)
+    return shared
+
+def start_workers(shared, arrays, directory, memory, need, tasks=None):
+    
+    """ saves the library "arrays" for the workers, and starts them (see 
+    "cpu_counter") along with the "ProgressReporter" """
+    
+    import tempfile
+    
+    folder = tempfile.mkdtemp(prefix="library_", dir=directory)
+    save_arrays(folder, arrays)
+    scheduler = MemoryScheduler(memory_ceiling(memory, arrays))
+    reporter = ProgressReporter()
+    reporter.start()
+    return cpu_counter(shared, folder, reporter.counter, scheduler, need, tasks), folder, reporter
+
+def stop_workers(pool, folder, reporter):
     pool.close()
     pool.join()
+    reporter.stop()
+    shutil.rmtree(folder, ignore_errors=True)
+
+class SampleTally:
+    
+    """ adds up the chunk results of the "aligner" workers per file, and 
+    writes each sample out as soon as all of its chunks are done. With a 
+    "Manifest", the samples completed by a previous run are taken from it 
+    instead of being counted, and the others are marked pending, then 
+    completed. Files are numbered in the order they are "register"ed, so new
+    files can keep coming (see "watch") """
+    
+    def __init__(self, library, separator, manifest=None):
+        self.library, self.separator, self.manifest = library, separator, manifest
+        self.outputs, self.entries, self.totals, self.remaining = [], {}, {}, {}
+        self.results, self.metrics = {}, {}
+        
+    def register(self, files, write_path_save, tasks):
+        
+        """ adds the "files" (with their "chunk_tasks"), and returns the 
+        "aligner" tasks of the ones that still have to be counted """
+        
+        offset, skipped = len(self.outputs), 0
+        self.outputs += write_path_save
+        for i, raw in enumerate(files, offset):
+            if self.manifest is None:
+                continue
+            out = self.outputs[i]
+            name = os.path.basename(reads_file(out))
+            key, fingerprint = self.manifest.key(raw)
+            done = self.manifest.completed(name, key) if os.path.isfile(reads_file(out)) else None
+            if done is not None:
+                self.results[i], self.metrics[i] = (out, done[0], done[1]), done[2]
+                skipped += 1
+                continue
+            self.entries[i] = (name, raw, key, fingerprint)
+            self.manifest.update(name, raw, key, fingerprint, "pending")
+        if skipped:
+            print(f"\n{skipped} samples were already processed by a previous run, and will not be processed again")
+        
+        registered = []
+        for task in tasks:
+            i = offset + task[0]
+            if i not in self.results:
+                self.remaining[i] = task[5]
+                registered.append((i, len(self.outputs)) + task[2:] + (self.entries[i][2] if i in self.entries else None,))
+        return registered
+    
+    def add(self, result):
+        
+        """ adds up the result of one chunk, returns True when its sample is 
+        done (and written out) """
+        
+        i, started, finished, reads, perfect_counter, imperfect_counter, counts, chunk_metrics = result
+        if i not in self.totals:
+            self.totals[i] = [started, finished, 0, 0, 0, self.library.new_counts()]
+            self.metrics[i] = Metrics()
+        self.metrics[i].merge(chunk_metrics)
+        total = self.totals[i]
+        total[0], total[1] = min(total[0], started), max(total[1], finished)
+        total[2] += reads
+        total[3] += perfect_counter
+        total[4] += imperfect_counter
+        total[5] += counts
+        
+        self.remaining[i] -= 1
+        if self.remaining[i] != 0:
+            return False
+        tempo = time()
+        stats = sample_writer(self.outputs[i], self.separator, self.library, total[5], total[2], total[3], total[4], total[1] - total[0])
+        self.metrics[i].add("output", tempo)
+        self.metrics[i].wall = total[1] - total[0]
+        self.results[i] = (self.outputs[i], stats, total[5])
+        if self.manifest is not None:
+            self.manifest.update(*self.entries[i], "completed", stats, total[5], self.metrics[i])
+        del self.totals[i]
+        return True
+    
+    def collect(self):
+        
+        """ the statistics and read counts vector of each sample done so far, 
+        for "compiling", and their "Metrics", by sample name """
+        
+        ordered = sorted(self.results, key=lambda i: os.path.basename(reads_file(self.outputs[i])))
+        return [self.results[i] for i in ordered], {self.results[i][1][0]:self.metrics[i] for i in ordered}
+
+def multi(files, write_path_save, options, library, keys, index, locator, manifest=None, edits=None):
+    
+    """ starts and handles the parallel processing of all the samples. 
+    Each file is split into chunks (see "chunk_tasks"), and all the chunks, from
+    all the files, go into one dynamic work queue served by the "aligner" 
+    workers. The chunk counts are added up per file, and each sample is 
+    written out as soon as all of its chunks are done (see "SampleTally"). 
+    Returns the statistics and the read counts vector of each sample, for 
+    "compiling", and the "Metrics" of each sample. "options" are the run 
+    options (see "initializer"). With a --rc folder, the mismatch search 
+    outcomes are kept there between runs (see "ResolutionStore"). With a 
+    "manifest", the samples completed by a previous run are not processed 
+    again, and the files being counted are checkpointed (see "Manifest"). 
+    With "edits", the reads are searched with indels too (see "edit_index") """
+    
+    mismatch, cache_size = options["mismatch"], options["cache_size"]
+    tally = SampleTally(library, options["separator"], manifest)
+    tasks = tally.register(files, write_path_save, chunk_tasks(files, options["chunk_size"], keys))
+    
+    if tasks:
+        need = max(task_memory(raw, len(library), mismatch, keys is not None) for raw in files) + (cache_size if mismatch != 0 else 0)
+        running = start_workers(worker_shared(options, library, index, manifest), library_arrays(library, keys, index, locator, edits=edits), 
+                                os.path.dirname(write_path_save[0]), options["memory"], need, len(tasks))
+        for result in running[0].imap_unordered(aligner, tasks):
+            tally.add(result)
+        stop_workers(*running)
+    
+    return tally.collect()
+
+def pair_files(files, write_path_save):
+    
+    """ pairs up the R1 and R2 files of each sample, for the paired mode.
+    The R2 file has the same name as the R1 file, with "_R2" in place of "_R1" """
+    
+    pairs, outputs = [], []
+    for raw, out in zip(files, write_path_save):
+        name = os.path.basename(raw)
+        if "_R1" not in name:
+            continue
+        where = name.rfind("_R1")
+        partner = os.path.join(os.path.dirname(raw), name[:where] + "_R2" + name[where+len("_R1"):])
+        if partner not in files:
+            print(f"\nWarning!!\nNo R2 file found for {raw}. It will not be processed.\n")
+            continue
+        pairs.append((raw, partner))
+        out_name = os.path.basename(out)
+        outputs.append(os.path.join(os.path.dirname(out), out_name[:out_name.rfind("_R1")] + out_name[out_name.rfind("_R1")+len("_R1"):]))
+    
+    if pairs == []:
+        input("\nNo R1/R2 file pairs found (paired mode expects \"_R1\" and \"_R2\" in the file names).\nPress any key to exit")
+        raise Exception
+    
+    return pairs, outputs
+
+def paired_multi(files, write_path_save, options, libraries):
+    
+    """ Same as "multi", for the paired mode. Each R1/R2 file pair is one 
+    task (the two files can't be split at the same record boundaries). 
+    "libraries" has the library, packed keys, mismatch index and locator for 
+    each read, with None for R2 when both reads use the same library. 
+    Returns the statistics and the guide pair counts of each sample, and the 
+    "Metrics" of each sample """
+    
+    pairs, outputs = pair_files(files, write_path_save)
+    (library1, keys1, index1, locator), second = libraries
+    separator, mismatch, cache_size = options["separator"], options["mismatch"], options["cache_size"]
+    
+    shared = worker_shared(options, library1, index1)
+    shared["start2"] = options["start2"]
+    arrays = library_arrays(library1, keys1, index1, locator)
+    library2 = library1
+    if second is not None:
+        library2, keys2, index2 = second
+        shared["r2_index_kind"] = index2[0] if index2 is not None else None
+        shared["r2_store"] = open_store(options["stores"], library2, options["lenght"], mismatch)
+        arrays.update(library_arrays(library2, keys2, index2, None, "r2_"))
+    
+    tasks = sorted([(i, len(pairs), raw1, raw2) for i, (raw1, raw2) in enumerate(pairs)], key=lambda e: os.path.getsize(e[2]), reverse=True)
+    results, metrics = {}, {}
+    
+    need = max(task_memory(raw1, len(library1), mismatch, True) + task_memory(raw2, len(library2), mismatch, True) for raw1, raw2 in pairs) + PAIRS_MEMORY
+    running = start_workers(shared, arrays, os.path.dirname(write_path_save[0]), options["memory"], need + (2 * cache_size if mismatch != 0 else 0), len(tasks))
+    for i, started, finished, reads, perfect_counter, imperfect_counter, ids1, ids2, counts, metrics[i] in running[0].imap_unordered(paired_aligner, tasks):
+        tempo = time()
+        stats = pairs_writer(outputs[i], separator, library1, library2, (ids1, ids2, counts), reads, perfect_counter, imperfect_counter, finished - started)
+        metrics[i].add("output", tempo)
+        metrics[i].wall = finished - started
+        results[i] = (stats, ids1, ids2, counts)
+    stop_workers(*running)
+    
+    ordered = sorted(results, key=lambda i: outputs[i])
+    return [(outputs[i],) + results[i] for i in ordered], {results[i][0][0]:metrics[i] for i in ordered}, library1, library2
+
+def demux_multi(files, options, library, keys, index, locator, demux, edits=None):
+    
+    """ Same as "multi", for pooled files with the reads of many samples (see
+    "barcodes_loader"). All the files (for example the lanes of a run) and 
+    their chunks go into the same work queue, and their per sample counts are 
+    added up. Each sample of the barcode sheet is then written out like a 
+    regular sample. Returns the statistics and the read counts vector of each
+    sample, for "compiling", and the "Metrics" of each pooled file """
+    
+    directory, separator, mismatch, cache_size = options["directory"], options["separator"], options["mismatch"], options["cache_size"]
+    shared = worker_shared(options, library, index)
+    shared.update(demux=demux, barcode_position=options["barcode_position"])
+    
+    samples = len(demux["names"])
+    reads, perfect_counter, imperfect_counter = np.zeros(samples + 1, dtype=np.int64), np.zeros(samples + 1, dtype=np.int64), np.zeros(samples + 1, dtype=np.int64)
+    counts = np.zeros((samples, len(library)), dtype=np.uint64)
+    started, finished, metrics = time(), time(), {}
+    
+    tasks = chunk_tasks(files, options["chunk_size"], keys)
+    need = max(task_memory(raw, len(library), mismatch, True) for raw in files) + PAIRS_MEMORY + (cache_size if mismatch != 0 else 0)
+    running = start_workers(shared, library_arrays(library, keys, index, locator, edits=edits), directory, options["memory"], need, len(tasks))
+    for i, first, last, chunk_reads, chunk_perfect, chunk_imperfect, chunk_samples, ids, chunk_counts, chunk_metrics in running[0].imap_unordered(demux_aligner, tasks):
+        reads += chunk_reads
+        perfect_counter += chunk_perfect
+        imperfect_counter += chunk_imperfect
+        counts[chunk_samples, ids] += chunk_counts # each (sample, sgRNA) comes once per chunk
+        finished = max(finished, last)
+        metrics.setdefault(os.path.basename(files[i]), Metrics()).merge(chunk_metrics)
+    stop_workers(*running)
+    
+    print(f"\n{reads[-1]} reads out of {reads.sum()} couldn't be assigned to any sample by their barcode\n")
+    results = []
+    for sample, name in sorted(enumerate(demux["names"]), key=lambda e: e[1]):
+        out = directory + separator + name + ".fastq"
+        stats = sample_writer(out, separator, library, counts[sample], int(reads[sample]), int(perfect_counter[sample]), int(imperfect_counter[sample]), finished - started)
+        results.append((out, stats, counts[sample]))
+    for name in metrics:
+        metrics[name].wall = finished - started
+    
+    return sorted(results, key=lambda result: os.path.basename(reads_file(result[0]))), metrics
+
+def paired_compiling(results, library1, library2, directory, phred, mismatch, version, separator):
+    
+    """ Same as "compiling", for the paired mode. Only the guide pairs seen
+    in at least one sample get a row in the "compiled_pairs.csv" file. The same
+    counts are also saved as a sparse matrix (COO arrays) in the 
+    "compiled_pairs.npz" file, with the sgRNA names """
+    
+    headers = [f"#Crispery version: {version}"] + \
+            [f"#Mismatch: {mismatch}"] + \
+            [f"#Phred Score: {phred}"]
+    
+    size2 = len(library2)
+    keys = np.unique(np.concatenate([ids1 * size2 + ids2 for out, stats, ids1, ids2, counts in results]))
+    matrix = np.zeros((len(keys), len(results)), dtype=np.uint64)
+    for sample, (out, stats, ids1, ids2, counts) in enumerate(results):
+        matrix[np.searchsorted(keys, ids1 * size2 + ids2), sample] = counts
+    
+    out_file = directory
+    run_stats(headers, [stats for out, stats, ids1, ids2, counts in results], out_file, separator)
+    
+    samples = [stats[0] for out, stats, ids1, ids2, counts in results]
+    names1, names2 = library1.names[keys // size2], library2.names[keys % size2]
+    final = [["#sgRNA1", "sgRNA2"] + samples]
+    for name1, name2, row in sorted(zip(names1.tolist(), names2.tolist(), matrix.tolist())):
+        final.append([name1, name2] + row)
+    csv_writer(out_file + separator + "compiled_pairs.csv", final)
+    
+    rows, columns = np.nonzero(matrix)
+    np.savez_compressed(out_file + separator + "compiled_pairs.npz", sgrna1=keys[rows] // size2, sgrna2=keys[rows] % size2, 
+                        sample=columns, counts=matrix[rows, columns], sgrna1_names=library1.names, sgrna2_names=library2.names, 
+                        samples=np.array(samples))
 
-def input_file_type(ordered, extension, directory):
+def input_file_type(ordered, extension, directory, unpacking):
 
-    """ funnels the sequencing files to either unzipping, or direct processing,
-    depending on the file extension they have"""
+    """ funnels the sequencing files to either unzipping, streaming, or direct 
+    processing, depending on the file extension they have"""
     
-    if '.gz' in extension:
+    if ('.gz' in extension) and unpacking:
         
         print("\nUnpacking .gz files")
         files = unpack(ordered,directory)
         write_path_save = files
         
+    elif '.gz' in extension:
+        
+        print("\nStreaming .gz files")
+        files,write_path_save = [], []
+        for name, filename in ordered:
+            files.append(filename)
+            write_path_save.append(directory + name[:-len(".gz")])
+        
     else:
         
         files,write_path_save = [], []
@@ -636,30 +3638,435 @@ def input_file_type(ordered, extension, directory):
     
     return files, write_path_save
 
+def stdin_counter(counter, out, separator, block_size=16*1024*1024):
+    
+    """ counts the sample piped into stdin (plain or gzip compressed fastq) 
+    with a "Counter", and writes it out like "multi" does for the files """
+    
+    tempo = time()
+    stream = sys.stdin.buffer
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        stream = gzip.GzipFile(fileobj=stream)
+    
+    print("\nCounting the reads from stdin")
+    reporter = ProgressReporter()
+    reporter.start()
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        reads = counter.reads
+        counter.update(block)
+        progress_update(reporter.counter, counter.reads - reads)
+    reads, perfect_counter, imperfect_counter, counts = counter.result()
+    reporter.stop()
+    
+    started = time()
+    stats = sample_writer(out, separator, counter.library, counts, reads, perfect_counter, imperfect_counter, started - tempo)
+    counter.metrics.add("output", started)
+    counter.metrics.wall = time() - tempo
+    return [(out, stats, counts)], {stats[0]:counter.metrics}
+
+PREVIEW_BLOCK = 256*1024 # bytes of records taken at each position of a file in preview
+PREVIEW_POSITIONS = 64 # positions each uncompressed file is sampled at in preview
+PREVIEW_MIN_READS = 10_000 # reads sampled before the estimates can be taken as converged
+PREVIEW_SCAN = 20_000 # reads the sgRNA start position is scanned on
+
+def whole_records(block):
+    
+    """ the part of a byte block made of whole 4 line records """
+    
+    lines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+    records = len(lines) // 4 * 4
+    return block[:lines[records - 1] + 1] if records else b""
+
+def preview_blocks(raw, block_size=PREVIEW_BLOCK, positions=PREVIEW_POSITIONS):
+    
+    """ yields blocks of whole records from all over an uncompressed file: 
+    from evenly spaced positions, realigned to the next record (see 
+    "record_boundary"), visited in a scrambled order so that the first few 
+    blocks already come from the whole file. A .gz file can't be seeked into,
+    so it is read from the start """
+    
+    import mmap
+    
+    if raw.endswith(".gz"):
+        leftover = b""
+        for block in gzip_blocks(raw, block_size):
+            block = leftover + block
+            records = whole_records(block)
+            leftover = block[len(records):]
+            yield records
+        return
+    
+    with open(raw, "rb") as f:
+        if os.path.getsize(raw) == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            positions = min(positions, max(1, size // block_size))
+            for position in np.random.default_rng(0).permutation(positions):
+                begin = record_boundary(mm, int(position) * size // positions)
+                yield whole_records(mm[begin:begin + block_size] if positions > 1 else mm[:])
+
+def wilson_interval(hits, total, z=1.96):
+    
+    """ 95% confidence interval of a proportion (Wilson score interval) """
+    
+    if total == 0:
+        return 0.0, 1.0
+    rate = hits / total
+    center = (rate + z**2 / (2 * total)) / (1 + z**2 / total)
+    spread = z * np.sqrt(rate * (1 - rate) / total + z**2 / (4 * total**2)) / (1 + z**2 / total)
+    return max(0.0, center - spread), min(1.0, center + spread)
+
+def preview_estimates(counts):
+    
+    """ the read rates estimated from the "Metrics" counters of the sampled 
+    reads, with their confidence intervals """
+    
+    reads = counts["reads"]
+    rates = {"quality fail":counts["phred_fail"] + counts["n_fail"], "no location":counts["no_location"], "exact":counts["exact"],
+             "mismatch":counts["mismatch"] + counts["indel"], "ambiguous":counts["ambiguous"], "no match":counts["no_match"]}
+    return {name:(hits / reads if reads else 0.0,) + wilson_interval(hits, reads) for name, hits in rates.items()}
+
+def offset_scan(sequences, library, lenght):
+    
+    """ number of the sampled reads with a perfect sgRNA match starting at each
+    position of the read """
+    
+    ids = library.ids()
+    hits = np.zeros(max([len(sequence) for sequence in sequences] + [lenght]) - lenght + 1, dtype=np.int64)
+    for sequence in sequences:
+        for offset in range(len(sequence) - lenght + 1):
+            if sequence[offset:offset+lenght] in ids:
+                hits[offset] += 1
+    return hits
+
+def phred_scan(qualities, start, lenght, cutoffs=(20, 25, 30, 35)):
+    
+    """ share of the sampled reads whose sgRNA bases all pass each Phred-score cutoff """
+    
+    lowest = np.array([min(quality[start:start+lenght]) - 33 for quality in qualities if len(quality) >= start + lenght])
+    return {cutoff:float((lowest >= cutoff).mean()) if len(lowest) else 0.0 for cutoff in cutoffs}
+
+def preview(folder_path, guides, extension, start, lenght, mismatch, phred, max_reads, precision):
+    
+    """ the preview step: a quick look at each sequencing file before the full
+    run. Reads are sampled from all over the file (see "preview_blocks") and
+    counted with the run parameters, until the estimated rates (quality fail,
+    exact and mismatch matches, discarded reads) are known within "precision",
+    or "max_reads" were sampled. The sgRNA start position is then scanned 
+    over the first sampled reads, to suggest the best --st, along with the
+    reads passing a few other Phred-score cutoffs """
+    
+    separator = "\\" if system() == 'Windows' else "/"
+    if os.path.isfile(folder_path):
+        files = [folder_path]
+    else:
+        files = [raw for name, raw in path_finder_seq(folder_path, f"*{extension}", separator)]
+    
+    library, keys, index = library_loader(guides, lenght, mismatch, "fast", "index")
+    if keys is None:
+        input("\nThe preview requires sgRNAs that can be packed (see --e).\nPress any key to exit")
+        raise Exception
+    
+    for raw in sorted(files):
+        tempo = time()
+        counter = Counter(library, lenght, start, mismatch, phred, keys=keys, index=index)
+        sequences, qualities, converged = [], [], False
+        estimates = preview_estimates(counter.metrics.counts)
+        for block in preview_blocks(raw):
+            counter.update(block)
+            if len(sequences) < PREVIEW_SCAN:
+                lines = block.decode(errors="replace").split("\n")
+                sequences += [line.upper() for line in lines[1::4]][:PREVIEW_SCAN - len(sequences)]
+                qualities += [np.frombuffer(line.encode(), dtype=np.uint8) for line in lines[3::4]][:PREVIEW_SCAN - len(qualities)]
+            
+            estimates = preview_estimates(counter.metrics.counts)
+            converged = (counter.reads >= PREVIEW_MIN_READS) and all((high - low) / 2 <= precision for rate, low, high in estimates.values())
+            if converged or (counter.reads >= max_reads):
+                break
+        
+        reads = counter.reads
+        print(f"\n{os.path.basename(raw)}: {reads} reads sampled in {round(time() - tempo, 2)} seconds" + 
+              (" (estimates converged)" if converged else " (not converged)" if reads < max_reads else ""))
+        for name, (rate, low, high) in estimates.items():
+            print(f"    {name}: {100*rate:.2f}% (95% CI {100*low:.2f}-{100*high:.2f}%)")
+        if reads == 0:
+            continue
+        
+        hits = offset_scan(sequences, library, lenght)
+        best, current = int(np.argmax(hits)), hits[start] if start < len(hits) else 0
+        print("    perfect matches by sgRNA start (--st), before quality control: " + 
+              ", ".join(f"{offset}: {100*hits[offset]/len(sequences):.2f}%" for offset in np.argsort(-hits, kind="stable")[:3] if hits[offset]))
+        if hits[best] == 0:
+            print("    no perfect sgRNA match at any position, check the sgRNA file (--g) and length (--l)")
+        elif hits[best] > current:
+            print(f"    suggested --st {best} (instead of {start})")
+        else:
+            print(f"    --st {start} looks right")
+        print("    reads passing the Phred-score cutoff (--ph) on the sgRNA bases: " + 
+              ", ".join(f"{cutoff}: {100*rate:.2f}%" for cutoff, rate in phred_scan(qualities, start, lenght).items()))
+
+def exit_prompt(message):
+    
+    """ the final "Press any key to exit", which keeps the window open when 
+    crispery is started by double clicking. Only printed when there is no one 
+    to press it (stdin is a pipe or a file), so that pipelines don't hang """
+    
+    if sys.stdin is not None and sys.stdin.isatty():
+        input(message)
+    else:
+        print(message[:message.rfind("\n")])
+
+def library_loader(guides, lenght, mismatch, engine, search):
+    
+    """ loads the sgRNA "Library", either from the .csv file, or memory-mapped
+    from an index file made by build-index (see "index_builder"). Along with 
+    the packed sgRNAs and the mismatch search index of the fast engine, which
+    are taken from the index file when it was built for the same sgRNA 
+    length and number of mismatches """
+    
+    if not guides.endswith(INDEX_EXTENSION):
+        library = guides_loader(guides)
+        keys = packed_guides(library, lenght) if engine == "fast" else None
+        return library, keys, search_index(keys, lenght, mismatch, search)
+    
+    if not os.path.isfile(guides):
+        input("\nCheck the path to the sgRNA index file.\nNo file found in the following path: {}\nPress any key to exit".format(guides))
+        raise Exception
+    
+    arrays, meta = index_reader(guides)
+    if meta.get("kind") == "partial":
+        input(f"\n{guides} is a partial count file, not a sgRNA index file (see merge).\nPress any key to exit")
+        raise Exception
+    state = library_state(arrays, meta["index_kind"])
+    library, keys, index = state["library"], state["keys"], state["index"]
+    print(f"\nLoaded {len(library)} sgRNAs from {guides}")
+    
+    if meta["lenght"] != lenght:
+        keys, index = packed_guides(library, lenght), None
+    if engine != "fast":
+        keys = None
+    if (keys is None) or (mismatch == 0) or (search != "index"):
+        index = search_index(keys, lenght, mismatch, search)
+    elif (index is None) or (meta["mismatch"] != mismatch):
+        print(f"The index file was built for {meta['lenght']}bp sgRNAs and {meta['mismatch']} mismatches, building the mismatch search index for this run")
+        index = mismatch_index(keys, lenght, mismatch)
+    return library, keys, index
+
+def index_builder(guides, out, lenght, mismatch, search):
+    
+    """ the build-index step: parses the sgRNA .csv file, packs the sgRNAs and 
+    builds the mismatch search index, and saves it all into one index file.
+    Runs given the index file instead of the .csv file (--g) then start 
+    counting straight away """
+    
+    if not out.endswith(INDEX_EXTENSION):
+        out += INDEX_EXTENSION
+    library, keys, index = library_loader(guides, lenght, mismatch, "fast", search)
+    meta = {"lenght":lenght, "mismatch":mismatch if index is not None else 0, "index_kind":index[0] if index is not None else None,
+            "fingerprint":library.fingerprint()}
+    index_writer(out, library_arrays(library, keys, index, None), meta)
+    
+    print(f"\nSaved {len(library)} sgRNAs into {out}")
+    if keys is None:
+        print("These sgRNAs can't be packed (see --e), so the index file only has their names and sequences")
+    return out
+
+def index_parser(argv):
+    
+    parser = argparse.ArgumentParser(prog="crispery build-index", description="saves the sgRNA library, ready to use, into an index file for --g")
+    parser.add_argument("--g",required=True,help="The full path to the .csv file with the sgRNAs.")
+    parser.add_argument("--o",required=True,help=f"The full path to the index file ({INDEX_EXTENSION})")
+    parser.add_argument("--l",help="guideRNA length (default=20bp)")
+    parser.add_argument("--m",help="number of allowed mismatches the index is built for (default=1)")
+    parser.add_argument("--mm",choices=["index","scan"],help="mismatch search the index is built for (default=index)")
+    args = parser.parse_args(argv)
+    
+    lenght=20
+    if args.l is not None:
+        lenght=args.l
+        
+    mismatch=1
+    if args.m is not None:
+        mismatch=args.m
+        
+    search="index"
+    if args.mm is not None:
+        search=args.mm
+    
+    return args.g, args.o, int(lenght), int(mismatch), search
+
+def merge_parser(argv):
+    
+    parser = argparse.ArgumentParser(prog="crispery merge", description="adds up the partial count files of several runs into one compiled.csv file")
+    parser.add_argument("partials",nargs="+",help=f"partial count files ({PARTIAL_FILE}), or the output directories of the runs")
+    parser.add_argument("--g",required=True,help="The full path to the .csv file with the sgRNAs, or to the index file made by build-index")
+    parser.add_argument("--o",required=True,help="The full path to the output directory")
+    parser.add_argument("--co",choices=["npz","parquet"],help="also save the compiled read counts in a binary columnar file, next to compiled.csv (parquet requires pyarrow)")
+    args = parser.parse_args(argv)
+    
+    return args.partials, args.g, args.o, args.co
+
+def preview_parser(argv):
+    
+    parser = argparse.ArgumentParser(prog="crispery preview", description="estimates the read rates of each sequencing file on a sample of its reads, before the full run")
+    parser.add_argument("--s",required=True,help="The full path to the directory with the sequencing files, or to one file")
+    parser.add_argument("--g",required=True,help="The full path to the .csv file with the sgRNAs, or to the index file made by build-index")
+    parser.add_argument("--se",help="Sequencing file extenction (default='.fastq.gz')")
+    parser.add_argument("--st",help="guideRNA start position in the read (default is 0==1st bp)")
+    parser.add_argument("--l",help="guideRNA length (default=20bp)")
+    parser.add_argument("--m",help="number of allowed mismatches (default=1)")
+    parser.add_argument("--ph",help="Minimal Phred-score (default=30)")
+    parser.add_argument("--n",help="max number of reads sampled per file (default=1000000)")
+    parser.add_argument("--pr",help="sampling stops once every rate is known within this many %% points (95%% CI, default=0.5)")
+    args = parser.parse_args(argv)
+    
+    extension=".fastq.gz"
+    if args.se is not None:
+        extension=args.se
+    
+    start=0
+    if args.st is not None:
+        start=args.st
+        
+    lenght=20
+    if args.l is not None:
+        lenght=args.l
+        
+    mismatch=1
+    if args.m is not None:
+        mismatch=args.m
+        
+    phred=30
+    if args.ph is not None:
+        phred=args.ph
+        
+    max_reads=1000000
+    if args.n is not None:
+        max_reads=args.n
+        
+    precision=0.5
+    if args.pr is not None:
+        precision=args.pr
+    
+    return args.s, args.g, extension, int(start), int(lenght), int(mismatch), int(phred), int(max_reads), float(precision) / 100
+
 def main():
     
     """ Runs the program by calling all the appropriate functions"""
     
-    ### parses all inputted parameters
-    folder_path, guides,mismatch, quality_set,directory, \
-    version,phred,separator,start, lenght, ram, extension = initializer(input_parser())
+    if sys.argv[1:2] == ["build-index"]:
+        index_builder(*index_parser(sys.argv[2:]))
+        return
+    if sys.argv[1:2] == ["merge"]:
+        merge(*merge_parser(sys.argv[2:]))
+        return
+    if sys.argv[1:2] == ["preview"]:
+        preview(*preview_parser(sys.argv[2:]))
+        return
+    
+    started = time()
+    ### parses all inputted parameters, into the run "options" (see "initializer")
+    options = initializer(input_parser())
+    folder_path, directory, separator, version = options["folder_path"], options["directory"], options["separator"], options["version"]
+    mismatch, phred, start, lenght, indels = options["mismatch"], options["phred"], options["start"], options["lenght"], options["indels"]
+    paired, barcodes, watching = options["paired"], options["barcodes"], options["watching"]
     
     ### parses the names/paths, and orders the sequencing files
-    ordered = path_finder_seq(folder_path, extension, separator)
-    
     ### parses the sequencing files depending on whether they require unzipping or not
-    files, write_path_save = input_file_type(ordered, extension, directory)
+    ### in watch mode the files are looked for as they come instead, see "watch"
+    if watching and (paired or (barcodes is not None) or (folder_path == "-")):
+        input("\nThe watch mode (--wa) can't be combined with --p, --bc or --s -.\nPress any key to exit")
+        raise Exception
+    if (folder_path != "-") and not watching:
+        ordered = path_finder_seq(folder_path, options["extension"], separator)
+        files, write_path_save = input_file_type(ordered, options["extension"], directory, options["unpacking"])
+    elif paired:
+        input("\nThe paired mode (--p) can't read from stdin (--s -).\nPress any key to exit")
+        raise Exception
+    
+    ### loads the sgRNAs from the input .csv file, or from the index file made by build-index. 
+    ### Creates the sgRNA "library" arrays, sorted by sequence
+    ### packs the sgRNAs for the fast engine, and builds the mismatch search index once, for all samples
+    library, keys, index = library_loader(options["guides"], lenght, mismatch, options["engine"], options["search"])
+        
+    ### builds what is needed to find the sgRNA in the reads, when its position isn't fixed
+    locator = None
+    if keys is not None:
+        locator, options["span"] = guide_locator(options["anchor"], options["span"], keys, lenght)
+    elif options["anchor"] or options["span"]:
+        input("\nSearching for the sgRNA position (--a, --w) requires the fast engine, and sgRNAs that can be packed (see --e).\nPress any key to exit")
+        raise Exception
     
-    ### loads the sgRNAs from the input .csv file. 
-    ### Creates a dictionary "sgrna" of class instances for each sgRNA
-    sgrna = guides_loader(guides)
+    ### builds the deletion neighborhood of the sgRNAs, for the indel search of the reads left without a match
+    edits = None
+    if indels:
+        if (keys is None) or paired:
+            input("\nThe indel search (--id) requires the fast engine and sgRNAs that can be packed (see --e), and can't be combined with --p.\nPress any key to exit")
+            raise Exception
+        if folder_path != "-": # the stdin "Counter" builds its own
+            edits = edit_index(keys, lenght, indels)
+    
+    ### In paired mode, counts the guide pairs of the R1/R2 files instead of the single sgRNAs
+    if paired:
+        second = None
+        if options["guides2"] is not None:
+            second = library_loader(options["guides2"], lenght, mismatch, options["engine"], options["search"])
+        if (keys is None) or (second is not None and second[1] is None):
+            input("\nThe paired mode (--p) requires the fast engine, and sgRNAs that can be packed (see --e).\nPress any key to exit")
+            raise Exception
+        results, metrics, library1, library2 = paired_multi(files, write_path_save, options, ((library, keys, index, locator), second))
+        tempo = time()
+        paired_compiling(results, library1, library2, directory, phred, mismatch, version, separator)
+        metrics["compiled"] = Metrics()
+        metrics["compiled"].add("output", tempo)
+        metrics_writer(directory, separator, metrics, started)
+        profile_writer(directory, separator, metrics, phred)
+        exit_prompt("\nAnalysis successfully completed\nAll the guide pair reads have been compiled into the compiled_pairs.csv file.\nPress any key to exit")
+        return
+    
+    params = {name:options[name] for name in ["phred", "mismatch", "start", "lenght", "anchor", "span", "indels"]} # what the counts depend on
     
     ### Processes all the samples by associating sgRNAs to the reads on the fastq files.
-    ### Creates one process per sample, allowing multiple samples to be processed in parallel. 
-    multi(files,guides, write_path_save, quality_set,mismatch,sgrna,version,separator, start, lenght, ram)
+    ### Big files are split into chunks, and all the chunks from all the samples are processed in parallel. 
+    ### The read counts of each sample are returned as one vector (indexed by sgRNA ID).
+    ### Live progress is printed while the files are processed, and the metrics of each sample are returned too.
+    ### Samples completed by a previous run into the same output folder, with the same input files and parameters, are skipped.
+    ### A sample piped through stdin is counted as it comes, in this process.
+    ### With a barcode sheet, the files are pooled samples, demultiplexed while counting.
+    if barcodes is not None:
+        if (keys is None) or paired or (folder_path == "-"):
+            input("\nDemultiplexing (--bc) requires the fast engine and sgRNAs that can be packed (see --e), and can't be combined with --p or --s -.\nPress any key to exit")
+            raise Exception
+        demux = barcodes_loader(barcodes, options["barcode_mismatch"])
+        results, metrics = demux_multi(files, options, library, keys, index, locator, demux, edits)
+    elif folder_path == "-":
+        if keys is None:
+            input("\nReading from stdin (--s -) requires the fast engine, and sgRNAs that can be packed (see --e).\nPress any key to exit")
+            raise Exception
+        store = open_store(options["stores"], library, lenght, mismatch)
+        counter = Counter(library, lenght, start, mismatch, phred, options["cache_size"], keys, index, locator, options["span"], ResolutionStore(store) if store else None, indels)
+        results, metrics = stdin_counter(counter, directory + separator + options["sample_name"] + ".fastq", separator)
+    elif watching:
+        manifest = Manifest(directory, library, dict(params, version=version), options["fresh"])
+        results, metrics = watch(options, library, keys, index, locator, manifest, edits, params, started)
+    else:
+        manifest = Manifest(directory, library, dict(params, version=version), options["fresh"])
+        results, metrics = multi(files, write_path_save, options, library, keys, index, locator, manifest, edits)
+    
+    ### The watch mode can be stopped (or find a CopyComplete.txt file) before any sample was counted
+    if not results:
+        exit_prompt("\nNo sample was counted, so no output was written.\nPress any key to exit")
+        return
+    
+    ### Compiles all the processed samples from multi into one file, creates the run statistics, and writes the partial count file, 
+    ### the timings and read counters, and the read profiles (see "outputs_writer")
+    outputs_writer(results, metrics, library, directory, separator, version, params, options["columnar"], started)
     
-    ### Compiles all the processed samples from multi into one file, and creates the run statistics
-    compiling(directory,phred,mismatch,version,separator)
+    exit_prompt("\nAnalysis successfully completed\nAll the reads have been compiled into the compiled.csv file.\nPress any key to exit")
     
 if __name__ == "__main__":
     multiprocessing.freeze_support() # required to run multiprocess as .exe on windows
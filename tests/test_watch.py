@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_watch_empty_folder(tmp_path):
+
+    """ a watched folder with only the CopyComplete.txt file ends the run
+    without a traceback, and without writing compiled.csv """
+
+    folder, out = tmp_path / "reads", tmp_path / "out"
+    folder.mkdir()
+    out.mkdir()
+    (folder / "CopyComplete.txt").touch()
+
+    run = subprocess.run([sys.executable, os.path.join(ROOT, "crispery.py"), "-c", "--s", str(folder), "--g", os.path.join(ROOT, "D39V_guides.csv"),
+                          "--o", str(out), "--se", ".fastq", "--wa"], stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=600)
+
+    assert run.returncode == 0, run.stderr
+    assert "No sample was counted" in run.stdout
+    assert not (out / "compiled.csv").exists()